@@ -9,7 +9,6 @@ from bbrl import get_arguments, get_class
 from bbrl.workspace import Workspace
 from bbrl.agents import Agents, TemporalAgent
 
-from bbrl.utils.functional import gae
 
 import hydra
 
@@ -30,7 +29,18 @@ from bbrl.visu.plot_policies import plot_policy
 from bbrl.visu.plot_critics import plot_critic
 from bbrl_algos.models.envs import get_env_agents
 from bbrl_algos.models.hyper_params import launch_optuna
-from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.instrumentation import PhaseTimer
+from bbrl_algos.models.distributed import (
+    launch_distributed,
+    is_main_process,
+    broadcast_parameters,
+    all_reduce_gradients,
+    sum_over_ranks,
+)
+from bbrl_algos.models.checkpoint import CheckpointManager
+from bbrl_algos.models.rollout import make_temporal_agent
+from bbrl_algos.models.returns import gae_advantages
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
 
 # HYDRA_FULL_ERROR = 1
 
@@ -53,8 +63,10 @@ def create_a2c_agent(cfg, train_env_agent, eval_env_agent):
     )
 
     # Get an agent that is executed on a complete workspace
-    train_agent = TemporalAgent(tr_agent)
-    eval_agent = TemporalAgent(ev_agent)
+    # The training rollout only collects data: the log probabilities and the entropy
+    # are computed again from the rollout buffer, with a gradient
+    train_agent = make_temporal_agent(tr_agent, requires_grad=False)
+    eval_agent = make_temporal_agent(ev_agent, requires_grad=False)
     return train_agent, eval_agent, critic_agent
 
 
@@ -66,26 +78,29 @@ def setup_optimizers(cfg, action_agent, critic_agent):
     return optimizer
 
 
-def compute_advantages_loss(cfg, reward, must_bootstrap, v_value):
-    # Compute temporal difference
-    # target = reward[:-1] + cfg.algorithm.discount_factor * v_value[1:].detach() * must_bootstrap.int()
-    # td = target - v_value[:-1]
-    advantages = gae(
+def compute_advantages_loss(cfg, rollout_buffer, v_value):
+    # Compute the advantages with GAE over the whole rollout,
+    # the values of terminal states are not bootstrapped
+    advantages, returns = gae_advantages(
         v_value,
-        reward,
-        must_bootstrap,
+        rollout_buffer.reward,
+        rollout_buffer.terminated,
+        rollout_buffer.done,
         cfg.algorithm.discount_factor,
         cfg.algorithm.gae,
+        advantages=rollout_buffer.advantage,
+        returns=rollout_buffer.returns,
+        compiled="compile_gae" in cfg.algorithm and cfg.algorithm.compile_gae,
     )
-    # Compute critic loss
-    td = advantages - v_value[:-1]
-    td_error = td**2
+    # The critic regresses onto the returns over the transitions inside an episode,
+    # the gradient does not flow through the GAE recursion
+    td_error = (v_value - returns.detach())[rollout_buffer.valid] ** 2
     critic_loss = td_error.mean()
     return critic_loss, advantages
 
 
-def compute_actor_loss(action_logp, td):
-    a2c_loss = action_logp[:-1] * td.detach()
+def compute_actor_loss(action_logp, td, valid):
+    a2c_loss = action_logp[valid] * td[valid].detach()
     return a2c_loss.mean()
 
 
@@ -106,62 +121,69 @@ def run_a2c(cfg, logger, trial=None):
     # In the training loop, calling the agent() and critic_agent()
     # will take the workspace as parameter
     train_workspace = Workspace()  # Used for training
+    rollout_buffer = RolloutBuffer()
+    policy = a2c_agent.agent.agents[1]
+    critic = critic_agent.agent
 
     # 6) Configure the optimizer over the a2c agent
     optimizer = setup_optimizers(cfg, a2c_agent, critic_agent)
+    # In data-parallel training, all the ranks start from the parameters of the rank 0
+    broadcast_parameters(optimizer)
     nb_steps = 0
     tmp_steps = 0
 
+    # Time spent in each phase of the loop, logged at each evaluation
+    timer = PhaseTimer.from_config(cfg)
+
+    # The best agents, written in the background by the main process
+    if cfg.save_best and is_main_process():
+        best_agents = CheckpointManager.from_config(
+            cfg, "./a2c_best_agents/", cfg.gym_env.env_name + "a2c"
+        )
+
     # 7) Training loop
     while nb_steps < cfg.algorithm.n_steps:
         # Execute the agent in the workspace
-        if nb_steps > 0:
-            train_workspace.zero_grad()
-            train_workspace.copy_n_last_steps(1)
-            a2c_agent(
-                train_workspace,
-                t=1,
-                n_steps=cfg.algorithm.n_steps_train - 1,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=True,
-            )
-        else:
-            a2c_agent(
-                train_workspace,
-                t=0,
-                n_steps=cfg.algorithm.n_steps_train,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=True,
+        with timer.phase("collect"):
+            if nb_steps > 0:
+                train_workspace.copy_n_last_steps(1)
+                a2c_agent(
+                    train_workspace,
+                    t=1,
+                    n_steps=cfg.algorithm.n_steps_train - 1,
+                    stochastic=True,
+                    predict_proba=False,
+                )
+            else:
+                a2c_agent(
+                    train_workspace,
+                    t=0,
+                    n_steps=cfg.algorithm.n_steps_train,
+                    stochastic=True,
+                    predict_proba=False,
+                )
+
+        # Copy the rollout into the preallocated buffer
+        with timer.phase("transitions"):
+            rollout_buffer.store(train_workspace)
+        nb_steps += sum_over_ranks(rollout_buffer.nb_transitions())
+
+        with timer.phase("forward"):
+            # Compute the log probabilities of the played actions, the entropy
+            # and the critic values over the whole rollout at once
+            action_logp, entropy = policy.evaluate_actions(
+                rollout_buffer.obs, rollout_buffer.action, compute_entropy=True
             )
+            v_value = critic.predict_value(rollout_buffer.obs)
 
-        # Compute the critic value over the whole workspace
-        critic_agent(train_workspace, n_steps=cfg.algorithm.n_steps_train)
-
-        transition_workspace = train_workspace.get_transitions()
-
-        v_value, terminated, reward, action, action_logp = transition_workspace[
-            "critic/v_values",
-            "env/terminated",
-            "env/reward",
-            "action",
-            "policy/action_logprobs",
-        ]
-        # print("action", action)
-        nb_steps += action[0].shape[0]
-        # Determines whether values of the critic should be propagated
-        # True if the task was not terminated.
-        must_bootstrap = ~terminated
-
-        # Compute critic loss
-        critic_loss, advantages = compute_advantages_loss(
-            cfg, reward, must_bootstrap, v_value
-        )
-        a2c_loss = compute_actor_loss(action_logp, advantages)
+            # Compute critic loss
+            critic_loss, advantages = compute_advantages_loss(
+                cfg, rollout_buffer, v_value
+            )
+            a2c_loss = compute_actor_loss(action_logp, advantages, rollout_buffer.valid)
 
-        # Compute entropy loss
-        entropy_loss = torch.mean(train_workspace["entropy"])
+            # Compute entropy loss
+            entropy_loss = torch.mean(entropy)
 
         # Store the losses for tensorboard display
         logger.log_losses(nb_steps, critic_loss, entropy_loss, a2c_loss)
@@ -173,37 +195,49 @@ def run_a2c(cfg, logger, trial=None):
             - cfg.algorithm.a2c_coef * a2c_loss
         )
 
-        optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(
-            a2c_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
-        optimizer.step()
+        with timer.phase("backward"):
+            optimizer.zero_grad()
+            loss.backward()
+            all_reduce_gradients(optimizer)
+            torch.nn.utils.clip_grad_norm_(
+                a2c_agent.parameters(), cfg.algorithm.max_grad_norm
+            )
+        with timer.phase("optimizer_step"):
+            optimizer.step()
+        timer.add_updates()
 
-        if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
+        if nb_steps - tmp_steps > cfg.algorithm.eval_interval and is_main_process():
             tmp_steps = nb_steps
             eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                stochastic=False,
-                predict_proba=False,
-            )
+            with timer.phase("evaluation"):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    stochastic=False,
+                    predict_proba=False,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
             logger.log_reward_losses(rewards, nb_steps)
+            timer.log(logger, nb_steps)
             print(
                 f"nb_steps: {nb_steps}, reward: {mean:.0f}, best_reward: {best_reward:.0f}"
             )
             if mean > best_reward:
                 best_reward = mean
 
+            if cfg.save_best:
+                with timer.phase("checkpoint"):
+                    best_agents.save(
+                        mean,
+                        nb_steps,
+                        {"policy": policy, "critic": critic},
+                        {"optimizer": optimizer},
+                    )
+
             if cfg.save_best and best_reward == mean:
                 policy = eval_agent.agent.agents[1]
-                save_best(
-                    policy, cfg.gym_env.env_name, mean, "./a2c_best_agents/", "a2c"
-                )
                 critic = critic_agent.agent
                 if cfg.plot_agents:
                     plot_policy(
@@ -227,7 +261,11 @@ def run_a2c(cfg, logger, trial=None):
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
-    chrono.stop()
+    if cfg.save_best and is_main_process():
+        best_agents.close()
+    # Like the logs, the duration of the run is only printed by the main process
+    if is_main_process():
+        chrono.stop()
     return best_reward
 
 
@@ -243,6 +281,8 @@ def main(cfg_raw: DictConfig):
 
     if "optuna" in cfg_raw:
         launch_optuna(cfg_raw, run_a2c)
+    elif "n_processes" in cfg_raw.algorithm and cfg_raw.algorithm.n_processes > 1:
+        launch_distributed(cfg_raw, run_a2c)
     else:
         logger = Logger(cfg_raw)
         run_a2c(cfg_raw, logger)
@@ -1,4 +1,5 @@
 import numpy as np
+from functools import partial
 
 import torch
 import torch.nn as nn
@@ -6,14 +7,23 @@ import hydra
 import optuna
 
 from omegaconf import DictConfig
-from bbrl.workspace import Workspace
+from bbrl import get_arguments, get_class
 from bbrl.agents import Agents, TemporalAgent
 
 from bbrl_algos.models.loggers import Logger
 from bbrl_algos.wrappers.env_wrappers import FilterWrapper
 from bbrl_algos.models.hyper_params import launch_optuna
 from bbrl_algos.models.utils import save_best
-from bbrl_algos.models.envs import get_eval_env_agent
+from bbrl_algos.models.covariance import CovMatrix
+from bbrl_algos.models.importance_mixing import importance_mixing
+from bbrl_algos.models.envs import (
+    get_eval_env_agent,
+    get_population_eval_env_agent,
+)
+from bbrl_algos.models.population_eval import (
+    PopulationEvaluator,
+    PopulationWorkerPool,
+)
 
 # Neural network models for actors and critics
 from bbrl_algos.models.actors import (
@@ -39,27 +49,6 @@ import matplotlib
 matplotlib.use("TkAgg")
 
 
-class CovMatrix:
-    def __init__(self, centroid: torch.Tensor, sigma, noise_multiplier):
-        policy_dim = centroid.size()[0]
-        self.noise = torch.diag(torch.ones(policy_dim) * sigma)
-        self.cov = torch.diag(torch.ones(policy_dim) * torch.var(centroid)) + self.noise
-        self.noise_multiplier = noise_multiplier
-
-    def update_noise(self) -> None:
-        self.noise = self.noise * self.noise_multiplier
-
-    def generate_weights(self, centroid, pop_size):
-        dist = torch.distributions.MultivariateNormal(
-            centroid, covariance_matrix=self.cov
-        )
-        weights = [dist.sample() for _ in range(pop_size)]
-        return weights
-
-    def update_covariance(self, elite_weights) -> None:
-        self.cov = torch.cov(elite_weights.T) + self.noise
-
-
 # Create the CEM Agent
 def create_CEM_agent(cfg, env_agent):
     obs_size, act_size = env_agent.get_obs_and_actions_sizes()
@@ -72,19 +61,51 @@ def create_CEM_agent(cfg, env_agent):
     return eval_agent
 
 
-def run_cem(cfg, logger, trial=None):
-    eval_env_agent = get_eval_env_agent(cfg)
+def create_covariance(cfg, centroid):
+    # The covariance model is a full matrix, unless another one is given in the config
+    if "covariance" in cfg.algorithm:
+        covariance_class = get_class(cfg.algorithm.covariance)
+        covariance_args = get_arguments(cfg.algorithm.covariance)
+    else:
+        covariance_class = CovMatrix
+        covariance_args = {}
+    return covariance_class(
+        centroid,
+        cfg.algorithm.sigma,
+        cfg.algorithm.noise_multiplier,
+        **covariance_args,
+    )
+
 
+def run_cem(cfg, logger, trial=None):
     pop_size = cfg.algorithm.pop_size
 
+    # The population is evaluated either by worker processes,
+    # or in a single batched rollout of all the individuals
+    n_workers = cfg.algorithm.n_workers if "n_workers" in cfg.algorithm else 0
+    eval_env_agent = get_eval_env_agent(cfg)
     eval_agent = create_CEM_agent(cfg, eval_env_agent)
+    policy = eval_agent.agent.agents[1]
+    if n_workers > 0:
+        evaluator = PopulationWorkerPool(cfg, policy, pop_size, n_workers)
+    else:
+        evaluator = PopulationEvaluator(
+            partial(get_population_eval_env_agent, cfg),
+            policy,
+            cfg.algorithm.nb_evals,
+        )
 
-    centroid = torch.nn.utils.parameters_to_vector(eval_agent.parameters())
-    matrix = CovMatrix(
-        centroid,
-        cfg.algorithm.sigma,
-        cfg.algorithm.noise_multiplier,
+    # With importance mixing, the samples of the previous generation are reused
+    # when they are likely enough under the new sampling distribution
+    use_importance_mixing = (
+        "importance_mixing" in cfg.algorithm and cfg.algorithm.importance_mixing
     )
+    old_dist = None
+    old_weights = old_scores = None
+
+    # The weights of the policy only (the env agent has a dummy parameter)
+    centroid = torch.nn.utils.parameters_to_vector(policy.parameters())
+    matrix = create_covariance(cfg, centroid)
 
     best_score = -np.inf
     nb_steps = 0
@@ -92,19 +113,26 @@ def run_cem(cfg, logger, trial=None):
     # 7) Training loop
     while nb_steps < cfg.algorithm.n_steps:
         matrix.update_noise()
+        new_dist = matrix.get_distribution(centroid)
+        if use_importance_mixing and old_dist is not None:
+            reused, weights = importance_mixing(
+                old_dist, new_dist, old_weights, pop_size, cfg.algorithm.refresh_rate
+            )
+            reused_weights = old_weights[reused]
+            reused_scores = [old_scores[k] for k in reused]
+            logger.add_log("reused", len(reused), nb_steps)
+        else:
+            weights = new_dist.sample((pop_size,))
+            reused_weights = weights[:0]
+            reused_scores = []
+
+        # Evaluate the new individuals at once
+        population_rewards, population_steps = evaluator.evaluate(weights)
         scores = []
-        weights = matrix.generate_weights(centroid, pop_size)
-
-        for i in range(pop_size):
-            workspace = Workspace()
-            w = weights[i]
-            torch.nn.utils.vector_to_parameters(w, eval_agent.parameters())
-
-            eval_agent(workspace, t=0, stop_variable="env/done", render=False)
-            action = workspace["action"]
-            nb_steps += action.shape[0]
-            rewards = workspace["env/cumulated_reward"][-1]
-            mean_reward = rewards.mean()
+
+        for i in range(len(weights)):
+            nb_steps += population_steps[i].item()
+            mean_reward = population_rewards[i]
             logger.add_log("reward", mean_reward, nb_steps)
 
             # ---------------------------------------------------
@@ -116,6 +144,7 @@ def run_cem(cfg, logger, trial=None):
                 )
             if cfg.save_best and mean_reward > best_score:
                 best_score = mean_reward
+                torch.nn.utils.vector_to_parameters(weights[i], policy.parameters())
                 print("Best score: ", best_score)
                 save_best(
                     eval_agent,
@@ -133,12 +162,14 @@ def run_cem(cfg, logger, trial=None):
                         cfg.gym_env.env_name,
                         stochastic=False,
                     )
+        # The population is made of the reused samples and the new ones
+        weights = torch.cat((reused_weights, weights))
+        scores = reused_scores + scores
+        old_dist, old_weights, old_scores = new_dist, weights, scores
+
         # Keep only best individuals to compute the new centroid
         elites_idxs = np.argsort(scores)[-cfg.algorithm.elites_nb :]
-        elites_weights = [weights[k] for k in elites_idxs]
-        elites_weights = torch.cat(
-            [w.clone().detach().unsqueeze(0) for w in elites_weights], dim=0
-        )
+        elites_weights = weights[torch.as_tensor(elites_idxs)]
         centroid = elites_weights.mean(0)
 
         # Update covariance
@@ -146,6 +177,7 @@ def run_cem(cfg, logger, trial=None):
         matrix.update_covariance(elites_weights)
         if cfg.verbose:
             print("---------------------")
+    evaluator.close()
     return best_score
 
 
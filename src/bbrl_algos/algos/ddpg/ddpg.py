@@ -22,8 +22,18 @@ from bbrl_algos.models.critics import ContinuousQAgent
 from bbrl_algos.models.plotters import Plotter
 from bbrl_algos.models.exploration_agents import AddGaussianNoise
 from bbrl_algos.models.envs import get_env_agents
-from bbrl_algos.models.hyper_params import launch_optuna
-from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.hyper_params import launch_optuna, resumable
+from bbrl_algos.models.instrumentation import PhaseTimer
+from bbrl_algos.models.memory import log_memory
+from bbrl_algos.models.checkpoint import (
+    CheckpointManager,
+    save_checkpoint,
+    load_checkpoint,
+    replay_buffer_state,
+    load_replay_buffer_state,
+    rng_state,
+    set_rng_state,
+)
 
 from bbrl.visu.plot_policies import plot_policy
 from bbrl.visu.plot_critics import plot_critic
@@ -99,6 +109,7 @@ def compute_actor_loss(q_values):
     return -q_values.mean()
 
 
+@resumable
 def run_ddpg(cfg, logger, trial=None):
     best_reward = float("-inf")
 
@@ -127,88 +138,143 @@ def run_ddpg(cfg, logger, trial=None):
     nb_steps = 0
     tmp_steps = 0
 
+    # Resume the run from its checkpoint, if there is one
+    checkpoint_path = (
+        cfg.algorithm.checkpoint if "checkpoint" in cfg.algorithm else None
+    )
+    checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path else None
+    if checkpoint is not None:
+        actor.load_state_dict(checkpoint["actor"])
+        critic.load_state_dict(checkpoint["critic"])
+        target_critic.load_state_dict(checkpoint["target_critic"])
+        actor_optimizer.load_state_dict(checkpoint["actor_optimizer"])
+        critic_optimizer.load_state_dict(checkpoint["critic_optimizer"])
+        load_replay_buffer_state(rb, checkpoint["replay_buffer"])
+        nb_steps = checkpoint["nb_steps"]
+        tmp_steps = checkpoint["tmp_steps"]
+        best_reward = checkpoint["best_reward"]
+        set_rng_state(checkpoint["rng"])
+    # The environments are not restored, a resumed run starts new episodes
+    start_steps = nb_steps
+
+    # Time spent in each phase of the loop, logged at each evaluation
+    timer = PhaseTimer.from_config(cfg, nb_steps)
+
+    # The best agents, written in the background
+    if cfg.save_best:
+        best_agents = CheckpointManager.from_config(
+            cfg, "./ddpg_best_agents/", cfg.gym_env.env_name + "ddpg"
+        )
+
     # Training loop
     while nb_steps < cfg.algorithm.n_steps:
         # Execute the agent in the workspace
-        if nb_steps > 0:
-            train_workspace.zero_grad()
-            train_workspace.copy_n_last_steps(1)
-            train_agent(train_workspace, t=1, n_steps=cfg.algorithm.n_steps_train)
-        else:
-            train_agent(train_workspace, t=0, n_steps=cfg.algorithm.n_steps_train)
-
-        transition_workspace = train_workspace.get_transitions(filter_key="env/done")
+        with timer.phase("collect"):
+            if nb_steps > start_steps:
+                train_workspace.zero_grad()
+                train_workspace.copy_n_last_steps(1)
+                train_agent(train_workspace, t=1, n_steps=cfg.algorithm.n_steps_train)
+            else:
+                train_agent(train_workspace, t=0, n_steps=cfg.algorithm.n_steps_train)
+
+        with timer.phase("transitions"):
+            transition_workspace = train_workspace.get_transitions(
+                filter_key="env/done"
+            )
         action = transition_workspace["action"]
         nb_steps += action[0].shape[0]
-        rb.put(transition_workspace)
+        with timer.phase("replay_put"):
+            rb.put(transition_workspace)
 
         for _ in range(cfg.algorithm.optim_n_updates):
-            rb_workspace = rb.get_shuffled(cfg.algorithm.batch_size)
+            with timer.phase("replay_sample"):
+                rb_workspace = rb.get_shuffled(cfg.algorithm.batch_size)
 
             terminated, reward, action = rb_workspace[
                 "env/terminated", "env/reward", "action"
             ]
             if nb_steps > cfg.algorithm.learning_starts:
-                # Determines whether values of the critic should be propagated
-                # True if the task was not terminated.
-                must_bootstrap = ~terminated[1]
-                # Critic update
-                # compute q_values: at t, we have Q(s,a) from the (s,a) in the RB
-                # the detach_actions=True changes nothing in the results
-                q_agent(rb_workspace, t=0, n_steps=1, detach_actions=True)
-                q_values = rb_workspace["critic/q_values"]
-
-                with torch.no_grad():
-                    # replace the action at t+1 in the RB with \pi(s_{t+1}), to compute Q(s_{t+1}, \pi(s_{t+1}) below
-                    ag_actor(rb_workspace, t=1, n_steps=1)
-                    # compute q_values: at t+1 we have Q(s_{t+1}, \pi(s_{t+1})
-                    target_q_agent(rb_workspace, t=1, n_steps=1, detach_actions=True)
-                    # q_agent(rb_workspace, t=1, n_steps=1)
-                # finally q_values contains the above collection at t=0 and t=1
-                post_q_values = rb_workspace["target-critic/q_values"]
-
-                # Compute critic loss
-                critic_loss = compute_critic_loss(
-                    cfg, reward, must_bootstrap, q_values[0], post_q_values[1]
-                )
+                with timer.phase("forward"):
+                    # Determines whether values of the critic should be propagated
+                    # True if the task was not terminated.
+                    must_bootstrap = ~terminated[1]
+                    # Critic update
+                    # compute q_values: at t, we have Q(s,a) from the (s,a) in the RB
+                    # the detach_actions=True changes nothing in the results
+                    q_agent(rb_workspace, t=0, n_steps=1, detach_actions=True)
+                    q_values = rb_workspace["critic/q_values"]
+
+                    with torch.no_grad():
+                        # replace the action at t+1 in the RB with \pi(s_{t+1}), to compute Q(s_{t+1}, \pi(s_{t+1}) below
+                        ag_actor(rb_workspace, t=1, n_steps=1)
+                        # compute q_values: at t+1 we have Q(s_{t+1}, \pi(s_{t+1})
+                        target_q_agent(
+                            rb_workspace, t=1, n_steps=1, detach_actions=True
+                        )
+                        # q_agent(rb_workspace, t=1, n_steps=1)
+                    # finally q_values contains the above collection at t=0 and t=1
+                    post_q_values = rb_workspace["target-critic/q_values"]
+
+                    # Compute critic loss
+                    critic_loss = compute_critic_loss(
+                        cfg, reward, must_bootstrap, q_values[0], post_q_values[1]
+                    )
                 logger.add_log("critic_loss", critic_loss, nb_steps)
-                critic_optimizer.zero_grad()
-                critic_loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    critic.parameters(), cfg.algorithm.max_grad_norm
-                )
-                critic_optimizer.step()
+                with timer.phase("backward"):
+                    critic_optimizer.zero_grad()
+                    critic_loss.backward()
+                    torch.nn.utils.clip_grad_norm_(
+                        critic.parameters(), cfg.algorithm.max_grad_norm
+                    )
+                with timer.phase("optimizer_step"):
+                    critic_optimizer.step()
 
                 # Actor update
-                # Now we determine the actions the current policy would take in the states from the RB
-                ag_actor(rb_workspace, t=0, n_steps=1)
-                # We determine the Q values resulting from actions of the current policy
-                q_agent(rb_workspace, t=0, n_steps=1)
-                # and we back-propagate the corresponding loss to maximize the Q values
-                q_values = rb_workspace["critic/q_values"]
-                actor_loss = compute_actor_loss(q_values)
+                with timer.phase("forward"):
+                    # Now we determine the actions the current policy would take in the states from the RB
+                    ag_actor(rb_workspace, t=0, n_steps=1)
+                    # We determine the Q values resulting from actions of the current policy
+                    q_agent(rb_workspace, t=0, n_steps=1)
+                    # and we back-propagate the corresponding loss to maximize the Q values
+                    q_values = rb_workspace["critic/q_values"]
+                    actor_loss = compute_actor_loss(q_values)
                 logger.add_log("actor_loss", actor_loss, nb_steps)
                 # if -25 < actor_loss < 0 and nb_steps > 2e5:
-                actor_optimizer.zero_grad()
-                actor_loss.backward()
-                torch.nn.utils.clip_grad_norm_(
-                    actor.parameters(), cfg.algorithm.max_grad_norm
-                )
-                actor_optimizer.step()
+                with timer.phase("backward"):
+                    actor_optimizer.zero_grad()
+                    actor_loss.backward()
+                    torch.nn.utils.clip_grad_norm_(
+                        actor.parameters(), cfg.algorithm.max_grad_norm
+                    )
+                with timer.phase("optimizer_step"):
+                    actor_optimizer.step()
+                timer.add_updates()
                 # Soft update of target q function
-                tau = cfg.algorithm.tau_target
-                soft_update_params(critic, target_critic, tau)
-                # soft_update_params(actor, target_actor, tau)
+                with timer.phase("target_update"):
+                    tau = cfg.algorithm.tau_target
+                    soft_update_params(critic, target_critic, tau)
+                    # soft_update_params(actor, target_actor, tau)
 
         if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
             tmp_steps = nb_steps
             eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(eval_workspace, t=0, stop_variable="env/done")
+            with timer.phase("evaluation"):
+                eval_agent(eval_workspace, t=0, stop_variable="env/done")
 
             rewards = eval_workspace["env/cumulated_reward"][-1]
 
             mean = rewards.mean()
             logger.log_reward_losses(rewards, nb_steps)
+            timer.log(logger, nb_steps)
+            if "log_memory" in cfg and cfg.log_memory:
+                log_memory(
+                    logger,
+                    nb_steps,
+                    rb,
+                    {"train": train_workspace, "eval": eval_workspace},
+                    {"actor": actor, "critic": critic, "target_critic": target_critic},
+                    {"actor": actor_optimizer, "critic": critic_optimizer},
+                )
 
             if mean > best_reward:
                 best_reward = mean
@@ -220,15 +286,16 @@ def run_ddpg(cfg, logger, trial=None):
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
-            if cfg.save_best and best_reward == mean:
-                save_best(
-                    eval_agent,
-                    cfg.gym_env.env_name,
-                    mean,
-                    "./ddpg_best_agents/",
-                    "ddpg",
-                )
-                if cfg.plot_agents:
+            if cfg.save_best:
+                with timer.phase("checkpoint"):
+                    best_agents.save(
+                        mean,
+                        nb_steps,
+                        {"actor": actor, "critic": critic},
+                        {"actor": actor_optimizer, "critic": critic_optimizer},
+                        rb,
+                    )
+                if best_reward == mean and cfg.plot_agents:
                     plot_policy(
                         eval_agent.agent.agents[1],
                         eval_env_agent,
@@ -246,6 +313,28 @@ def run_ddpg(cfg, logger, trial=None):
                         input_action=None,
                     )
 
+    if checkpoint_path:
+        with timer.phase("checkpoint"):
+            save_checkpoint(
+                checkpoint_path,
+                {
+                    "actor": actor.state_dict(),
+                    "critic": critic.state_dict(),
+                    "target_critic": target_critic.state_dict(),
+                    "actor_optimizer": actor_optimizer.state_dict(),
+                    "critic_optimizer": critic_optimizer.state_dict(),
+                    "replay_buffer": replay_buffer_state(rb),
+                    "nb_steps": nb_steps,
+                    "tmp_steps": tmp_steps,
+                    "best_reward": best_reward,
+                    "rng": rng_state(),
+                },
+            )
+        timer.log(logger, nb_steps)
+
+    if cfg.save_best:
+        best_agents.close()
+
     return best_reward
 
 
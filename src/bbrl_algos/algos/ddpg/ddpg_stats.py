@@ -27,6 +27,7 @@ from bbrl_algos.models.exploration_agents import AddGaussianNoise
 from bbrl_algos.models.envs import get_env_agents
 from bbrl_algos.models.hyper_params import launch_optuna
 from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.stats import StatsWriter
 
 # HYDRA_FULL_ERROR = 1
 import matplotlib
@@ -128,12 +129,8 @@ def run_ddpg(cfg, logger, trial=None):
     nb_steps = 0
     tmp_steps = 0
     if cfg.collect_stats:
-        directory = "./ddpg_data/"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        filename = directory + "ddpg.data"
-        fo = open(filename, "wb")
-        stats_data = []
+        # The rewards of the evaluations, written as they come
+        stats = StatsWriter("./ddpg_data/ddpg.stats", cfg.algorithm.nb_evals)
 
     # Training loop
     while nb_steps < cfg.algorithm.n_steps:
@@ -251,15 +248,10 @@ def run_ddpg(cfg, logger, trial=None):
                     )
 
             if cfg.collect_stats:
-                stats_data.append(rewards)
+                stats.write(nb_steps, rewards)
 
     if cfg.collect_stats:
-        # All rewards, dimensions (# of evaluations x # of episodes)
-        stats_data = torch.stack(stats_data, axis=-1)
-        print(np.shape(stats_data))
-        np.savetxt(filename, stats_data.numpy())
-        fo.flush()
-        fo.close()
+        stats.close()
 
     return best_reward
 
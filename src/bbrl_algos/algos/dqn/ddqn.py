@@ -35,6 +35,8 @@ from bbrl_algos.models.exploration_agents import EGreedyActionSelector
 from bbrl_algos.models.critics import DiscreteQAgent
 from bbrl_algos.models.loggers import Logger
 from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.rollout import make_temporal_agent
+from bbrl_algos.models.stats import StatsWriter
 
 from bbrl.visu.plot_critics import plot_discrete_q, plot_critic
 from bbrl_algos.models.hyper_params import launch_optuna
@@ -150,8 +152,9 @@ def create_dqn_agent(cfg_algo, train_env_agent, eval_env_agent):
     ev_agent = Agents(eval_env_agent, critic)
 
     # Get an agent that is executed on a complete workspace
-    train_agent = TemporalAgent(tr_agent)
-    eval_agent = TemporalAgent(ev_agent)
+    # Neither collection nor evaluation need gradients: the critic is trained on the replay buffer
+    train_agent = make_temporal_agent(tr_agent, requires_grad=False)
+    eval_agent = make_temporal_agent(ev_agent, requires_grad=False)
 
     return train_agent, eval_agent, q_agent, target_q_agent
 
@@ -169,12 +172,11 @@ def setup_optimizer(optimizer_cfg, q_agent):
 def run_ddqn(cfg, logger, trial=None):
     best_reward = float("-inf")
     if cfg.collect_stats:
-        directory = "./ddqn_data/"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        filename = directory + "ddqn_" + cfg.gym_env.env_name + ".txt"
-        fo = open(filename, "wb")
-        stats_data = []
+        # The rewards of the evaluations, written as they come
+        stats = StatsWriter(
+            "./ddqn_data/ddqn_" + cfg.gym_env.env_name + ".stats",
+            cfg.algorithm.nb_evals,
+        )
 
     # 1) Create the environment agent
     train_env_agent, eval_env_agent = local_get_env_agents(cfg)
@@ -205,7 +207,6 @@ def run_ddqn(cfg, logger, trial=None):
 
         # Execute the agent in the workspace
         if nb_steps > 0:
-            train_workspace.zero_grad()
             train_workspace.copy_n_last_steps(1)
             train_agent(
                 train_workspace,
@@ -313,7 +314,7 @@ def run_ddqn(cfg, logger, trial=None):
                         input_action=None,
                     )
             if cfg.collect_stats:
-                stats_data.append(mean)
+                stats.write(nb_steps, rewards)
 
             if trial is not None:
                 trial.report(mean, nb_steps)
@@ -321,12 +322,7 @@ def run_ddqn(cfg, logger, trial=None):
                     raise optuna.TrialPruned()
 
     if cfg.collect_stats:
-        # All rewards, dimensions (# of evaluations x # of episodes)
-        stats_data = torch.stack(stats_data, axis=-1)
-        print(np.shape(stats_data))
-        np.savetxt(filename, stats_data.numpy())
-        fo.flush()
-        fo.close()
+        stats.close()
 
     if cfg.visualize:
         env = make_env(cfg.gym_env.env_name, render_mode="rgb_array")
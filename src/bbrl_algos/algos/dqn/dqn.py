@@ -33,10 +33,33 @@ from bbrl.workspace import Workspace
 from bbrl_algos.models.exploration_agents import EGreedyActionSelector
 from bbrl_algos.models.critics import DiscreteQAgent
 from bbrl_algos.models.loggers import Logger
-from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.checkpoint import (
+    CheckpointManager,
+    ReplayableEnv,
+    ReplaySegments,
+    save_checkpoint,
+    load_checkpoint,
+    env_agent_state,
+    load_env_agent_state,
+    rng_state,
+    set_rng_state,
+)
+from bbrl_algos.models.rollout import make_temporal_agent
+from bbrl_algos.models.instrumentation import PhaseTimer
+from bbrl_algos.models.stats import StatsWriter
+from bbrl_algos.models.memory import log_memory
+from bbrl_algos.models.ensemble import (
+    Ensemble,
+    EnsembleAgent,
+    EnsembleReplayBuffer,
+    clip_grad_norm_per_member,
+    ensemble_env_config,
+    member_config,
+    MemberStatsWriter,
+)
 
 from bbrl.visu.plot_critics import plot_discrete_q, plot_critic
-from bbrl_algos.models.hyper_params import launch_optuna
+from bbrl_algos.models.hyper_params import launch_optuna, resumable
 
 from bbrl.utils.functional import gae
 from bbrl.utils.chrono import Chrono
@@ -50,6 +73,7 @@ import matplotlib.pyplot as plt
 from bbrl_gymnasium.envs.maze_mdp import MazeMDPEnv
 from bbrl_algos.wrappers.env_wrappers import MazeMDPContinuousWrapper
 from bbrl.agents.gymnasium import make_env, ParallelGymAgent, record_video
+from bbrl_algos.models.envs import make_env_agent
 from functools import partial
 
 
@@ -57,25 +81,21 @@ matplotlib.use("TkAgg")
 
 
 def local_get_env_agents(cfg):
-    eval_env_agent = ParallelGymAgent(
-        partial(
-            make_env,
-            cfg.gym_env.env_name,
-            autoreset=False,
-        ),
+    # The episodes are recorded, to be replayed when the run is resumed from a checkpoint
+    wrappers = [ReplayableEnv] if "checkpoint" in cfg.algorithm else []
+    eval_env_agent = make_env_agent(
+        cfg,
         cfg.algorithm.nb_evals,
-        include_last_state=True,
-        seed=cfg.algorithm.seed.eval,
+        cfg.algorithm.seed.eval,
+        autoreset=False,
+        wrappers=wrappers,
     )
-    train_env_agent = ParallelGymAgent(
-        partial(
-            make_env,
-            cfg.gym_env.env_name,
-            autoreset=True,
-        ),
+    train_env_agent = make_env_agent(
+        cfg,
         cfg.algorithm.n_envs,
-        include_last_state=True,
-        seed=cfg.algorithm.seed.train,
+        cfg.algorithm.seed.train,
+        autoreset=True,
+        wrappers=wrappers,
     )
     return train_env_agent, eval_env_agent
 
@@ -139,8 +159,9 @@ def create_dqn_agent(cfg_algo, train_env_agent, eval_env_agent):
     ev_agent = Agents(eval_env_agent, critic)
 
     # Get an agent that is executed on a complete workspace
-    train_agent = TemporalAgent(tr_agent)
-    eval_agent = TemporalAgent(ev_agent)
+    # Neither collection nor evaluation need gradients: the critic is trained on the replay buffer
+    train_agent = make_temporal_agent(tr_agent, requires_grad=False)
+    eval_agent = make_temporal_agent(ev_agent, requires_grad=False)
 
     return train_agent, eval_agent, q_agent, target_q_agent
 
@@ -155,15 +176,9 @@ def setup_optimizer(optimizer_cfg, q_agent):
 
 
 # %%
+@resumable
 def run_dqn(cfg, logger, trial=None):
     best_reward = float("-inf")
-    if cfg.collect_stats:
-        directory = "./dqn_data/"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        filename = directory + "dqn_" + cfg.gym_env.env_name + ".txt"
-        fo = open(filename, "wb")
-        stats_data = []
 
     # 1) Create the environment agent
     train_env_agent, eval_env_agent = local_get_env_agents(cfg)
@@ -186,81 +201,172 @@ def run_dqn(cfg, logger, trial=None):
     tmp_steps_eval = 0
     last_critic_update_step = 0
 
+    explorer = train_agent.agent.get_by_name("action_selector")
+    assert len(explorer) == 1, "There should be only one explorer"
+
+    # 7) Resume the run from its checkpoint, if there is one
+    checkpoint_path = cfg.algorithm.checkpoint if "checkpoint" in cfg.algorithm else None
+    checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path else None
+    if checkpoint_path:
+        # Each checkpoint only writes the transitions put into the buffer since the previous one
+        replay_segments = ReplaySegments(checkpoint_path + ".replay")
+    resumed_episodes = False
+    if checkpoint is not None:
+        q_agent.load_state_dict(checkpoint["q_agent"])
+        target_q_agent.load_state_dict(checkpoint["target_q_agent"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        explorer[0].epsilon = checkpoint["epsilon"]
+        replay_segments.load(rb, checkpoint["replay_segments"])
+        nb_steps = checkpoint["nb_steps"]
+        tmp_steps_eval = checkpoint["tmp_steps_eval"]
+        last_critic_update_step = checkpoint["last_critic_update_step"]
+        best_reward = checkpoint["best_reward"]
+        load_env_agent_state(eval_env_agent, checkpoint["eval_env_agent"])
+        # The current episodes are replayed, and continue from the last step collected
+        if load_env_agent_state(train_env_agent, checkpoint["train_env_agent"]):
+            for key, value in checkpoint["train_workspace"].items():
+                train_workspace.set_full(key, value)
+            resumed_episodes = True
+        set_rng_state(checkpoint["rng"])
+    if cfg.collect_stats:
+        # The rewards of the evaluations, written as they come,
+        # a resumed run keeps the ones up to its checkpoint
+        stats = StatsWriter(
+            "./dqn_data/dqn_" + cfg.gym_env.env_name + ".stats",
+            cfg.algorithm.nb_evals,
+            resume_step=nb_steps if checkpoint is not None else None,
+        )
+    # Unless its episodes were replayed, a resumed run starts new episodes
+    start_steps = -1 if resumed_episodes else nb_steps
+    last_checkpoint_step = nb_steps
+
+    def save_training_state():
+        # What was logged before the checkpoint is written, a resumed run logs from there
+        logger.flush()
+        save_checkpoint(
+            checkpoint_path,
+            {
+                "q_agent": q_agent.state_dict(),
+                "target_q_agent": target_q_agent.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epsilon": explorer[0].epsilon,
+                "replay_segments": replay_segments.save(rb, nb_steps),
+                "train_env_agent": env_agent_state(train_env_agent),
+                "eval_env_agent": env_agent_state(eval_env_agent),
+                "train_workspace": {
+                    key: train_workspace.get_full(key)[-1:]
+                    for key in train_workspace.keys()
+                },
+                "nb_steps": nb_steps,
+                "tmp_steps_eval": tmp_steps_eval,
+                "last_critic_update_step": last_critic_update_step,
+                "best_reward": best_reward,
+                "rng": rng_state(),
+            },
+        )
+        replay_segments.remove_obsolete()
+
+    # Time spent in each phase of the loop, logged at each evaluation
+    timer = PhaseTimer.from_config(cfg, nb_steps)
+
+    # The best agents, written in the background
+    if cfg.save_best:
+        best_agents = CheckpointManager.from_config(
+            cfg, "./dqn_best_agents/", cfg.gym_env.env_name + "dqn"
+        )
+
     while nb_steps < cfg.algorithm.n_steps:
         # Decay the explorer epsilon
-        explorer = train_agent.agent.get_by_name("action_selector")
-        assert len(explorer) == 1, "There should be only one explorer"
         explorer[0].decay()
 
         # Execute the agent in the workspace
-        if nb_steps > 0:
-            train_workspace.zero_grad()
-            train_workspace.copy_n_last_steps(1)
-            train_agent(
-                train_workspace,
-                t=1,
-                n_steps=cfg.algorithm.n_steps_train - 1,
-            )
-        else:
-            train_agent(
-                train_workspace,
-                t=0,
-                n_steps=cfg.algorithm.n_steps_train,
-            )
+        with timer.phase("collect"):
+            if nb_steps > start_steps:
+                train_workspace.copy_n_last_steps(1)
+                train_agent(
+                    train_workspace,
+                    t=1,
+                    n_steps=cfg.algorithm.n_steps_train - 1,
+                )
+            else:
+                train_agent(
+                    train_workspace,
+                    t=0,
+                    n_steps=cfg.algorithm.n_steps_train,
+                )
 
 
-        transition_workspace = train_workspace.get_transitions()
+        with timer.phase("transitions"):
+            transition_workspace = train_workspace.get_transitions()
 
         action = transition_workspace["action"]
         nb_steps += action[0].shape[0]
 
         # Adds the transitions to the workspace
-        rb.put(transition_workspace)
+        with timer.phase("replay_put"):
+            rb.put(transition_workspace)
         if rb.size() > cfg.algorithm.buffer.learning_starts: # tant que le replay buffer n'est pas assez rempli, on continue de collecter des données dedans
             for _ in range(cfg.algorithm.optim_n_updates):
-                rb_workspace = rb.get_shuffled(cfg.algorithm.buffer.batch_size)
-
-                # The q agent needs to be executed on the rb_workspace workspace (gradients are removed in workspace)
-                q_agent(rb_workspace, t=0, n_steps=2, choose_action=False)
-                q_values, terminated, reward, action = rb_workspace[
-                    "critic/q_values", "env/terminated", "env/reward", "action"
-                ]
-
-                with torch.no_grad():
-                    target_q_agent(rb_workspace, t=0, n_steps=2, stochastic=True)
-                target_q_values = rb_workspace["critic/q_values"]
-
-                # Determines whether values of the critic should be propagated
-                must_bootstrap = ~terminated[1]
-
-                # Compute critic loss
-                # FIXME: homogénéiser les notations (soit tranche temporelle, soit rien)
-                critic_loss = compute_critic_loss(
-                    cfg.algorithm.discount_factor, reward, must_bootstrap, action, q_values, target_q_values
-                )
+                with timer.phase("replay_sample"):
+                    rb_workspace = rb.get_shuffled(cfg.algorithm.buffer.batch_size)
+
+                with timer.phase("forward"):
+                    # The q agent needs to be executed on the rb_workspace workspace (gradients are removed in workspace)
+                    q_agent(rb_workspace, t=0, n_steps=2, choose_action=False)
+                    q_values, terminated, reward, action = rb_workspace[
+                        "critic/q_values", "env/terminated", "env/reward", "action"
+                    ]
+
+                    with torch.no_grad():
+                        target_q_agent(rb_workspace, t=0, n_steps=2, stochastic=True)
+                    target_q_values = rb_workspace["critic/q_values"]
+
+                    # Determines whether values of the critic should be propagated
+                    must_bootstrap = ~terminated[1]
+
+                    # Compute critic loss
+                    # FIXME: homogénéiser les notations (soit tranche temporelle, soit rien)
+                    critic_loss = compute_critic_loss(
+                        cfg.algorithm.discount_factor, reward, must_bootstrap, action, q_values, target_q_values
+                    )
                 # Store the loss for tensorboard display
                 logger.add_log("critic_loss", critic_loss, nb_steps)
 
-                optimizer.zero_grad()
-                critic_loss.backward()
-                torch.nn.utils.clip_grad_norm_(q_agent.parameters(), cfg.algorithm.max_grad_norm)
-                optimizer.step()
+                with timer.phase("backward"):
+                    optimizer.zero_grad()
+                    critic_loss.backward()
+                    torch.nn.utils.clip_grad_norm_(q_agent.parameters(), cfg.algorithm.max_grad_norm)
+                with timer.phase("optimizer_step"):
+                    optimizer.step()
+                timer.add_updates()
                 if nb_steps - last_critic_update_step > cfg.algorithm.target_critic_update_interval:
                     last_critic_update_step = nb_steps
-                    target_q_agent.agent = copy.deepcopy(q_agent.agent)
+                    with timer.phase("target_update"):
+                        target_q_agent.agent = copy.deepcopy(q_agent.agent)
 
         # Evaluate the agent
         if nb_steps - tmp_steps_eval > cfg.algorithm.eval_interval:
             tmp_steps_eval = nb_steps
             eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                choose_action=True,
-            )
+            with timer.phase("evaluation"):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    choose_action=True,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             logger.log_reward_losses(rewards, nb_steps)
+            timer.log(logger, nb_steps)
+            if "log_memory" in cfg and cfg.log_memory:
+                log_memory(
+                    logger,
+                    nb_steps,
+                    rb,
+                    {"train": train_workspace, "eval": eval_workspace},
+                    {"q": q_agent, "target_q": target_q_agent},
+                    {"q": optimizer},
+                )
             mean = rewards.mean()
 
             if mean > best_reward:
@@ -275,15 +381,12 @@ def run_dqn(cfg, logger, trial=None):
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
-            if cfg.save_best and best_reward == mean:
-                save_best(
-                    eval_agent,
-                    cfg.gym_env.env_name,
-                    best_reward,
-                    "./dqn_best_agents/",
-                    "dqn",
-                )
-                if cfg.plot_agents:
+            if cfg.save_best:
+                with timer.phase("checkpoint"):
+                    best_agents.save(
+                        mean, nb_steps, {"q_agent": q_agent}, {"optimizer": optimizer}, rb
+                    )
+                if best_reward == mean and cfg.plot_agents:
                     critic = eval_agent.agent.agents[1]
                     plot_discrete_q(
                         critic,
@@ -302,19 +405,32 @@ def run_dqn(cfg, logger, trial=None):
                         input_action=None,
                     )
             if cfg.collect_stats:
-                stats_data.append(mean)
+                stats.write(nb_steps, rewards)
 
             if trial is not None:
                 trial.report(mean, nb_steps)
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
+        if (
+            checkpoint_path
+            and "checkpoint_interval" in cfg.algorithm
+            and nb_steps - last_checkpoint_step >= cfg.algorithm.checkpoint_interval
+        ):
+            last_checkpoint_step = nb_steps
+            with timer.phase("checkpoint"):
+                save_training_state()
+
+    if checkpoint_path:
+        with timer.phase("checkpoint"):
+            save_training_state()
+        timer.log(logger, nb_steps)
+
+    if cfg.save_best:
+        best_agents.close()
+
     if cfg.collect_stats:
-        # All rewards, dimensions (# of evaluations x # of episodes)
-        print(np.shape(stats_data))
-        np.savetxt(filename, stats_data)
-        fo.flush()
-        fo.close()
+        stats.close()
 
     if cfg.visualize:
         env = make_env(cfg.gym_env.env_name, render_mode="rgb_array")
@@ -325,17 +441,170 @@ def run_dqn(cfg, logger, trial=None):
     return best_reward
 
 
+# %%
+def create_dqn_ensemble(cfg_algo, train_env_agent, eval_env_agent):
+    """One critic per seed, the critics are stacked into an Ensemble"""
+    state_dim, action_dim = train_env_agent.get_obs_and_actions_sizes()
+
+    critics = []
+    for index in range(cfg_algo.nb_seeds):
+        # The seeds only differ by the initialization of their critic and their rollouts
+        torch.random.manual_seed(cfg_algo.seed.torch + index)
+        critics.append(
+            DiscreteQAgent(
+                state_dim=state_dim,
+                hidden_layers=list(cfg_algo.architecture.hidden_sizes),
+                action_dim=action_dim,
+            )
+        )
+    q_ensemble = Ensemble(critics)
+    target_q_ensemble = copy.deepcopy(q_ensemble)
+
+    explorer = EGreedyActionSelector(
+        name="action_selector",
+        epsilon=cfg_algo.explorer.epsilon_start,
+        epsilon_end=cfg_algo.explorer.epsilon_end,
+        epsilon_decay=cfg_algo.explorer.decay,
+        seed=cfg_algo.seed.explorer,
+    )
+    critic_agent = EnsembleAgent(q_ensemble, "model", "critic/q_values")
+    policy_agent = EnsembleAgent(q_ensemble, "predict_action", "action", stochastic=False)
+
+    tr_agent = Agents(train_env_agent, critic_agent, explorer)
+    ev_agent = Agents(eval_env_agent, policy_agent)
+    train_agent = make_temporal_agent(tr_agent, requires_grad=False)
+    eval_agent = make_temporal_agent(ev_agent, requires_grad=False)
+
+    return train_agent, eval_agent, q_ensemble, target_q_ensemble
+
+
+# %%
+def run_dqn_multi_seed(cfg):
+    """
+    Trains cfg.algorithm.nb_seeds DQN agents at once, with the torch seeds
+    seed.torch, seed.torch + 1, ... Each seed has its own environments, replay buffer,
+    logger (in log_dir/seed_<i>) and stats file (dqn_data/dqn_<env>_seed<i>.stats)
+    """
+    nb_seeds = cfg.algorithm.nb_seeds
+    loggers = [Logger(member_config(cfg, index)) for index in range(nb_seeds)]
+    stats = None
+    if cfg.collect_stats:
+        stats = MemberStatsWriter(
+            "./dqn_data/",
+            "dqn",
+            cfg.gym_env.env_name,
+            nb_seeds,
+            cfg.algorithm.nb_evals,
+        )
+    best_rewards = torch.full((nb_seeds,), float("-inf"))
+
+    # The seed i plays in the i-th block of n_envs training (nb_evals evaluation) environments
+    train_env_agent, eval_env_agent = local_get_env_agents(ensemble_env_config(cfg))
+    train_agent, eval_agent, q_ensemble, target_q_ensemble = create_dqn_ensemble(
+        cfg.algorithm, train_env_agent, eval_env_agent
+    )
+
+    train_workspace = Workspace()
+    rb = EnsembleReplayBuffer(nb_seeds, cfg.algorithm.buffer.max_size)
+    # A single optimizer over the stacked parameters behaves as one optimizer per seed
+    optimizer = setup_optimizer(cfg.optimizer, q_ensemble)
+
+    # The steps are counted per seed
+    nb_steps = 0
+    tmp_steps_eval = 0
+    last_critic_update_step = 0
+
+    explorer = train_agent.agent.get_by_name("action_selector")[0]
+
+    while nb_steps < cfg.algorithm.n_steps:
+        explorer.decay()
+
+        if nb_steps > 0:
+            train_workspace.copy_n_last_steps(1)
+            train_agent(
+                train_workspace,
+                t=1,
+                n_steps=cfg.algorithm.n_steps_train - 1,
+            )
+        else:
+            train_agent(
+                train_workspace,
+                t=0,
+                n_steps=cfg.algorithm.n_steps_train,
+            )
+
+        nb_steps += rb.put(train_workspace)
+        if rb.size() > cfg.algorithm.buffer.learning_starts:
+            for _ in range(cfg.algorithm.optim_n_updates):
+                # The i-th block of the batch is sampled from the replay buffer of the seed i
+                rb_workspace = rb.get_shuffled(cfg.algorithm.buffer.batch_size)
+                obs, terminated, reward, action = rb_workspace[
+                    "env/env_obs", "env/terminated", "env/reward", "action"
+                ]
+                q_values = q_ensemble.call("model", obs, dim=1)
+                with torch.no_grad():
+                    target_q_values = target_q_ensemble.call("model", obs, dim=1)
+                must_bootstrap = ~terminated
+
+                # The loss of each seed on its own block, their sum is minimized
+                blocks = [
+                    x.chunk(nb_seeds, dim=1)
+                    for x in (reward, must_bootstrap, action, q_values, target_q_values)
+                ]
+                critic_losses = torch.stack(
+                    [
+                        compute_critic_loss(cfg.algorithm.discount_factor, *member_blocks)
+                        for member_blocks in zip(*blocks)
+                    ]
+                )
+                for logger, critic_loss in zip(loggers, critic_losses):
+                    logger.add_log("critic_loss", critic_loss, nb_steps)
+
+                optimizer.zero_grad()
+                critic_losses.sum().backward()
+                clip_grad_norm_per_member(q_ensemble.parameters(), cfg.algorithm.max_grad_norm)
+                optimizer.step()
+                if nb_steps - last_critic_update_step > cfg.algorithm.target_critic_update_interval:
+                    last_critic_update_step = nb_steps
+                    target_q_ensemble.load_state_dict(q_ensemble.state_dict())
+
+        if nb_steps - tmp_steps_eval > cfg.algorithm.eval_interval:
+            tmp_steps_eval = nb_steps
+            eval_workspace = Workspace()
+            eval_agent(eval_workspace, t=0, stop_variable="env/done")
+            rewards = eval_workspace["env/cumulated_reward"][-1].view(nb_seeds, -1)
+            for logger, member_rewards in zip(loggers, rewards):
+                logger.log_reward_losses(member_rewards, nb_steps)
+            means = rewards.mean(dim=1)
+            best_rewards = torch.maximum(best_rewards, means)
+            if stats is not None:
+                stats.write(nb_steps, rewards)
+            print(
+                f"nb_steps: {nb_steps}, reward: {means.mean():.02f} +- {means.std():.02f}, "
+                f"best: {best_rewards.mean():.02f}"
+            )
+
+    if stats is not None:
+        stats.close()
+    for logger in loggers:
+        logger.close()
+    return best_rewards
+
+
 # %%
 @hydra.main(
     config_path="configs/",
     # config_name="dqn_cartpole.yaml",
     config_name="dqn_lunar_lander.yaml",
+    # config_name="dqn_cartpole_hyperband.yaml",
     version_base="1.3")
 def main(cfg_raw: DictConfig):
     torch.random.manual_seed(seed=cfg_raw.algorithm.seed.torch)
 
     if "optuna" in cfg_raw:
         launch_optuna(cfg_raw, run_dqn)
+    elif "nb_seeds" in cfg_raw.algorithm and cfg_raw.algorithm.nb_seeds > 1:
+        run_dqn_multi_seed(cfg_raw)
     else:
         logger = Logger(cfg_raw)
         run_dqn(cfg_raw, logger)
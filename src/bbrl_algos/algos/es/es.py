@@ -0,0 +1,136 @@
+import numpy as np
+from functools import partial
+
+import torch
+import torch.nn as nn
+import hydra
+import optuna
+
+from omegaconf import DictConfig
+
+from bbrl import get_arguments, get_class
+
+from bbrl_algos.models.loggers import Logger
+from bbrl_algos.models.hyper_params import launch_optuna
+from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.envs import get_eval_env_agent, get_population_eval_env_agent
+from bbrl_algos.models.population_eval import PopulationEvaluator
+from bbrl_algos.models.evolution import (
+    NoiseTable,
+    BatchedESEvaluator,
+    ESWorkerPool,
+    es_gradient,
+)
+from bbrl_algos.algos.cem.cem import create_CEM_agent
+
+from bbrl.visu.plot_policies import plot_policy
+
+import matplotlib
+
+matplotlib.use("TkAgg")
+
+
+def run_es(cfg, logger, trial=None):
+    n_pairs = cfg.algorithm.n_pairs
+    sigma = cfg.algorithm.sigma
+
+    eval_env_agent = get_eval_env_agent(cfg)
+    eval_agent = create_CEM_agent(cfg, eval_env_agent)
+    policy = eval_agent.agent.agents[1]
+
+    # The weights of the policy only (the env agent has a dummy parameter)
+    theta = nn.Parameter(
+        torch.nn.utils.parameters_to_vector(policy.parameters()).detach()
+    )
+    dim = len(theta)
+    optimizer_args = get_arguments(cfg.optimizer)
+    optimizer = get_class(cfg.optimizer)([theta], **optimizer_args)
+
+    # The perturbations are read from a noise table shared by all the workers
+    noise_table = NoiseTable(cfg.algorithm.noise_table_size, cfg.algorithm.seed.noise)
+    n_workers = cfg.algorithm.n_workers if "n_workers" in cfg.algorithm else 0
+    if n_workers > 0:
+        evaluator = ESWorkerPool(cfg, policy, noise_table, n_workers)
+    else:
+        population_evaluator = PopulationEvaluator(
+            partial(get_population_eval_env_agent, cfg),
+            policy,
+            cfg.algorithm.nb_evals,
+        )
+        evaluator = BatchedESEvaluator(population_evaluator, noise_table)
+
+    best_score = -np.inf
+    nb_steps = 0
+
+    while nb_steps < cfg.algorithm.n_steps:
+        # Antithetic pairs theta + sigma eps, theta - sigma eps
+        offsets = noise_table.sample_offsets(n_pairs, dim)
+        rewards, steps = evaluator.evaluate(theta.detach(), offsets, sigma)
+        nb_steps += steps.sum().item()
+        logger.add_log("reward", rewards.mean(), nb_steps)
+
+        best_index = rewards.argmax().item()
+        best_reward = rewards.flatten()[best_index]
+        if cfg.verbose:
+            print(
+                f"nb_steps: {nb_steps}, mean reward: {rewards.mean():.2f}, "
+                f"best reward: {best_reward:.2f}"
+            )
+        if cfg.save_best and best_reward > best_score:
+            best_score = best_reward
+            pair, sign = divmod(best_index, 2)
+            perturbation = sigma * noise_table.get(offsets[pair].item(), dim)
+            weights = theta.detach() + (perturbation if sign == 0 else -perturbation)
+            torch.nn.utils.vector_to_parameters(weights, policy.parameters())
+            print(f"nb_steps: {nb_steps}, best score: {best_score:.2f}")
+            save_best(
+                eval_agent,
+                cfg.gym_env.env_name,
+                best_reward,
+                "./es_best_agents/",
+                "es",
+            )
+            if cfg.plot_agents:
+                plot_policy(
+                    eval_agent.agent.agents[1],
+                    eval_env_agent,
+                    best_score,
+                    "./es_plots/",
+                    cfg.gym_env.env_name,
+                    stochastic=False,
+                )
+
+        # Gradient ascent on the rank-shaped returns
+        optimizer.zero_grad()
+        theta.grad = -es_gradient(noise_table, offsets, rewards, dim, sigma)
+        optimizer.step()
+
+        if trial is not None:
+            trial.report(rewards.mean().item(), nb_steps)
+            if trial.should_prune():
+                evaluator.close()
+                raise optuna.TrialPruned()
+
+    evaluator.close()
+    return best_score
+
+
+# %%
+@hydra.main(
+    config_path="./configs/",
+    config_name="es_cartpole.yaml",
+    # config_name="es_swimmer.yaml",
+    # version_base="1.3",
+)
+def main(cfg_raw: DictConfig):
+    torch.random.manual_seed(seed=cfg_raw.algorithm.seed.torch)
+
+    if "optuna" in cfg_raw:
+        launch_optuna(cfg_raw, run_es)
+    else:
+        logger = Logger(cfg_raw)
+        run_es(cfg_raw, logger)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,13 @@
 """
-This version of PPO works, but it incorrectly samples minibatches randomly from the rollouts
-without making sure that each sample is used once and only once
+This version of PPO stores each rollout into a RolloutBuffer, and every optimization epoch
+goes through all the transitions of the rollout once, in random minibatches
 See: https://iclr-blog-track.github.io/2022/03/25/ppo-implementation-details/
 for a full description of all the coding tricks that should be integrated
 """
 
 import sys
 import os
-import copy
+import math
 
 import torch
 import torch.nn as nn
@@ -21,8 +21,6 @@ from omegaconf import DictConfig
 
 from bbrl import get_arguments, get_class
 
-from bbrl.utils.functional import gae
-
 from bbrl_algos.models.loggers import Logger
 from bbrl.utils.chrono import Chrono
 
@@ -41,7 +39,29 @@ from bbrl.agents import Agents, TemporalAgent, PrintAgent
 # At timestep t>0, these agents will read the ’action’ variable in the workspace at time t − 1
 from bbrl_algos.models.envs import get_env_agents
 from bbrl_algos.models.hyper_params import launch_optuna
+from bbrl_algos.models.instrumentation import PhaseTimer
+from bbrl_algos.models.distributed import (
+    launch_distributed,
+    get_world_size,
+    is_main_process,
+    broadcast_parameters,
+    all_reduce_gradients,
+    min_over_ranks,
+    sum_over_ranks,
+)
+from bbrl_algos.models.ensemble import (
+    Ensemble,
+    EnsembleAgent,
+    clip_grad_norm_per_member,
+    ensemble_env_config,
+    member_config,
+    member_mean,
+    MemberStatsWriter,
+    split_members,
+)
 from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.returns import gae_advantages
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
 
 # Neural network models for actors and critics
 from bbrl_algos.models.stochastic_actors import (
@@ -80,23 +100,15 @@ def create_ppo_agent(cfg, train_env_agent, eval_env_agent):
     ev_agent = Agents(eval_env_agent, policy)
 
     critic_agent = VAgent(obs_size, cfg.algorithm.architecture.critic_hidden_size)
-    old_critic_agent = copy.deepcopy(critic_agent).set_name("old_critic")
-
-    all_critics = TemporalAgent(Agents(critic_agent, old_critic_agent))
 
     train_agent = TemporalAgent(tr_agent)
     eval_agent = TemporalAgent(ev_agent)
 
-    old_policy = copy.deepcopy(policy)
-    old_policy.set_name("old_policy")
-
     return (
         train_agent,
         eval_agent,
         critic_agent,
-        all_critics,
         policy,
-        old_policy,
     )
 
 
@@ -107,20 +119,26 @@ def setup_optimizer(cfg, actor, critic):
     return optimizer
 
 
-def compute_advantage(cfg, reward, must_bootstrap, v_value):
-    # Compute temporal difference with GAE
-    advantage = gae(
+def compute_advantage(cfg, rollout_buffer, v_value):
+    # Compute temporal difference with GAE over the whole rollout,
+    # the advantages and the returns are written into the rollout buffer
+    advantage, _ = gae_advantages(
         v_value,
-        reward,
-        must_bootstrap,
+        rollout_buffer.reward,
+        rollout_buffer.terminated,
+        rollout_buffer.done,
         cfg.algorithm.discount_factor,
         cfg.algorithm.gae,
+        advantages=rollout_buffer.advantage,
+        returns=rollout_buffer.returns,
+        compiled="compile_gae" in cfg.algorithm and cfg.algorithm.compile_gae,
     )
     return advantage
 
 
-def compute_critic_loss(advantage):
-    td_error = advantage**2
+def compute_critic_loss(v_value, returns, valid):
+    # The critic regresses onto the returns, not through the GAE recursion
+    td_error = (v_value - returns.detach())[valid] ** 2
     critic_loss = td_error.mean()
     return critic_loss
 
@@ -137,6 +155,7 @@ def compute_clip_policy_loss(cfg, advantage, ratio):
 
 def run_ppo_clip(cfg, logger, trial=None):
     best_reward = float("-inf")
+    mean = float("-inf")
     nb_steps = 0
     tmp_steps = 0
 
@@ -146,18 +165,19 @@ def run_ppo_clip(cfg, logger, trial=None):
         train_agent,
         eval_agent,
         critic_agent,
-        all_critics,
         policy,
-        old_policy_params,
     ) = create_ppo_agent(cfg, train_env_agent, eval_env_agent)
 
-    # The old_policy params must be wrapped into a TemporalAgent
-    old_policy = TemporalAgent(old_policy_params)
-
     train_workspace = Workspace()
+    rollout_buffer = RolloutBuffer()
 
     # Configure the optimizer
     optimizer = setup_optimizer(cfg, train_agent, critic_agent)
+    # In data-parallel training, all the ranks start from the parameters of the rank 0
+    broadcast_parameters(optimizer)
+
+    # Time spent in each phase of the loop, logged at each evaluation
+    timer = PhaseTimer.from_config(cfg)
 
     # Training loop
     while nb_steps < cfg.algorithm.n_steps:
@@ -166,154 +186,130 @@ def run_ppo_clip(cfg, logger, trial=None):
         # Handles continuation
         delta_t = 0
         if nb_steps > 0:
-            train_workspace.zero_grad()
             delta_t = 1
             train_workspace.copy_n_last_steps(1)
 
-        # Run the current policy and evaluate the proba of its action according to the old policy
-        # The old_policy can be run after the train_agent on the same workspace
-        # because it writes a logprob_predict and not an action.
-        # That is, it does not determine the action of the old_policy,
-        # it just determines the proba of the action of the current policy given its own probabilities
-
-        with torch.no_grad():
+        # Run the current policy
+        with timer.phase("collect"), torch.no_grad():
             train_agent(
                 train_workspace,
                 t=delta_t,
-                n_steps=cfg.algorithm.n_steps_train,
+                n_steps=cfg.algorithm.n_steps_train - delta_t,
                 stochastic=True,
                 predict_proba=False,
                 compute_entropy=False,
             )
-            old_policy(
-                train_workspace,
-                t=delta_t,
-                n_steps=cfg.algorithm.n_steps_train,
-                # Just computes the probability of the old policy's action
-                # to get the ratio of probabilities
-                predict_proba=True,
-                compute_entropy=False,
-            )
 
-        # Compute the critic value over the whole workspace
-        all_critics(train_workspace, t=delta_t, n_steps=cfg.algorithm.n_steps_train)
-
-        transition_workspace = train_workspace.get_transitions()
-
-        terminated, reward, action, v_value, old_v_value = transition_workspace[
-            "env/terminated",
-            "env/reward",
-            "action",
-            "critic/v_values",
-            "old_critic/v_values",
-        ]
-        nb_steps += action[0].shape[0]
-
-        # Determines whether values of the critic should be propagated
-        must_bootstrap = ~terminated[1]
+        # Copy the rollout into the preallocated buffer
+        with timer.phase("transitions"):
+            rollout_buffer.store(train_workspace)
+        nb_steps += sum_over_ranks(rollout_buffer.nb_transitions())
+
+        with timer.phase("forward"):
+            # Compute the critic value over the whole rollout
+            v_value = critic_agent.predict_value(rollout_buffer.obs)
+
+            # Cache the log probabilities of the actions and the values once per rollout:
+            # the policy and the critic have not been updated since they collected the rollout,
+            # so they are the old ones of the optimization epochs
+            with torch.no_grad():
+                old_action_logp, _ = policy.evaluate_actions(
+                    rollout_buffer.obs, rollout_buffer.action
+                )
+            rollout_buffer.cache_policy_outputs(old_action_logp, v_value.detach())
 
-        # the critic values are clamped to move not too far away from the values of the previous critic
+            # then we compute the advantage and the returns using the cached critic values
+            compute_advantage(cfg, rollout_buffer, v_value)
 
-        if cfg.algorithm.clip_range_vf > 0:
-            # Clip the difference between old and new values
-            # NOTE: this depends on the reward scaling
-            v_value = old_v_value + torch.clamp(
-                v_value - old_v_value,
-                -cfg.algorithm.clip_range_vf,
-                cfg.algorithm.clip_range_vf,
+            critic_loss = compute_critic_loss(
+                v_value, rollout_buffer.returns, rollout_buffer.valid
             )
+            loss_critic = cfg.algorithm.critic_coef * critic_loss
 
-        # then we compute the advantage using the clamped critic values
-        advantage = compute_advantage(cfg, reward, must_bootstrap, v_value)
-
-        # We store the advantage into the transition_workspace
-        transition_workspace.set("advantage", 1, advantage[0])
-
-        critic_loss = compute_critic_loss(advantage)
-        loss_critic = cfg.algorithm.critic_coef * critic_loss
-
-        optimizer.zero_grad()
-        loss_critic.backward()
-        torch.nn.utils.clip_grad_norm_(
-            critic_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
-        optimizer.step()
+        with timer.phase("backward"):
+            optimizer.zero_grad()
+            loss_critic.backward()
+            all_reduce_gradients(optimizer)
+            torch.nn.utils.clip_grad_norm_(
+                critic_agent.parameters(), cfg.algorithm.max_grad_norm
+            )
+        with timer.phase("optimizer_step"):
+            optimizer.step()
+        timer.add_updates()
+
+        # In data-parallel training, all the ranks must perform the same number of updates,
+        # whatever their number of valid transitions, and none of them may get an empty
+        # minibatch: there are at most as many minibatches as valid transitions on any rank
+        nb_batches = None
+        if get_world_size() > 1:
+            nb_batches = min(
+                math.ceil(rollout_buffer.valid[:-1].numel() / cfg.algorithm.batch_size),
+                min_over_ranks(rollout_buffer.nb_transitions()),
+            )
 
         # We start several optimization epochs on mini_batches
         for opt_epoch in range(cfg.algorithm.opt_epochs):
-            if cfg.algorithm.batch_size > 0:
-                sample_workspace = transition_workspace.select_batch_n(
-                    cfg.algorithm.batch_size
-                )
-            else:
-                sample_workspace = transition_workspace
-
-            # Compute the probability of the played actions according to the current policy
-            # We do not replay the action: we use the one stored into the dataset
-            # Hence predict_proba=True
-            # Note that the policy is not wrapped into a TemporalAgent, but we use a single step
-
-            policy(
-                sample_workspace,
-                t=0,
-                compute_entropy=True,
-                predict_proba=True,
-            )
-
-            # The logprob_predict Tensor has been computed from the old_policy outside the loop
-            advantage, action_logp, old_action_logp, entropy = sample_workspace[
-                "advantage",
-                "current_policy/logprob_predict",
-                "old_policy/logprob_predict",
-                "entropy",
-            ]
-
-            # Compute the ratio of action probabilities
-            act_diff = action_logp[0] - old_action_logp[0].detach()
-            ratios = act_diff.exp()
+            for indices in rollout_buffer.minibatches(
+                cfg.algorithm.batch_size, nb_batches=nb_batches
+            ):
+                with timer.phase("minibatch"):
+                    obs, action, old_action_logp, policy_advantage = rollout_buffer.get(
+                        indices, "obs", "action", "logprob", "advantage"
+                    )
 
-            # Compute the policy loss
-            # (using compute_clip_policy_loss)
-            policy_advantage = advantage.detach()[1]
-            policy_loss = compute_clip_policy_loss(cfg, policy_advantage, ratios)
+                with timer.phase("forward"):
+                    # Compute the probability of the played actions according to the current policy
+                    # We do not replay the action: we use the one stored into the buffer
+                    action_logp, entropy = policy.evaluate_actions(
+                        obs, action, compute_entropy=True
+                    )
 
-            loss_policy = -cfg.algorithm.policy_coef * policy_loss
+                    # Compute the ratio of action probabilities
+                    ratios = (action_logp - old_action_logp).exp()
 
-            # Entropy loss favors exploration
-            assert len(entropy) == 1, f"{entropy.shape}"
-            entropy_loss = entropy[0].mean()
-            loss_entropy = -cfg.algorithm.entropy_coef * entropy_loss
+                    # Compute the policy loss
+                    policy_loss = compute_clip_policy_loss(
+                        cfg, policy_advantage, ratios
+                    )
+                    loss_policy = -cfg.algorithm.policy_coef * policy_loss
 
-            # Store the losses for tensorboard display
-            logger.log_losses(critic_loss, entropy_loss, policy_loss, nb_steps)
-            logger.add_log("advantage", policy_advantage.mean(), nb_steps)
+                    # Entropy loss favors exploration
+                    entropy_loss = entropy.mean()
+                    loss_entropy = -cfg.algorithm.entropy_coef * entropy_loss
 
-            loss = loss_policy + loss_entropy
+                # Store the losses for tensorboard display
+                logger.log_losses(critic_loss, entropy_loss, policy_loss, nb_steps)
+                logger.add_log("advantage", policy_advantage.mean(), nb_steps)
 
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(
-                policy.parameters(), cfg.algorithm.max_grad_norm
-            )
-            optimizer.step()
+                loss = loss_policy + loss_entropy
 
-        old_policy_params.copy_parameters(policy)
-        all_critics.agent.agents[1] = copy.deepcopy(critic_agent).set_name("old_critic")
+                with timer.phase("backward"):
+                    optimizer.zero_grad()
+                    loss.backward()
+                    all_reduce_gradients(optimizer)
+                    torch.nn.utils.clip_grad_norm_(
+                        policy.parameters(), cfg.algorithm.max_grad_norm
+                    )
+                with timer.phase("optimizer_step"):
+                    optimizer.step()
+                timer.add_updates()
 
         # Evaluate if enough steps have been performed
-        if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
+        if nb_steps - tmp_steps > cfg.algorithm.eval_interval and is_main_process():
             tmp_steps = nb_steps
             eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                stochastic=True,
-                predict_proba=False,
-            )
+            with timer.phase("evaluation"):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    stochastic=True,
+                    predict_proba=False,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
             logger.log_reward_losses(rewards, nb_steps)
+            timer.log(logger, nb_steps)
             print(
                 f"nb_steps: {nb_steps}, reward: {mean:.3f}, best_reward: {best_reward:.3f}"
             )
@@ -349,6 +345,185 @@ def run_ppo_clip(cfg, logger, trial=None):
     return mean
 
 
+def create_ppo_ensemble(cfg, train_env_agent, eval_env_agent):
+    """One policy and one critic per seed, stacked into two Ensembles"""
+    obs_size, act_size = train_env_agent.get_obs_and_actions_sizes()
+    policies, critics = [], []
+    for index in range(cfg.algorithm.nb_seeds):
+        # The seeds only differ by the initialization of their networks and their rollouts
+        torch.random.manual_seed(cfg.algorithm.seed.torch + index)
+        policies.append(
+            globals()[cfg.algorithm.policy_type](
+                obs_size,
+                cfg.algorithm.architecture.policy_hidden_size,
+                act_size,
+                name="current_policy",
+            )
+        )
+        critics.append(VAgent(obs_size, cfg.algorithm.architecture.critic_hidden_size))
+    policy = Ensemble(policies)
+    critic = Ensemble(critics)
+
+    policy_agent = EnsembleAgent(policy, "predict_action", "action", stochastic=True)
+    train_agent = TemporalAgent(Agents(train_env_agent, policy_agent))
+    eval_agent = TemporalAgent(Agents(eval_env_agent, policy_agent))
+    return train_agent, eval_agent, critic, policy
+
+
+def run_ppo_clip_multi_seed(cfg):
+    """
+    Trains cfg.algorithm.nb_seeds PPO agents at once, with the torch seeds
+    seed.torch, seed.torch + 1, ... Each seed has its own environments,
+    logger (in log_dir/seed_<i>) and stats file (ppo_data/ppo_<env>_seed<i>.stats)
+    """
+    nb_seeds = cfg.algorithm.nb_seeds
+    loggers = [Logger(member_config(cfg, index)) for index in range(nb_seeds)]
+    stats = None
+    if "collect_stats" in cfg and cfg.collect_stats:
+        stats = MemberStatsWriter(
+            "./ppo_data/",
+            "ppo",
+            cfg.gym_env.env_name,
+            nb_seeds,
+            cfg.algorithm.nb_evals,
+        )
+    best_rewards = torch.full((nb_seeds,), float("-inf"))
+    # The steps are counted per seed
+    nb_steps = 0
+    tmp_steps = 0
+
+    # The seed i plays in the i-th block of n_envs training (nb_evals evaluation) environments
+    train_env_agent, eval_env_agent = get_env_agents(ensemble_env_config(cfg))
+    train_agent, eval_agent, critic, policy = create_ppo_ensemble(
+        cfg, train_env_agent, eval_env_agent
+    )
+
+    train_workspace = Workspace()
+    rollout_buffer = RolloutBuffer()
+    # A single optimizer over the stacked parameters behaves as one optimizer per seed
+    optimizer = setup_optimizer(cfg, policy, critic)
+
+    while nb_steps < cfg.algorithm.n_steps:
+        delta_t = 0
+        if nb_steps > 0:
+            delta_t = 1
+            train_workspace.copy_n_last_steps(1)
+
+        with torch.no_grad():
+            train_agent(
+                train_workspace,
+                t=delta_t,
+                n_steps=cfg.algorithm.n_steps_train - delta_t,
+            )
+
+        # The columns of the rollout are the n_envs environments of each seed in turn
+        rollout_buffer.store(train_workspace)
+        nb_steps += rollout_buffer.nb_transitions() // nb_seeds
+
+        v_value = critic.call("predict_value", rollout_buffer.obs, dim=1)
+        with torch.no_grad():
+            old_params = policy.call(
+                "get_distribution_params", rollout_buffer.obs, dim=1
+            )
+            old_action_logp = policy.call(
+                "log_prob_from_params", old_params, rollout_buffer.action, dim=1
+            )
+        rollout_buffer.cache_policy_outputs(old_action_logp, v_value.detach())
+
+        # GAE is computed column by column, the seeds do not interact
+        compute_advantage(cfg, rollout_buffer, v_value)
+
+        critic_losses = member_mean(
+            split_members((v_value - rollout_buffer.returns) ** 2, nb_seeds, dim=1),
+            split_members(rollout_buffer.valid, nb_seeds, dim=1),
+        )
+        optimizer.zero_grad()
+        (cfg.algorithm.critic_coef * critic_losses.sum()).backward()
+        clip_grad_norm_per_member(critic.parameters(), cfg.algorithm.max_grad_norm)
+        optimizer.step()
+
+        # The transitions of each seed, as (nb_seeds x (n_steps_train x n_envs)) tensors
+        obs, action, old_logp, policy_advantage, valid = [
+            split_members(x, nb_seeds, dim=1).flatten(1, 2)
+            for x in (
+                rollout_buffer.obs,
+                rollout_buffer.action,
+                rollout_buffer.logprob,
+                rollout_buffer.advantage,
+                rollout_buffer.valid,
+            )
+        ]
+        nb_batches = max(1, math.ceil(valid.size(1) / cfg.algorithm.batch_size))
+        members = torch.arange(nb_seeds).unsqueeze(-1)
+
+        for opt_epoch in range(cfg.algorithm.opt_epochs):
+            # Each seed draws its own minibatches, in which its invalid transitions are masked
+            permutations = torch.rand(valid.shape).argsort(dim=1)
+            for indices in permutations.tensor_split(nb_batches, dim=1):
+                batch_valid = valid[members, indices]
+                batch_advantage = policy_advantage[members, indices]
+                params = policy.call_stacked(
+                    "get_distribution_params", obs[members, indices]
+                )
+                action_logp = policy.call_stacked(
+                    "log_prob_from_params", params, action[members, indices]
+                )
+                entropy = policy.call_stacked("entropy_from_params", params)
+
+                ratios = (action_logp - old_logp[members, indices]).exp()
+                clip_range = cfg.algorithm.clip_range
+                policy_losses = member_mean(
+                    torch.minimum(
+                        batch_advantage * ratios,
+                        batch_advantage
+                        * torch.clamp(ratios, 1 - clip_range, 1 + clip_range),
+                    ),
+                    batch_valid,
+                )
+                entropy_losses = member_mean(entropy, batch_valid)
+
+                for index, logger in enumerate(loggers):
+                    logger.log_losses(
+                        critic_losses[index],
+                        entropy_losses[index],
+                        policy_losses[index],
+                        nb_steps,
+                    )
+
+                loss = (
+                    -cfg.algorithm.policy_coef * policy_losses
+                    - cfg.algorithm.entropy_coef * entropy_losses
+                ).sum()
+                optimizer.zero_grad()
+                loss.backward()
+                clip_grad_norm_per_member(
+                    policy.parameters(), cfg.algorithm.max_grad_norm
+                )
+                optimizer.step()
+
+        if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
+            tmp_steps = nb_steps
+            eval_workspace = Workspace()
+            eval_agent(eval_workspace, t=0, stop_variable="env/done")
+            rewards = eval_workspace["env/cumulated_reward"][-1].view(nb_seeds, -1)
+            for logger, member_rewards in zip(loggers, rewards):
+                logger.log_reward_losses(member_rewards, nb_steps)
+            means = rewards.mean(dim=1)
+            best_rewards = torch.maximum(best_rewards, means)
+            if stats is not None:
+                stats.write(nb_steps, rewards)
+            print(
+                f"nb_steps: {nb_steps}, reward: {means.mean():.3f} +- {means.std():.3f}, "
+                f"best_reward: {best_rewards.mean():.3f}"
+            )
+
+    if stats is not None:
+        stats.close()
+    for logger in loggers:
+        logger.close()
+    return best_rewards
+
+
 @hydra.main(
     config_path="./configs/",
     # config_name="ppo_lunarlander_continuous.yaml",
@@ -365,6 +540,10 @@ def main(cfg_raw: DictConfig):
 
     if "optuna" in cfg_raw:
         launch_optuna(cfg_raw, run_ppo_clip)
+    elif "n_processes" in cfg_raw.algorithm and cfg_raw.algorithm.n_processes > 1:
+        launch_distributed(cfg_raw, run_ppo_clip)
+    elif "nb_seeds" in cfg_raw.algorithm and cfg_raw.algorithm.nb_seeds > 1:
+        run_ppo_clip_multi_seed(cfg_raw)
     else:
         logger = Logger(cfg_raw)
         run_ppo_clip(cfg_raw, logger)
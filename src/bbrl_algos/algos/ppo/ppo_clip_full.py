@@ -7,7 +7,6 @@ for a full description of all the coding tricks that should be integrated
 
 import sys
 import os
-import copy
 
 import torch
 import torch.nn as nn
@@ -18,10 +17,7 @@ from omegaconf import DictConfig
 
 from bbrl import get_arguments, get_class
 
-from bbrl.utils.functional import gae
-from bbrl.utils.replay_buffer import ReplayBuffer
-
-from bbrl_algos.models.loggers import MyLogger, Logger
+from bbrl_algos.models.loggers import Logger
 from bbrl.utils.chrono import Chrono
 
 # The workspace is the main class in BBRL, this is where all data is collected and stored
@@ -37,7 +33,9 @@ from bbrl.agents import Agents, TemporalAgent, PrintAgent
 # ’env/env_obs’, ’env/reward’, ’env/timestep’, ’env/done’, ’env/initial_state’, ’env/cumulated_reward’,
 # ... When called at timestep t=0, then the environments are automatically reset.
 # At timestep t>0, these agents will read the ’action’ variable in the workspace at time t − 1
-from bbrl_algos.models.envs import create_env_agents
+from bbrl_algos.models.envs import get_env_agents
+from bbrl_algos.models.returns import gae_advantages
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
 
 # Neural network models for actors and critics
 from bbrl_algos.models.stochastic_actors import (
@@ -77,16 +75,12 @@ def create_ppo_agent(cfg, train_env_agent, eval_env_agent):
     critic_agent = TemporalAgent(
         VAgent(obs_size, cfg.algorithm.architecture.critic_hidden_size)
     )
-    old_critic_agent = copy.deepcopy(critic_agent)
 
     train_agent = TemporalAgent(tr_agent)
     eval_agent = TemporalAgent(ev_agent)
     train_agent.seed(cfg.algorithm.seed)
 
-    old_policy = copy.deepcopy(policy)
-    old_policy.setname("old_policy")
-
-    return train_agent, eval_agent, critic_agent, old_policy, old_critic_agent
+    return train_agent, eval_agent, critic_agent
 
 
 def setup_optimizer(cfg, actor, critic):
@@ -96,14 +90,19 @@ def setup_optimizer(cfg, actor, critic):
     return optimizer
 
 
-def compute_advantage(cfg, reward, must_bootstrap, v_value):
-    # Compute temporal difference with GAE
-    advantage = gae(
+def compute_advantage(cfg, rollout_buffer, v_value):
+    # Compute temporal difference with GAE over the whole rollout,
+    # the advantages and the returns are written into the rollout buffer
+    advantage, _ = gae_advantages(
         v_value,
-        reward,
-        must_bootstrap,
+        rollout_buffer.reward,
+        rollout_buffer.terminated,
+        rollout_buffer.done,
         cfg.algorithm.discount_factor,
         cfg.algorithm.gae,
+        advantages=rollout_buffer.advantage,
+        returns=rollout_buffer.returns,
+        compiled="compile_gae" in cfg.algorithm and cfg.algorithm.compile_gae,
     )
     return advantage
 
@@ -124,196 +123,100 @@ def compute_clip_actor_loss(cfg, advantage, ratio):
     return actor_loss
 
 
+def collect_rollout(cfg, train_agent, train_workspace, rollout_buffer, epoch):
+    """
+    Runs the current policy for n_steps_train steps, continuing the rollout of the
+    previous epoch, and copies them into the rollout buffer
+    """
+    # Handles continuation: the last step of the previous rollout is the first one
+    delta_t = 0
+    if epoch > 0:
+        delta_t = 1
+        train_workspace.copy_n_last_steps(1)
+
+    with torch.no_grad():
+        train_agent(
+            train_workspace,
+            t=delta_t,
+            n_steps=cfg.algorithm.n_steps_train - delta_t,
+            stochastic=True,
+            predict_proba=False,
+            compute_entropy=False,
+        )
+
+    # Copy the rollout into the preallocated buffer
+    rollout_buffer.store(train_workspace)
+
+
 def run_ppo_clip(cfg, logger, trial=None):
     best_reward = float("-inf")
     nb_steps = 0
     tmp_steps = 0
 
-    train_env_agent, eval_env_agent = create_env_agents(cfg)
+    train_env_agent, eval_env_agent = get_env_agents(cfg)
     (
         train_agent,
         eval_agent,
         critic_agent,
-        old_policy,
-        old_critic_agent,
     ) = create_ppo_agent(cfg, train_env_agent, eval_env_agent)
 
     # We can call the policy instead of a temporal agent because we run on transitions,
     # so we just need one step
     policy = train_agent.agent.agents[1]
-    # This is not true of the old_policy, because it works on the train_workspace
-    old_actor = TemporalAgent(old_policy)
 
     train_workspace = Workspace()
 
     # Configure the optimizer
     optimizer = setup_optimizer(cfg, train_agent, critic_agent)
-    if cfg.algorithm.opt_epochs > 0:
-        batch_size = int(cfg.algorithm.n_steps / cfg.algorithm.opt_epochs)
+    rollout_buffer = RolloutBuffer()
 
     # Training loop
     for epoch in range(cfg.algorithm.max_epochs):
         # Execute the training agent in the workspace
+        collect_rollout(cfg, train_agent, train_workspace, rollout_buffer, epoch)
 
-        # Handles continuation
-        delta_t = 0
-        if epoch > 0:
-            train_workspace.zero_grad()
-            delta_t = 1
-            train_workspace.copy_n_last_steps(1)
-
-        # Run the current actor and evaluate the proba of its action according to the old actor
-        # The old_actor can be run after the train_agent on the same workspace
-        # because it writes a logprob_predict and not an action.
-        # That is, it does not determine the action of the old_actor,
-        # it just determines the proba of the action of the current actor given its own probabilities
-
-        with torch.no_grad():
-            train_agent(
-                train_workspace,
-                t=delta_t,
-                n_steps=cfg.algorithm.n_steps,
-                stochastic=True,
-                predict_proba=False,
-                compute_entropy=False,
-            )
-            old_actor(
-                train_workspace,
-                t=delta_t,
-                n_steps=cfg.algorithm.n_steps,
-                # Just computes the probability of the current actor's action
-                # to get the ratio of probabilities
-                predict_proba=True,
-                compute_entropy=False,
-            )
-
-        # Compute the critic value over the whole workspace
-        critic_agent(train_workspace, t=delta_t, n_steps=cfg.algorithm.n_steps)
-
-        terminated, reward, action, v_value = train_workspace[
-            "env/terminated",
-            "env/reward",
-            "action",
-            "critic/v_values",
-        ]
-
-        # Determines whether values of the critic should be propagated
-        # True if the task was not terminated
-        must_bootstrap = ~terminated
-
-        # the critic values are clamped to move not too far away from the values of the previous critic
-
+        # Cache the log probabilities of the actions and the values once per rollout:
+        # the actor and the critic have not been updated since they collected the rollout,
+        # so they are the old ones of the optimization epochs
+        critic = critic_agent.agent
         with torch.no_grad():
-            old_critic_agent(train_workspace, n_steps=cfg.algorithm.n_steps)
-        old_v_value = train_workspace["critic/v_values"]
-        if cfg.algorithm.clip_range_vf > 0:
-            # Clip the difference between old and new values
-            # NOTE: this depends on the reward scaling
-            v_value = old_v_value + torch.clamp(
-                v_value - old_v_value,
-                -cfg.algorithm.clip_range_vf,
-                cfg.algorithm.clip_range_vf,
+            old_action_logp, _ = policy.evaluate_actions(
+                rollout_buffer.obs, rollout_buffer.action
             )
+            v_value = critic.predict_value(rollout_buffer.obs)
+        rollout_buffer.cache_policy_outputs(old_action_logp, v_value)
 
-        # then we compute the advantage using the clamped critic values
-
-        # NB: I had to add must_bootstrap[1:], otherwise the sizes are not correct
-        # A weakness of this code is that the advantage tensor is one step shorter than the other variables
-        # so it needs to be completed with a 0
-
-        advantage = compute_advantage(cfg, reward, must_bootstrap[1:], v_value)
-        last_bit = torch.Tensor([[0]])
-        advantage = torch.cat((advantage, last_bit), 0)
-        print("adv rollout", advantage)
-
-        # We store the advantage into the transition_workspace
-        train_workspace.set_full("advantage", advantage)
-
-        # We rename logprob_predict data into old_action_logprobs
-        # We do so because we will rewrite in the logprob_predict variable in mini_batches
-        train_workspace.set_full(
-            "old_action_logprobs", train_workspace["logprob_predict"].detach()
-        )
-
-        train_workspace.clear("logprob_predict")
-
-        rb = ReplayBuffer(train_workspace.batch_size())
-        rb.put(train_workspace)
-        shuffled = rb.get_shuffled(rb.max_size)
-
-        print_content(shuffled)
+        # then we compute the advantage and the returns using the cached critic values
+        # the advantage tensor has the same length as the other variables, its last step is 0
+        compute_advantage(cfg, rollout_buffer, v_value)
 
         # We start several optimization epochs on mini_batches
-        for opt_epoch in range(max(cfg.algorithm.opt_epochs, 1)):
-            if cfg.algorithm.opt_epochs > 0:
-                from_time = opt_epoch * batch_size
-                to_time = (opt_epoch + 1) * batch_size
-
-                print(
-                    f"************************************************************** [{from_time}, {to_time}["
-                )
-                # The +1 is necessary because we need the next step in the transitions
-                # sample_workspace = train_workspace.get_time_truncated_workspace(
-                sample_workspace = shuffled.subtime(from_time, to_time + 1)
-                print("sample workspace:")
-                print_ag = TemporalAgent(PrintAgent("env/timestep", "advantage"))
-                print_ag(
-                    sample_workspace,
-                    t=0,
-                    n_steps=min(to_time + 1, cfg.algorithm.n_steps) - from_time,
-                )
-            else:
-                sample_workspace = shuffled
+        # The rollout is split into opt_epochs minibatches, each transition is used once
+        nb_minibatches = max(cfg.algorithm.opt_epochs, 1)
+        batch_size = -(-rollout_buffer.nb_transitions() // nb_minibatches)
+        for indices in rollout_buffer.minibatches(batch_size):
+            obs, action, old_action_logp, advantage, returns = rollout_buffer.get(
+                indices, "obs", "action", "logprob", "advantage", "returns"
+            )
+            nb_steps += len(indices)
 
             # Compute the probability of the played actions according to the current policy
-            # We do not replay the action: we use the one stored into the dataset
-            # Hence predict_proba=True
-            #
-            policy(
-                sample_workspace,
-                t=0,
-                n_steps=1,
-                compute_entropy=True,
-                predict_proba=True,
+            # We do not replay the action: we use the one stored into the buffer
+            action_logp, entropy = policy.evaluate_actions(
+                obs, action, compute_entropy=True
             )
-            print("sample workspace 2:")
-            print_agent = TemporalAgent(PrintAgent("env/timestep", "advantage"))
-            print_agent(
-                sample_workspace,
-                t=0,
-                n_steps=1,
-            )
-            # The old_action_logprobs Tensor has been computed from the old_policy outside the loop
-            (
-                action,
-                advantage,
-                action_logp,
-                old_action_logp,
-                entropy,
-            ) = sample_workspace[
-                "action",
-                "advantage",
-                "logprob_predict",
-                "old_action_logprobs",
-                "entropy",
-            ]
-            nb_steps += action[0].shape[0]
-
-            print("advantage full", advantage)
-            print("advantage [0]", advantage[0])
-            critic_loss = compute_critic_loss(advantage[0])
-            # critic_loss = action_logp[0][0]
+
+            # The critic is trained to predict the returns of the rollout
+            critic_loss = compute_critic_loss(critic.predict_value(obs) - returns)
             loss_critic = cfg.algorithm.critic_coef * critic_loss
 
-            act_diff = action_logp[0] - old_action_logp[0].detach()
-            ratios = act_diff.exp()
+            ratios = (action_logp - old_action_logp).exp()
 
-            actor_advantage = advantage.detach().squeeze(0)[0]
-            actor_loss = compute_clip_actor_loss(cfg, actor_advantage, ratios)
+            actor_loss = compute_clip_actor_loss(cfg, advantage, ratios)
             loss_actor = -cfg.algorithm.actor_coef * actor_loss
 
             # Entropy loss favors exploration
-            entropy_loss = entropy[0].mean()
+            entropy_loss = entropy.mean()
             loss_entropy = -cfg.algorithm.entropy_coef * entropy_loss
 
             # Store the losses for tensorboard display
@@ -322,7 +225,6 @@ def run_ppo_clip(cfg, logger, trial=None):
 
             loss = loss_actor + loss_entropy
 
-            torch.autograd.set_detect_anomaly(True)
             optimizer.zero_grad()
             loss_critic.backward()
             torch.nn.utils.clip_grad_norm_(
@@ -334,9 +236,6 @@ def run_ppo_clip(cfg, logger, trial=None):
             )
             optimizer.step()
 
-        old_policy.copy_parameters(policy)
-        old_critic_agent = copy.deepcopy(critic_agent)
-
         # Evaluate if enough steps have been performed
         if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
             tmp_steps = nb_steps
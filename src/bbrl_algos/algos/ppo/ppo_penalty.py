@@ -1,6 +1,6 @@
 """
-This version of PPO works, but it incorrectly samples minibatches randomly from the rollouts
-without making sure that each sample is used once and only once
+This version of PPO stores each rollout into a RolloutBuffer, and every optimization epoch
+goes through all the transitions of the rollout once, in random minibatches
 See: https://iclr-blog-track.github.io/2022/03/25/ppo-implementation-details/
 for a full description of all the coding tricks that should be integrated
 """
@@ -8,7 +8,7 @@ for a full description of all the coding tricks that should be integrated
 
 import sys
 import os
-import copy
+import math
 import numpy as np
 
 import torch
@@ -23,8 +23,6 @@ from omegaconf import DictConfig
 
 from bbrl import get_arguments, get_class
 
-from bbrl.utils.functional import gae
-
 from bbrl_algos.models.loggers import Logger
 from bbrl.utils.chrono import Chrono
 
@@ -43,7 +41,19 @@ from bbrl.agents import Agents, TemporalAgent
 # At timestep t>0, these agents will read the ’action’ variable in the workspace at time t − 1
 from bbrl_algos.models.envs import get_env_agents
 from bbrl_algos.models.hyper_params import launch_optuna
+from bbrl_algos.models.instrumentation import PhaseTimer
+from bbrl_algos.models.distributed import (
+    launch_distributed,
+    get_world_size,
+    is_main_process,
+    broadcast_parameters,
+    all_reduce_gradients,
+    min_over_ranks,
+    sum_over_ranks,
+)
 from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.returns import gae_advantages
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
 
 # Neural network models for policys and critics
 from bbrl_algos.models.stochastic_actors import (
@@ -58,10 +68,6 @@ from bbrl_algos.models.stochastic_actors import (
 )
 from bbrl_algos.models.critics import VAgent
 
-# The KLAgent is specific to the KL regularization version of PPO
-# It is used to compute the KL divergence between the current and the past policy
-from bbrl_algos.models.exploration_agents import KLAgent
-
 # Used to display a policy and a critic as a 2D map
 from bbrl.visu.plot_policies import plot_policy
 from bbrl.visu.plot_critics import plot_critic
@@ -85,25 +91,15 @@ def create_ppo_agent(cfg, train_env_agent, eval_env_agent):
     ev_agent = Agents(eval_env_agent, policy)
 
     critic_agent = VAgent(obs_size, cfg.algorithm.architecture.critic_hidden_size)
-    old_critic_agent = copy.deepcopy(critic_agent).set_name("old_critic")
-
-    all_critics = TemporalAgent(Agents(critic_agent, old_critic_agent))
 
     train_agent = TemporalAgent(tr_agent)
     eval_agent = TemporalAgent(ev_agent)
 
-    old_policy = copy.deepcopy(policy)
-    old_policy.set_name("old_policy")
-
-    kl_agent = TemporalAgent(KLAgent(old_policy, policy))
     return (
         train_agent,
         eval_agent,
         critic_agent,
-        all_critics,
         policy,
-        old_policy,
-        kl_agent,
     )
 
 
@@ -114,20 +110,26 @@ def setup_optimizer(cfg, policy, critic):
     return optimizer
 
 
-def compute_advantage(cfg, reward, must_bootstrap, v_value):
-    # Compute temporal difference with GAE
-    advantage = gae(
+def compute_advantage(cfg, rollout_buffer, v_value):
+    # Compute temporal difference with GAE over the whole rollout,
+    # the advantages and the returns are written into the rollout buffer
+    advantage, _ = gae_advantages(
         v_value,
-        reward,
-        must_bootstrap,
+        rollout_buffer.reward,
+        rollout_buffer.terminated,
+        rollout_buffer.done,
         cfg.algorithm.discount_factor,
         cfg.algorithm.gae,
+        advantages=rollout_buffer.advantage,
+        returns=rollout_buffer.returns,
+        compiled="compile_gae" in cfg.algorithm and cfg.algorithm.compile_gae,
     )
     return advantage
 
 
-def compute_critic_loss(advantage):
-    td_error = advantage**2
+def compute_critic_loss(v_value, returns, valid):
+    # The critic regresses onto the returns, not through the GAE recursion
+    td_error = (v_value - returns.detach())[valid] ** 2
     critic_loss = td_error.mean()
     return critic_loss
 
@@ -144,7 +146,9 @@ def run_ppo_penalty(cfg, logger, trial=None):
     best_reward = float("-inf")
     nb_steps = 0
     tmp_steps = 0
-    if cfg.collect_stats:
+    # Only the main process evaluates the agent
+    collect_stats = cfg.collect_stats and is_main_process()
+    if collect_stats:
         directory = "./ppo_data/"
         if not os.path.exists(directory):
             os.makedirs(directory)
@@ -158,19 +162,19 @@ def run_ppo_penalty(cfg, logger, trial=None):
         train_agent,
         eval_agent,
         critic_agent,
-        all_critics,
         policy,
-        old_policy_params,
-        kl_agent,
     ) = create_ppo_agent(cfg, train_env_agent, eval_env_agent)
 
-    # The old_policy params must be wrapped into a TemporalAgent
-    old_policy = TemporalAgent(old_policy_params)
-
     train_workspace = Workspace()
+    rollout_buffer = RolloutBuffer()
 
     # Configure the optimizer
     optimizer = setup_optimizer(cfg, train_agent, critic_agent)
+    # In data-parallel training, all the ranks start from the parameters of the rank 0
+    broadcast_parameters(optimizer)
+
+    # Time spent in each phase of the loop, logged at each evaluation
+    timer = PhaseTimer.from_config(cfg)
 
     # Training loop
     while nb_steps < cfg.algorithm.n_steps:
@@ -179,154 +183,141 @@ def run_ppo_penalty(cfg, logger, trial=None):
         # Handles continuation
         delta_t = 0
         if nb_steps > 0:
-            train_workspace.zero_grad()
             delta_t = 1
             train_workspace.copy_n_last_steps(1)
 
-        # Run the current policy and evaluate the proba of its action according to the old policy
-        # The old_policy can be run after the train_agent on the same workspace
-        # because it writes a logprob_predict and not an action.
-        # That is, it does not determine the action of the old_policy,
-        # it just determines the proba of the action of the current policy given its own probabilities
-
-        with torch.no_grad():
+        # Run the current policy
+        with timer.phase("collect"), torch.no_grad():
             train_agent(
                 train_workspace,
                 t=delta_t,
-                n_steps=cfg.algorithm.n_steps_train,
+                n_steps=cfg.algorithm.n_steps_train - delta_t,
                 stochastic=True,
                 predict_proba=False,
                 compute_entropy=False,
             )
-            old_policy(
-                train_workspace,
-                t=delta_t,
-                n_steps=cfg.algorithm.n_steps_train,
-                # Just computes the probability of the old policy's action
-                # to get the ratio of probabilities
-                predict_proba=True,
-                compute_entropy=False,
-            )
 
-        # Compute the critic value over the whole workspace
-        all_critics(train_workspace, t=delta_t, n_steps=cfg.algorithm.n_steps_train)
-
-        transition_workspace = train_workspace.get_transitions()
-
-        terminated, reward, action, v_value, old_v_value = transition_workspace[
-            "env/terminated",
-            "env/reward",
-            "action",
-            "critic/v_values",
-            "old_critic/v_values",
-        ]
-        nb_steps += action[0].shape[0]
-
-        # Determines whether values of the critic should be propagated
-        # True if the episode reached a time limit or if the task was not done
-        must_bootstrap = ~terminated[1]
-
-        assert (
-            old_v_value.shape == v_value.shape
-        ), f"{old_v_value.shape}[{old_v_value}]/{v_value.shape}[{v_value}]"
-        # assert old_v_value.equal(v_value), f"{old_v_value.shape}[{old_v_value}]/{v_value.shape}[{v_value}]"
-        if cfg.algorithm.clip_range_vf > 0:
-            # Clip the difference between old and new values
-            # NOTE: this depends on the reward scaling
-            v_value = old_v_value + torch.clamp(
-                v_value - old_v_value,
-                -cfg.algorithm.clip_range_vf,
-                cfg.algorithm.clip_range_vf,
+        # Copy the rollout into the preallocated buffer
+        with timer.phase("transitions"):
+            rollout_buffer.store(train_workspace)
+        nb_steps += sum_over_ranks(rollout_buffer.nb_transitions())
+
+        with timer.phase("forward"):
+            # Compute the critic value over the whole rollout
+            v_value = critic_agent.predict_value(rollout_buffer.obs)
+
+            # Cache the distribution of the policy, the log probabilities of the actions
+            # and the values once per rollout: the policy and the critic have not been updated
+            # since they collected the rollout, so they are the old ones of the optimization epochs
+            with torch.no_grad():
+                old_params = policy.get_distribution_params(rollout_buffer.obs)
+                old_action_logp = policy.log_prob_from_params(
+                    old_params, rollout_buffer.action
+                )
+            rollout_buffer.cache_policy_outputs(
+                old_action_logp, v_value.detach(), old_params
             )
 
-        # then we compute the advantage using the clamped critic values
-        advantage = compute_advantage(cfg, reward, must_bootstrap, v_value)
+            # then we compute the advantage and the returns using the cached critic values
+            compute_advantage(cfg, rollout_buffer, v_value)
 
-        # We store the advantage into the transition_workspace
-        transition_workspace.set("advantage", 1, advantage[0])
-
-        critic_loss = compute_critic_loss(advantage)
-        loss_critic = cfg.algorithm.critic_coef * critic_loss
+            critic_loss = compute_critic_loss(
+                v_value, rollout_buffer.returns, rollout_buffer.valid
+            )
+            loss_critic = cfg.algorithm.critic_coef * critic_loss
 
-        optimizer.zero_grad()
-        loss_critic.backward()
-        torch.nn.utils.clip_grad_norm_(
-            critic_agent.parameters(), cfg.algorithm.max_grad_norm
-        )
-        optimizer.step()
+        with timer.phase("backward"):
+            optimizer.zero_grad()
+            loss_critic.backward()
+            all_reduce_gradients(optimizer)
+            torch.nn.utils.clip_grad_norm_(
+                critic_agent.parameters(), cfg.algorithm.max_grad_norm
+            )
+        with timer.phase("optimizer_step"):
+            optimizer.step()
+        timer.add_updates()
+
+        # In data-parallel training, all the ranks must perform the same number of updates,
+        # whatever their number of valid transitions, and none of them may get an empty
+        # minibatch: there are at most as many minibatches as valid transitions on any rank
+        nb_batches = None
+        if get_world_size() > 1:
+            nb_batches = min(
+                math.ceil(rollout_buffer.valid[:-1].numel() / cfg.algorithm.batch_size),
+                min_over_ranks(rollout_buffer.nb_transitions()),
+            )
 
         # We start several optimization epochs on mini_batches
         for opt_epoch in range(cfg.algorithm.opt_epochs):
-            if cfg.algorithm.batch_size > 0:
-                sample_workspace = transition_workspace.select_batch_n(
-                    cfg.algorithm.batch_size
-                )
-            else:
-                sample_workspace = transition_workspace
-
-            kl_agent(sample_workspace, t=0, n_steps=1)
-            kl = sample_workspace["kl"][0]
-
-            # Compute the probability of the played actions according to the current policy
-            # We do not replay the action: we use the one stored into the dataset
-            # Hence predict_proba=True
-            policy(
-                sample_workspace,
-                t=0,
-                compute_entropy=True,
-                predict_proba=True,
-            )
+            for indices in rollout_buffer.minibatches(
+                cfg.algorithm.batch_size, nb_batches=nb_batches
+            ):
+                with timer.phase("minibatch"):
+                    (
+                        obs,
+                        action,
+                        old_action_logp,
+                        policy_advantage,
+                        old_params,
+                    ) = rollout_buffer.get(
+                        indices, "obs", "action", "logprob", "advantage", "dist_params"
+                    )
 
-            # The logprob_predict Tensor has been computed from the old_policy outside the loop
-            advantage, action_logp, old_action_logp, entropy = sample_workspace[
-                "advantage",
-                "current_policy/logprob_predict",
-                "old_policy/logprob_predict",
-                "entropy",
-            ]
+                with timer.phase("forward"):
+                    # A single forward of the current policy gives the probability of the played actions,
+                    # the entropy and the KL divergence from the cached distribution of the old policy
+                    params = policy.get_distribution_params(obs)
+                    action_logp = policy.log_prob_from_params(params, action)
+                    entropy = policy.entropy_from_params(params)
+                    kl = policy.kl_from_params(old_params, params)
 
-            act_diff = action_logp[0] - old_action_logp[0].detach()
-            ratios = act_diff.exp()
+                    # Compute the ratio of action probabilities
+                    ratios = (action_logp - old_action_logp).exp()
 
-            policy_advantage = advantage.detach()[1]
-            policy_loss = compute_penalty_policy_loss(cfg, policy_advantage, ratios, kl)
-            loss_policy = -cfg.algorithm.policy_coef * policy_loss
+                    # Compute the policy loss
+                    policy_loss = compute_penalty_policy_loss(
+                        cfg, policy_advantage, ratios, kl
+                    )
+                    loss_policy = -cfg.algorithm.policy_coef * policy_loss
 
-            # Entropy loss favors exploration
-            entropy_loss = entropy[0].mean()
-            loss_entropy = -cfg.algorithm.entropy_coef * entropy_loss
+                    # Entropy loss favors exploration
+                    entropy_loss = entropy.mean()
+                    loss_entropy = -cfg.algorithm.entropy_coef * entropy_loss
 
-            # Store the losses for tensorboard display
-            logger.log_losses(critic_loss, entropy_loss, policy_loss, nb_steps)
-            logger.add_log("advantage", policy_advantage.mean(), nb_steps)
+                # Store the losses for tensorboard display
+                logger.log_losses(critic_loss, entropy_loss, policy_loss, nb_steps)
+                logger.add_log("advantage", policy_advantage.mean(), nb_steps)
 
-            loss = loss_policy + loss_entropy
+                loss = loss_policy + loss_entropy
 
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(
-                policy.parameters(), cfg.algorithm.max_grad_norm
-            )
-            optimizer.step()
-
-        old_policy_params.copy_parameters(policy)
-        all_critics.agent.agents[1] = copy.deepcopy(critic_agent).set_name("old_critic")
+                with timer.phase("backward"):
+                    optimizer.zero_grad()
+                    loss.backward()
+                    all_reduce_gradients(optimizer)
+                    torch.nn.utils.clip_grad_norm_(
+                        policy.parameters(), cfg.algorithm.max_grad_norm
+                    )
+                with timer.phase("optimizer_step"):
+                    optimizer.step()
+                timer.add_updates()
 
         # Evaluate if enough steps have been performed
-        if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
+        if nb_steps - tmp_steps > cfg.algorithm.eval_interval and is_main_process():
             tmp_steps = nb_steps
             eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                stochastic=True,
-                predict_proba=False,
-            )
+            with timer.phase("evaluation"):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    stochastic=True,
+                    predict_proba=False,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
 
             logger.log_reward_losses(rewards, nb_steps)
+            timer.log(logger, nb_steps)
             print(
                 f"nb_steps: {nb_steps}, reward: {mean:.3f}, best_reward: {best_reward:.3f}"
             )
@@ -353,7 +344,7 @@ def run_ppo_penalty(cfg, logger, trial=None):
                         "./ppo_plots/",
                         cfg.gym_env.env_name,
                     )
-            if cfg.collect_stats:
+            if collect_stats:
                 stats_data.append(rewards)
 
             if trial is not None:
@@ -361,7 +352,7 @@ def run_ppo_penalty(cfg, logger, trial=None):
                 if trial.should_prune():
                     raise optuna.TrialPruned()
 
-    if cfg.collect_stats:
+    if collect_stats:
         # All rewards, dimensions (# of evaluations x # of episodes)
         stats_data = torch.stack(stats_data, axis=-1)
         print(np.shape(stats_data))
@@ -387,6 +378,8 @@ def main(cfg_raw: DictConfig):
 
     if "optuna" in cfg_raw:
         launch_optuna(cfg_raw, run_ppo_penalty)
+    elif "n_processes" in cfg_raw.algorithm and cfg_raw.algorithm.n_processes > 1:
+        launch_distributed(cfg_raw, run_ppo_penalty)
     else:
         logger = Logger(cfg_raw)
         run_ppo_penalty(cfg_raw, logger)
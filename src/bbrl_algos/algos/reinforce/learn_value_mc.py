@@ -18,6 +18,7 @@ from bbrl_algos.models.stochastic_actors import ConstantVarianceContinuousActor
 from bbrl_algos.models.stochastic_actors import DiscreteActor, BernoulliActor
 from bbrl_algos.models.critics import VAgent
 from bbrl_algos.models.envs import get_eval_env_agent
+from bbrl_algos.models.returns import discounted_returns, baselined_returns
 from bbrl_algos.models.loggers import Logger
 from bbrl.utils.chrono import Chrono
 
@@ -25,36 +26,6 @@ from bbrl.visu.plot_policies import plot_policy
 from bbrl.visu.plot_critics import plot_critic
 
 
-def apply_sum(reward):
-    # print(reward)
-    reward_sum = reward.sum(axis=0)
-    # print("sum", reward_sum)
-    for i in range(len(reward)):
-        reward[i] = reward_sum
-    # print("final", reward)
-    return reward
-
-
-def apply_discounted_sum(cfg, reward):
-    # print(reward)
-    tmp = 0
-    for i in reversed(range(len(reward))):
-        reward[i] = reward[i] + cfg.algorithm.discount_factor * tmp
-        tmp = reward[i]
-    # print("final", reward)
-    return reward
-
-
-def apply_discounted_sum_minus_baseline(cfg, reward, baseline):
-    # print(reward)
-    tmp = 0
-    for i in reversed(range(len(reward))):
-        reward[i] = reward[i] + cfg.algorithm.discount_factor * tmp - baseline[i]
-        tmp = reward[i]
-    # print("final", reward)
-    return reward
-
-
 # Create the REINFORCE Agent
 def create_reinforce_agent(cfg, env_agent):
     obs_size, act_size = env_agent.get_obs_and_actions_sizes()
@@ -125,9 +96,10 @@ def run_reinforce(cfg):
         )
 
         # Get relevant tensors (size are timestep x n_envs x ....)
-        obs, terminated, action_logprobs, reward, action = train_workspace[
+        obs, terminated, done, action_logprobs, reward, action = train_workspace[
             "env/env_obs",
             "env/terminated",
+            "env/done",
             "action_logprobs",
             "env/reward",
             "action",
@@ -143,8 +115,8 @@ def run_reinforce(cfg):
         # Determines whether values of the critic should be propagated
         must_bootstrap = ~terminated
 
-        reward = apply_discounted_sum(cfg, reward)
-        # reward = apply_discounted_sum_minus_baseline(cfg, reward, v_value)
+        reward = discounted_returns(reward, cfg.algorithm.discount_factor, done)
+        # reward = baselined_returns(reward, v_value, cfg.algorithm.discount_factor, done)
         critic_loss = compute_critic_loss_mc(reward, v_value)
         actor_loss = compute_actor_loss(action_logprobs, reward, must_bootstrap)
 
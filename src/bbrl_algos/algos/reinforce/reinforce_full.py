@@ -22,6 +22,11 @@ from bbrl_algos.models.loggers import Logger
 from bbrl_algos.models.hyper_params import launch_optuna
 from bbrl_algos.models.utils import save_best
 from bbrl_algos.models.envs import get_eval_env_agent
+from bbrl_algos.models.returns import (
+    discounted_returns,
+    baselined_returns,
+    episode_returns,
+)
 from bbrl.utils.chrono import Chrono
 
 from bbrl.visu.plot_policies import plot_policy
@@ -34,36 +39,6 @@ import matplotlib.pyplot as plt
 matplotlib.use("TkAgg")
 
 
-def apply_sum(reward):
-    # print(reward)
-    reward_sum = reward.sum(axis=0)
-    # print("sum", reward_sum)
-    for i in range(len(reward)):
-        reward[i] = reward_sum
-    # print("final", reward)
-    return reward
-
-
-def apply_discounted_sum(cfg, reward):
-    # print(reward)
-    tmp = 0
-    for i in reversed(range(len(reward))):
-        reward[i] = reward[i] + cfg.algorithm.discount_factor * tmp
-        tmp = reward[i]
-    # print("final", reward)
-    return reward
-
-
-def apply_discounted_sum_minus_baseline(cfg, reward, baseline):
-    # print(reward)
-    tmp = 0
-    for i in reversed(range(len(reward))):
-        reward[i] = reward[i] + cfg.algorithm.discount_factor * tmp - baseline[i]
-        tmp = reward[i]
-    # print("final", reward)
-    return reward
-
-
 # Create the REINFORCE Agent
 def create_reinforce_agent(cfg, env_agent):
     obs_size, act_size = env_agent.get_obs_and_actions_sizes()
@@ -151,8 +126,9 @@ def run_reinforce(cfg, logger, trial=None):
             compute_entropy=True,
         )
         # Get relevant tensors (size are timestep x n_envs x ....)
-        terminated, action_logprobs, reward, action = train_workspace[
+        terminated, done, action_logprobs, reward, action = train_workspace[
             "env/terminated",
+            "env/done",
             "policy/action_logprobs",
             "env/reward",
             "action",
@@ -167,9 +143,9 @@ def run_reinforce(cfg, logger, trial=None):
 
         critic_loss = compute_critic_loss(cfg, reward, must_bootstrap, v_value)
 
-        # reward = apply_sum(reward)
-        reward = apply_discounted_sum(cfg, reward)
-        # reward = apply_discounted_sum_minus_baseline(cfg, reward, v_value)
+        # reward = episode_returns(reward, done)
+        reward = discounted_returns(reward, cfg.algorithm.discount_factor, done)
+        # reward = baselined_returns(reward, v_value, cfg.algorithm.discount_factor, done)
         actor_loss = compute_actor_loss(action_logprobs, reward, must_bootstrap)
 
         entropy_loss = torch.mean(train_workspace["entropy"])
@@ -21,6 +21,7 @@ from bbrl_algos.models.critics import VAgent
 from bbrl_algos.models.hyper_params import launch_optuna
 from bbrl_algos.models.utils import save_best
 from bbrl_algos.models.envs import get_eval_env_agent
+from bbrl_algos.models.returns import episode_returns
 from bbrl.utils.chrono import Chrono
 from bbrl_algos.models.loggers import Logger
 
@@ -28,16 +29,6 @@ from bbrl_algos.models.loggers import Logger
 # of actions a posteriori, rather than online. The online version is clearly more elegant
 
 
-def apply_sum(reward):
-    # print(reward)
-    reward_sum = reward.sum(axis=0)
-    # print("sum", reward_sum)
-    for i in range(len(reward)):
-        reward[i] = reward_sum
-    # print("final", reward)
-    return reward
-
-
 def create_reinforce_agent(cfg, env_agent):
     obs_size, act_size = env_agent.get_obs_and_actions_sizes()
     proba_agent = ProbAgent(
@@ -100,9 +91,10 @@ def run_reinforce(cfg, logger, trial=None):
         reinforce_agent(train_workspace, stochastic=True, t=0, stop_variable="env/done")
 
         # Get relevant tensors (size are timestep x n_envs x ....)
-        obs, terminated, action_probs, reward, action = train_workspace[
+        obs, terminated, done, action_probs, reward, action = train_workspace[
             "env/env_obs",
             "env/terminated",
+            "env/done",
             "policy/action_probs",
             "env/reward",
             "action",
@@ -118,7 +110,7 @@ def run_reinforce(cfg, logger, trial=None):
 
         critic_loss, td = compute_critic_loss(cfg, reward, must_bootstrap, v_value)
 
-        reward = apply_sum(reward)
+        reward = episode_returns(reward, done)
 
         # Take the log probability of the actions performed
         action = action.unsqueeze(-1)
@@ -23,10 +23,28 @@ from bbrl_algos.models.stochastic_actors import (
     DiscreteActor,
 )
 from bbrl_algos.models.critics import ContinuousQAgent
+from bbrl_algos.models.distributions import (
+    squashed_gaussian_sample,
+    squashed_gaussian_log_prob,
+)
+from bbrl_algos.models.ensemble import (
+    Ensemble,
+    EnsembleAgent,
+    EnsembleReplayBuffer,
+    clip_grad_norm_per_member,
+    ensemble_env_config,
+    member_config,
+    member_mean,
+    MemberStatsWriter,
+    split_members,
+)
 from bbrl_algos.models.shared_models import soft_update_params
 from bbrl_algos.models.envs import get_env_agents
 from bbrl_algos.models.hyper_params import launch_optuna
-from bbrl_algos.models.utils import save_best
+from bbrl_algos.models.instrumentation import PhaseTimer
+from bbrl_algos.models.memory import log_memory
+from bbrl_algos.models.checkpoint import CheckpointManager
+from bbrl_algos.models.rollout import make_temporal_agent
 
 from bbrl.visu.plot_policies import plot_policy
 from bbrl.visu.plot_critics import plot_critic
@@ -64,8 +82,9 @@ def create_sac_agent(cfg, train_env_agent, eval_env_agent):
         name="critic-2",
     )
     target_critic_2 = copy.deepcopy(critic_2).set_name("target-critic-2")
-    train_agent = TemporalAgent(tr_agent)
-    eval_agent = TemporalAgent(ev_agent)
+    # The actor is trained on the replay buffer, so collection and evaluation do not need gradients
+    train_agent = make_temporal_agent(tr_agent, requires_grad=False)
+    eval_agent = make_temporal_agent(ev_agent, requires_grad=False)
     return (
         train_agent,
         eval_agent,
@@ -90,14 +109,14 @@ def setup_optimizers(cfg, actor, critic_1, critic_2):
     return actor_optimizer, critic_optimizer
 
 
-def setup_entropy_optimizers(cfg):
+def setup_entropy_optimizers(cfg, nb_seeds=1):
     if cfg.algorithm.entropy_mode == "auto":
         entropy_coef_optimizer_args = get_arguments(cfg.entropy_coef_optimizer)
         # Note: we optimize the log of the entropy coef which is slightly different from the paper
         # as discussed in https://github.com/rail-berkeley/softlearning/issues/37
         # Comment and code taken from the SB3 version of SAC
         log_entropy_coef = torch.log(
-            torch.ones(1) * cfg.algorithm.init_entropy_coef
+            torch.ones(nb_seeds) * cfg.algorithm.init_entropy_coef
         ).requires_grad_(True)
         entropy_coef_optimizer = get_class(cfg.entropy_coef_optimizer)(
             [log_entropy_coef], **entropy_coef_optimizer_args
@@ -239,34 +258,46 @@ def run_sac(cfg, logger, trial=None):
         # target_entropy is \mathcal{H}_0 in the SAC and aplications paper.
         target_entropy = -np.prod(train_env_agent.action_space.shape).astype(np.float32)
 
+    # Time spent in each phase of the loop, logged at each evaluation
+    timer = PhaseTimer.from_config(cfg)
+
+    # The best agents, written in the background
+    if cfg.save_best:
+        best_agents = CheckpointManager.from_config(
+            cfg, "./sac_best_agents/", cfg.gym_env.env_name + "sac"
+        )
+
     # Training loop
     while nb_steps < cfg.algorithm.n_steps:
         # Execute the agent in the workspace
-        if nb_steps > 0:
-            train_workspace.zero_grad()
-            train_workspace.copy_n_last_steps(1)
-            train_agent(
-                train_workspace,
-                t=1,
-                n_steps=cfg.algorithm.n_steps_train,
-                stochastic=True,
-            )
-        else:
-            train_agent(
-                train_workspace,
-                t=0,
-                n_steps=cfg.algorithm.n_steps_train,
-                stochastic=True,
-            )
+        with timer.phase("collect"):
+            if nb_steps > 0:
+                train_workspace.copy_n_last_steps(1)
+                train_agent(
+                    train_workspace,
+                    t=1,
+                    n_steps=cfg.algorithm.n_steps_train,
+                    stochastic=True,
+                )
+            else:
+                train_agent(
+                    train_workspace,
+                    t=0,
+                    n_steps=cfg.algorithm.n_steps_train,
+                    stochastic=True,
+                )
 
-        transition_workspace = train_workspace.get_transitions()
+        with timer.phase("transitions"):
+            transition_workspace = train_workspace.get_transitions()
         action = transition_workspace["action"]
         nb_steps += action[0].shape[0]
-        rb.put(transition_workspace)
+        with timer.phase("replay_put"):
+            rb.put(transition_workspace)
 
         if nb_steps > cfg.algorithm.learning_starts:
             # Get a sample from the workspace
-            rb_workspace = rb.get_shuffled(cfg.algorithm.batch_size)
+            with timer.phase("replay_sample"):
+                rb_workspace = rb.get_shuffled(cfg.algorithm.batch_size)
 
             terminated, reward = rb_workspace["env/terminated", "env/reward"]
             if entropy_coef_optimizer is not None:
@@ -275,40 +306,46 @@ def run_sac(cfg, logger, trial=None):
             # Critic update part #
             critic_optimizer.zero_grad()
 
-            (critic_loss_1, critic_loss_2) = compute_critic_loss(
-                cfg,
-                reward,
-                ~terminated[1],
-                current_actor,
-                q_agents,
-                target_q_agents,
-                rb_workspace,
-                ent_coef,
-            )
+            with timer.phase("forward"):
+                critic_loss_1, critic_loss_2 = compute_critic_loss(
+                    cfg,
+                    reward,
+                    ~terminated[1],
+                    current_actor,
+                    q_agents,
+                    target_q_agents,
+                    rb_workspace,
+                    ent_coef,
+                )
 
             logger.add_log("critic_loss_1", critic_loss_1, nb_steps)
             logger.add_log("critic_loss_2", critic_loss_2, nb_steps)
-            critic_loss = critic_loss_1 + critic_loss_2
-            critic_loss.backward()
-            torch.nn.utils.clip_grad_norm_(
-                critic_1.parameters(), cfg.algorithm.max_grad_norm
-            )
-            torch.nn.utils.clip_grad_norm_(
-                critic_2.parameters(), cfg.algorithm.max_grad_norm
-            )
-            critic_optimizer.step()
+            with timer.phase("backward"):
+                critic_loss = critic_loss_1 + critic_loss_2
+                critic_loss.backward()
+                torch.nn.utils.clip_grad_norm_(
+                    critic_1.parameters(), cfg.algorithm.max_grad_norm
+                )
+                torch.nn.utils.clip_grad_norm_(
+                    critic_2.parameters(), cfg.algorithm.max_grad_norm
+                )
+            with timer.phase("optimizer_step"):
+                critic_optimizer.step()
 
             # Actor update part #
             actor_optimizer.zero_grad()
-            actor_loss = compute_actor_loss(
-                ent_coef, current_actor, q_agents, rb_workspace
-            )
+            with timer.phase("forward"):
+                actor_loss = compute_actor_loss(
+                    ent_coef, current_actor, q_agents, rb_workspace
+                )
             logger.add_log("actor_loss", actor_loss, nb_steps)
-            actor_loss.backward()
-            torch.nn.utils.clip_grad_norm_(
-                actor.parameters(), cfg.algorithm.max_grad_norm
-            )
-            actor_optimizer.step()
+            with timer.phase("backward"):
+                actor_loss.backward()
+                torch.nn.utils.clip_grad_norm_(
+                    actor.parameters(), cfg.algorithm.max_grad_norm
+                )
+            with timer.phase("optimizer_step"):
+                actor_optimizer.step()
 
             # Entropy coef update part #
             if entropy_coef_optimizer is not None:
@@ -320,28 +357,48 @@ def run_sac(cfg, logger, trial=None):
                 ).mean()
                 entropy_coef_optimizer.zero_grad()
                 entropy_coef_loss.backward()
-                entropy_coef_optimizer.step()
+                with timer.phase("optimizer_step"):
+                    entropy_coef_optimizer.step()
                 logger.add_log("entropy_coef_loss", entropy_coef_loss, nb_steps)
             logger.add_log("entropy_coef", ent_coef, nb_steps)
+            timer.add_updates()
 
             # Soft update of target q function
-            soft_update_params(critic_1, target_critic_1, tau)
-            soft_update_params(critic_2, target_critic_2, tau)
-            # soft_update_params(actor, target_actor, tau)
+            with timer.phase("target_update"):
+                soft_update_params(critic_1, target_critic_1, tau)
+                soft_update_params(critic_2, target_critic_2, tau)
+                # soft_update_params(actor, target_actor, tau)
 
         # Evaluate
         if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
             tmp_steps = nb_steps
             eval_workspace = Workspace()  # Used for evaluation
-            eval_agent(
-                eval_workspace,
-                t=0,
-                stop_variable="env/done",
-                stochastic=False,
-            )
+            with timer.phase("evaluation"):
+                eval_agent(
+                    eval_workspace,
+                    t=0,
+                    stop_variable="env/done",
+                    stochastic=False,
+                )
             rewards = eval_workspace["env/cumulated_reward"][-1]
             mean = rewards.mean()
             logger.log_reward_losses(rewards, nb_steps)
+            timer.log(logger, nb_steps)
+            if "log_memory" in cfg and cfg.log_memory:
+                log_memory(
+                    logger,
+                    nb_steps,
+                    rb,
+                    {"train": train_workspace, "eval": eval_workspace},
+                    {
+                        "actor": actor,
+                        "critic_1": critic_1,
+                        "critic_2": critic_2,
+                        "target_critic_1": target_critic_1,
+                        "target_critic_2": target_critic_2,
+                    },
+                    {"actor": actor_optimizer, "critic": critic_optimizer},
+                )
 
             if mean > best_reward:
                 best_reward = mean
@@ -349,14 +406,254 @@ def run_sac(cfg, logger, trial=None):
             print(
                 f"nb steps: {nb_steps}, reward: {mean:.02f}, best: {best_reward:.02f}"
             )
-            if cfg.save_best and best_reward == mean:
-                save_best(
-                    actor, cfg.gym_env.env_name, mean, "./sac_best_agents/", "sac"
-                )
+            if cfg.save_best:
+                with timer.phase("checkpoint"):
+                    best_agents.save(
+                        mean,
+                        nb_steps,
+                        {"actor": actor, "critic_1": critic_1, "critic_2": critic_2},
+                        {"actor": actor_optimizer, "critic": critic_optimizer},
+                        rb,
+                    )
+
+    if cfg.save_best:
+        best_agents.close()
 
     return best_reward
 
 
+def create_sac_ensemble(cfg, train_env_agent, eval_env_agent):
+    """One actor and two critics per seed, stacked into Ensembles"""
+    obs_size, act_size = train_env_agent.get_obs_and_actions_sizes()
+    assert (
+        train_env_agent.is_continuous_action()
+    ), "SAC code dedicated to continuous actions"
+    actors, critics_1, critics_2 = [], [], []
+    for index in range(cfg.algorithm.nb_seeds):
+        # The seeds only differ by the initialization of their networks and their rollouts
+        torch.random.manual_seed(cfg.algorithm.seed.torch + index)
+        actors.append(
+            SquashedGaussianActor(
+                obs_size,
+                cfg.algorithm.architecture.actor_hidden_size,
+                act_size,
+                name="policy",
+            )
+        )
+        for critics in (critics_1, critics_2):
+            critics.append(
+                ContinuousQAgent(
+                    obs_size, cfg.algorithm.architecture.critic_hidden_size, act_size
+                )
+            )
+    actor = Ensemble(actors)
+    critic_1 = Ensemble(critics_1)
+    critic_2 = Ensemble(critics_2)
+
+    train_policy = EnsembleAgent(actor, "predict_action", "action", stochastic=True)
+    eval_policy = EnsembleAgent(actor, "predict_action", "action", stochastic=False)
+    train_agent = make_temporal_agent(
+        Agents(train_env_agent, train_policy), requires_grad=False
+    )
+    eval_agent = make_temporal_agent(
+        Agents(eval_env_agent, eval_policy), requires_grad=False
+    )
+    return (
+        train_agent,
+        eval_agent,
+        actor,
+        critic_1,
+        copy.deepcopy(critic_1),
+        critic_2,
+        copy.deepcopy(critic_2),
+    )
+
+
+def sample_ensemble_actions(actor, obs):
+    """Reparameterized actions of the members of the actor, and their log probabilities"""
+    mean, std = actor.call("get_mean_and_std", obs)
+    action_std = actor.call("get_action_std", std)
+    action, gaussian_action = squashed_gaussian_sample(mean, action_std)
+    log_prob = squashed_gaussian_log_prob(
+        mean, action_std, gaussian_action=gaussian_action
+    )
+    return action, log_prob
+
+
+def ensemble_q_values(critic_1, critic_2, obs, action):
+    """The q values of the two critics of each member"""
+    obs_act = torch.cat((obs, action), dim=-1)
+    q_values_1 = critic_1.call("model", obs_act)
+    q_values_2 = critic_2.call("model", obs_act)
+    return q_values_1.squeeze(-1), q_values_2.squeeze(-1)
+
+
+def run_sac_multi_seed(cfg):
+    """
+    Trains cfg.algorithm.nb_seeds SAC agents at once, with the torch seeds
+    seed.torch, seed.torch + 1, ... Each seed has its own environments, replay buffer,
+    entropy coefficient, logger (in log_dir/seed_<i>) and stats file
+    (sac_data/sac_<env>_seed<i>.stats)
+    """
+    nb_seeds = cfg.algorithm.nb_seeds
+    loggers = [Logger(member_config(cfg, index)) for index in range(nb_seeds)]
+    stats = None
+    if "collect_stats" in cfg and cfg.collect_stats:
+        stats = MemberStatsWriter(
+            "./sac_data/",
+            "sac",
+            cfg.gym_env.env_name,
+            nb_seeds,
+            cfg.algorithm.nb_evals,
+        )
+    best_rewards = torch.full((nb_seeds,), float("-inf"))
+
+    ent_coef = torch.full((nb_seeds,), cfg.algorithm.init_entropy_coef)
+    tau = cfg.algorithm.tau_target
+    batch_size = cfg.algorithm.batch_size
+
+    # The seed i plays in the i-th block of n_envs training (nb_evals evaluation) environments
+    train_env_agent, eval_env_agent = get_env_agents(ensemble_env_config(cfg))
+    (
+        train_agent,
+        eval_agent,
+        actor,
+        critic_1,
+        target_critic_1,
+        critic_2,
+        target_critic_2,
+    ) = create_sac_ensemble(cfg, train_env_agent, eval_env_agent)
+    train_workspace = Workspace()
+    rb = EnsembleReplayBuffer(nb_seeds, int(cfg.algorithm.buffer_size))
+
+    # A single optimizer over the stacked parameters behaves as one optimizer per seed
+    actor_optimizer, critic_optimizer = setup_optimizers(cfg, actor, critic_1, critic_2)
+    entropy_coef_optimizer, log_entropy_coef = setup_entropy_optimizers(cfg, nb_seeds)
+    # The steps are counted per seed
+    nb_steps = 0
+    tmp_steps = 0
+
+    if cfg.algorithm.entropy_mode == "auto":
+        target_entropy = -np.prod(train_env_agent.action_space.shape).astype(np.float32)
+
+    while nb_steps < cfg.algorithm.n_steps:
+        if nb_steps > 0:
+            train_workspace.copy_n_last_steps(1)
+            train_agent(train_workspace, t=1, n_steps=cfg.algorithm.n_steps_train)
+        else:
+            train_agent(train_workspace, t=0, n_steps=cfg.algorithm.n_steps_train)
+
+        nb_steps += rb.put(train_workspace)
+
+        if nb_steps > cfg.algorithm.learning_starts:
+            # The i-th block of the batch is sampled from the replay buffer of the seed i
+            rb_workspace = rb.get_shuffled(batch_size)
+            obs, action, terminated, reward = rb_workspace[
+                "env/env_obs", "action", "env/terminated", "env/reward"
+            ]
+            if entropy_coef_optimizer is not None:
+                ent_coef = torch.exp(log_entropy_coef.detach())
+            # The entropy coefficient of the seed of each transition
+            batch_ent_coef = ent_coef.repeat_interleave(batch_size)
+
+            # Critic update part #
+            with torch.no_grad():
+                next_action, action_logprobs_next = sample_ensemble_actions(
+                    actor, obs[1]
+                )
+                q_next = torch.min(
+                    *ensemble_q_values(
+                        target_critic_1, target_critic_2, obs[1], next_action
+                    )
+                )
+                v_phi = q_next - batch_ent_coef * action_logprobs_next
+                target = (
+                    reward[-1]
+                    + cfg.algorithm.discount_factor * v_phi * (~terminated[1]).int()
+                )
+            q_values_1, q_values_2 = ensemble_q_values(
+                critic_1, critic_2, obs[0], action[0]
+            )
+            critic_losses_1 = member_mean(
+                split_members((target - q_values_1) ** 2, nb_seeds)
+            )
+            critic_losses_2 = member_mean(
+                split_members((target - q_values_2) ** 2, nb_seeds)
+            )
+
+            critic_optimizer.zero_grad()
+            (critic_losses_1 + critic_losses_2).sum().backward()
+            clip_grad_norm_per_member(
+                critic_1.parameters(), cfg.algorithm.max_grad_norm
+            )
+            clip_grad_norm_per_member(
+                critic_2.parameters(), cfg.algorithm.max_grad_norm
+            )
+            critic_optimizer.step()
+
+            # Actor update part #
+            new_action, action_logprobs_new = sample_ensemble_actions(actor, obs[0])
+            current_q_values = torch.min(
+                *ensemble_q_values(critic_1, critic_2, obs[0], new_action)
+            )
+            actor_losses = member_mean(
+                split_members(
+                    batch_ent_coef * action_logprobs_new - current_q_values, nb_seeds
+                )
+            )
+            actor_optimizer.zero_grad()
+            actor_losses.sum().backward()
+            clip_grad_norm_per_member(actor.parameters(), cfg.algorithm.max_grad_norm)
+            actor_optimizer.step()
+
+            # Entropy coef update part #
+            if entropy_coef_optimizer is not None:
+                entropy_coef_losses = -member_mean(
+                    split_members(
+                        log_entropy_coef.exp().repeat_interleave(batch_size)
+                        * (action_logprobs_new.detach() + target_entropy),
+                        nb_seeds,
+                    )
+                )
+                entropy_coef_optimizer.zero_grad()
+                entropy_coef_losses.sum().backward()
+                entropy_coef_optimizer.step()
+                for logger, loss in zip(loggers, entropy_coef_losses):
+                    logger.add_log("entropy_coef_loss", loss, nb_steps)
+
+            for index, logger in enumerate(loggers):
+                logger.add_log("critic_loss_1", critic_losses_1[index], nb_steps)
+                logger.add_log("critic_loss_2", critic_losses_2[index], nb_steps)
+                logger.add_log("actor_loss", actor_losses[index], nb_steps)
+                logger.add_log("entropy_coef", ent_coef[index], nb_steps)
+
+            # Soft update of target q function
+            soft_update_params(critic_1, target_critic_1, tau)
+            soft_update_params(critic_2, target_critic_2, tau)
+
+        if nb_steps - tmp_steps > cfg.algorithm.eval_interval:
+            tmp_steps = nb_steps
+            eval_workspace = Workspace()
+            eval_agent(eval_workspace, t=0, stop_variable="env/done")
+            rewards = eval_workspace["env/cumulated_reward"][-1].view(nb_seeds, -1)
+            for logger, member_rewards in zip(loggers, rewards):
+                logger.log_reward_losses(member_rewards, nb_steps)
+            means = rewards.mean(dim=1)
+            best_rewards = torch.maximum(best_rewards, means)
+            if stats is not None:
+                stats.write(nb_steps, rewards)
+            print(
+                f"nb steps: {nb_steps}, reward: {means.mean():.02f} +- {means.std():.02f}, "
+                f"best: {best_rewards.mean():.02f}"
+            )
+
+    if stats is not None:
+        stats.close()
+    for logger in loggers:
+        logger.close()
+    return best_rewards
+
+
 def load_best(best_filename):
     best_agent = torch.load(best_filename)
     return best_agent
@@ -378,9 +675,12 @@ def main(cfg_raw: DictConfig):
 
     if "optuna" in cfg_raw:
         launch_optuna(cfg_raw, run_sac)
+    elif "nb_seeds" in cfg_raw.algorithm and cfg_raw.algorithm.nb_seeds > 1:
+        run_sac_multi_seed(cfg_raw)
     else:
         logger = Logger(cfg_raw)
         run_sac(cfg_raw, logger)
+        logger.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+"""
+Microbenchmark of the GAE computation, comparing bbrl.utils.functional.gae
+with bbrl_algos.models.returns.gae_advantages (pure torch and compiled paths).
+
+Run:
+
+    python -m bbrl_algos.benchmarks.gae_bench --sizes 2x256 128x8 1024x16
+
+The compiled path is only measured with --compiled, since compiling takes a while
+(once per rollout length).
+"""
+
+import time
+
+import torch
+
+from bbrl.utils.functional import gae
+from bbrl_algos.models.returns import gae_advantages
+
+
+def time_function(function, nb_repeats, nb_warmup=3):
+    """Returns the mean duration of a call, in milliseconds"""
+    for _ in range(nb_warmup):
+        function()
+    start = time.perf_counter()
+    for _ in range(nb_repeats):
+        function()
+    return (time.perf_counter() - start) * 1000 / nb_repeats
+
+
+def make_inputs(n_steps, n_envs, done_prob=0.0, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    value = torch.randn(n_steps, n_envs, generator=generator, requires_grad=True)
+    reward = torch.randn(n_steps, n_envs, generator=generator)
+    terminated = torch.rand(n_steps, n_envs, generator=generator) < done_prob
+    return value, reward, terminated
+
+
+def bench_size(n_steps, n_envs, nb_repeats, compiled, backward):
+    discount_factor, gae_coef = 0.99, 0.95
+    value, reward, terminated = make_inputs(n_steps, n_envs)
+    # bbrl's gae does not handle episode ends, so compare without them
+    done = terminated
+
+    def run_bbrl():
+        advantages = gae(value, reward, ~terminated[1:], discount_factor, gae_coef)
+        if backward:
+            (advantages**2).mean().backward()
+
+    advantages_buffer = torch.zeros(n_steps, n_envs)
+    returns_buffer = torch.zeros(n_steps, n_envs)
+
+    def run_bbrl_algos(compiled_scan):
+        advantages, _ = gae_advantages(
+            value,
+            reward,
+            terminated,
+            done,
+            discount_factor,
+            gae_coef,
+            advantages=advantages_buffer,
+            returns=returns_buffer,
+            compiled=compiled_scan,
+        )
+        if backward:
+            (advantages[:-1] ** 2).mean().backward()
+
+    # Check that both implementations agree before timing them
+    reference = gae(value, reward, ~terminated[1:], discount_factor, gae_coef)
+    advantages, _ = gae_advantages(
+        value, reward, terminated, done, discount_factor, gae_coef
+    )
+    assert torch.allclose(reference, advantages[:-1], atol=1e-5)
+
+    results = {
+        "bbrl": time_function(run_bbrl, nb_repeats),
+        "torch": time_function(lambda: run_bbrl_algos(False), nb_repeats),
+    }
+    if compiled:
+        results["compiled"] = time_function(lambda: run_bbrl_algos(True), nb_repeats)
+    return results
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    print(f"{'T x B':>12} | " + " | ".join(f"{name:>10}" for name in args.columns))
+    for size in args.sizes:
+        n_steps, n_envs = (int(x) for x in size.split("x"))
+        results = bench_size(
+            n_steps, n_envs, args.repeats, args.compiled, not args.no_backward
+        )
+        line = " | ".join(
+            f"{results[name]:>8.3f}ms" if name in results else f"{'-':>10}"
+            for name in args.columns
+        )
+        print(f"{size:>12} | {line}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["2x256", "128x8", "1024x16"])
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--compiled", action="store_true")
+    parser.add_argument("--no_backward", action="store_true")
+    args = parser.parse_args()
+    args.columns = ["bbrl", "torch", "compiled"]
+    main(args)
@@ -0,0 +1,161 @@
+"""
+Microbenchmark of the data path of the off-policy scripts: Workspace.get_transitions,
+Workspace.copy_n_last_steps, ReplayBuffer.put and get_shuffled, and the buffers of
+bbrl_algos (EnsembleReplayBuffer, RolloutBuffer), on rollouts of n_steps_train steps
+of n_envs environments with observations and continuous actions of each size.
+
+Run:
+
+    python -m bbrl_algos.benchmarks.replay_bench --sizes 4x1 8x2 17x6 376x17
+
+Each operation is reported in nanoseconds per transition (the transitions of the
+rollout, or the sampled ones), and in bytes allocated per call, as measured by
+torch.profiler.
+"""
+
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from bbrl.utils.replay_buffer import ReplayBuffer
+from bbrl.workspace import Workspace
+from bbrl_algos.models.ensemble import EnsembleReplayBuffer
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
+
+
+def time_function(function, nb_repeats, nb_warmup=3):
+    """Returns the mean duration of a call, in nanoseconds"""
+    for _ in range(nb_warmup):
+        function()
+    start = time.perf_counter_ns()
+    for _ in range(nb_repeats):
+        function()
+    return (time.perf_counter_ns() - start) / nb_repeats
+
+
+def allocated_bytes(function, nb_repeats=3):
+    """Returns the mean number of bytes allocated by a call on the CPU"""
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(nb_repeats):
+            function()
+    events = [event for event in prof.events() if event.name != "[memory]"]
+    return sum(max(event.self_cpu_memory_usage, 0) for event in events) / nb_repeats
+
+
+def make_rollout(n_steps, n_envs, obs_dim, action_dim, episode_steps=200, seed=0):
+    """A workspace with the variables written by a ParallelGymAgent and an actor"""
+    generator = torch.Generator().manual_seed(seed)
+    timestep = (
+        torch.arange(n_steps).unsqueeze(1)
+        + torch.randint(episode_steps, (1, n_envs), generator=generator)
+    ) % episode_steps
+    done = timestep == episode_steps - 1
+    workspace = Workspace()
+    variables = {
+        "env/env_obs": torch.randn(n_steps, n_envs, obs_dim, generator=generator),
+        "env/reward": torch.randn(n_steps, n_envs, generator=generator),
+        "env/cumulated_reward": torch.randn(n_steps, n_envs, generator=generator),
+        "env/terminated": torch.zeros(n_steps, n_envs, dtype=torch.bool),
+        "env/truncated": done,
+        "env/done": done.clone(),
+        "env/timestep": timestep,
+        "action": torch.randn(n_steps, n_envs, action_dim, generator=generator),
+    }
+    for key, value in variables.items():
+        workspace.set_full(key, value)
+    return workspace
+
+
+def bench_size(obs_dim, action_dim, args):
+    rollout = make_rollout(args.n_steps_train, args.n_envs, obs_dim, action_dim)
+    transitions = rollout.get_transitions()
+    nb_transitions = transitions["env/done"].shape[1]
+
+    rb = ReplayBuffer(max_size=args.buffer_size)
+    while rb.size() < min(args.buffer_size, 10 * args.batch_size):
+        rb.put(transitions)
+
+    ensemble_rollout = make_rollout(
+        args.n_steps_train, args.n_envs * args.nb_members, obs_dim, action_dim
+    )
+    ensemble_rb = EnsembleReplayBuffer(args.nb_members, args.buffer_size)
+    for _ in range(10):
+        nb_member_transitions = ensemble_rb.put(ensemble_rollout)
+
+    rollout_buffer = RolloutBuffer()
+    rollout_buffer.store(rollout)
+    nb_rollout_transitions = rollout_buffer.nb_transitions()
+
+    def store_and_sample_rollout():
+        rollout_buffer.store(rollout)
+        for indices in rollout_buffer.minibatches(args.batch_size):
+            rollout_buffer.get(indices, "obs", "action", "reward")
+
+    # name: (function, number of transitions of a call)
+    operations = {
+        "get_transitions": (rollout.get_transitions, nb_transitions),
+        "copy_n_last_steps": (lambda: rollout.copy_n_last_steps(1), args.n_envs),
+        "rb.put": (lambda: rb.put(transitions), nb_transitions),
+        "rb.get_shuffled": (lambda: rb.get_shuffled(args.batch_size), args.batch_size),
+        "ensemble.put": (
+            lambda: ensemble_rb.put(ensemble_rollout),
+            nb_member_transitions * args.nb_members,
+        ),
+        "ensemble.get_shuffled": (
+            lambda: ensemble_rb.get_shuffled(args.batch_size),
+            args.batch_size * args.nb_members,
+        ),
+        "rollout.store+sample": (store_and_sample_rollout, nb_rollout_transitions),
+    }
+    results = {}
+    for name, (function, nb) in operations.items():
+        if name in args.operations:
+            results[name] = (
+                time_function(function, args.repeats) / nb,
+                allocated_bytes(function),
+            )
+    return results
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    print(
+        f"n_envs: {args.n_envs}, n_steps_train: {args.n_steps_train}, "
+        f"batch_size: {args.batch_size}, nb_members: {args.nb_members}"
+    )
+    columns = ["obs x act", "operation", "ns/transition", "bytes/call"]
+    widths = [10, 22, 13, 12]
+    print(" | ".join(f"{column:>{width}}" for column, width in zip(columns, widths)))
+    for size in args.sizes:
+        obs_dim, action_dim = (int(x) for x in size.split("x"))
+        results = bench_size(obs_dim, action_dim, args)
+        for name, (ns, nb_bytes) in results.items():
+            print(f"{size:>10} | {name:>22} | {ns:>13.1f} | {nb_bytes:>12.0f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    operations = [
+        "get_transitions",
+        "copy_n_last_steps",
+        "rb.put",
+        "rb.get_shuffled",
+        "ensemble.put",
+        "ensemble.get_shuffled",
+        "rollout.store+sample",
+    ]
+    parser = argparse.ArgumentParser()
+    # CartPole / Pendulum, Swimmer, HalfCheetah, Humanoid
+    parser.add_argument("--sizes", nargs="+", default=["4x1", "8x2", "17x6", "376x17"])
+    parser.add_argument("--n_envs", type=int, default=8)
+    parser.add_argument("--n_steps_train", type=int, default=32)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--buffer_size", type=int, default=100_000)
+    parser.add_argument("--nb_members", type=int, default=4)
+    parser.add_argument("--operations", nargs="+", default=operations)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+    main(args)
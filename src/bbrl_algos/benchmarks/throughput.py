@@ -0,0 +1,306 @@
+"""
+End-to-end throughput benchmark of the algorithms: each of them is trained for a fixed
+number of environment steps on CartPole (discrete actions) or Pendulum (continuous
+actions), in its own process, with the instrumentation of its training loop
+(see models/instrumentation.py). The results are written into a json file:
+environment steps and updates per second, time to the first update (from the start
+of the training loop), peak RSS and wall time of the process.
+
+Run, then compare with a stored baseline:
+
+    python -m bbrl_algos.benchmarks.throughput run --output results.json
+    python -m bbrl_algos.benchmarks.throughput compare baseline.json results.json
+
+With --synthetic, the environments are replaced by the synthetic ones of the same
+action type (see models/synthetic_env.py), so that the learner is measured without
+the cost of the simulators, with any --obs_dim, --action_dim and --episode_steps.
+compare exits with 1 when a metric is worse than the baseline by more than --tolerance.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+ALGOS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "algos")
+
+# name: (script, config, action type, overrides of a run of {n_steps} steps)
+SUITE = {
+    "dqn": (
+        "dqn/dqn.py",
+        "dqn_cartpole.yaml",
+        "discrete",
+        [
+            "algorithm.n_steps={n_steps}",
+            "algorithm.buffer.learning_starts={learning_starts}",
+            "algorithm.eval_interval={eval_interval}",
+            "collect_stats=False",
+            "++visualize=False",
+        ],
+    ),
+    "sac": (
+        "sac/sac.py",
+        "sac_pendulum.yaml",
+        "continuous",
+        [
+            "algorithm.n_steps={n_steps}",
+            "algorithm.learning_starts={learning_starts}",
+            "algorithm.eval_interval={eval_interval}",
+            "plot_agents=False",
+        ],
+    ),
+    "tqc": (
+        "tqc/tqc.py",
+        "tqc_pendulum.yaml",
+        "continuous",
+        [
+            # n_steps is the length of a rollout of the 8 environments
+            "algorithm.max_epochs={n_epochs}",
+            "algorithm.learning_starts={learning_starts}",
+            "algorithm.eval_interval={eval_interval}",
+        ],
+    ),
+    "ddpg": (
+        "ddpg/ddpg.py",
+        "ddpg_pendulum.yaml",
+        "continuous",
+        [
+            "algorithm.n_steps={n_steps}",
+            "algorithm.learning_starts={learning_starts}",
+            "algorithm.eval_interval={eval_interval}",
+            "logger.classname=bbrl.utils.logger.TFLogger",
+            "~logger.project",
+            "~logger.group",
+            "~logger.tags",
+            "~logger.job_type",
+        ],
+    ),
+    "ppo": (
+        "ppo/ppo_clip.py",
+        "ppo_cartpole.yaml",
+        "discrete",
+        [
+            "algorithm.n_steps={n_steps}",
+            "algorithm.eval_interval={eval_interval}",
+        ],
+    ),
+    "a2c": (
+        "a2c/a2c.py",
+        "a2c_cartpole.yaml",
+        "discrete",
+        [
+            "algorithm.n_steps={n_steps}",
+            "algorithm.eval_interval={eval_interval}",
+        ],
+    ),
+    "reinforce": (
+        "reinforce/reinforce_full.py",
+        "reinforce_cartpole.yaml",
+        "discrete",
+        ["algorithm.nb_episodes={n_episodes}", "plot_agents=False"],
+    ),
+    "cem": (
+        "cem/cem.py",
+        "cem_cartpole.yaml",
+        "discrete",
+        ["algorithm.n_steps={n_steps}", "verbose=False"],
+    ),
+}
+
+# The training loops of TQC and REINFORCE are not instrumented yet (and do not run
+# with their current configs), so they are only run when given with --algos
+DEFAULT_ALGOS = [name for name in SUITE if name not in ("tqc", "reinforce")]
+
+# The module prefix makes gymnasium import it, whatever the script imports
+SYNTHETIC_ENVS = {
+    "discrete": "bbrl_algos.models.synthetic_env:SyntheticDiscrete-v0",
+    "continuous": "bbrl_algos.models.synthetic_env:SyntheticContinuous-v0",
+}
+
+# name: True if higher is better
+METRICS = {
+    "env_steps_per_s": True,
+    "updates_per_s": True,
+    "time_to_first_update": False,
+    "peak_rss_mb": False,
+}
+
+
+def peak_rss_mb(rusage):
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss / 2**20
+    return rusage.ru_maxrss / 2**10
+
+
+def run_algo(name, run_dir, n_steps, synthetic, synthetic_args=None):
+    """Trains the algorithm name in a new process, returns its results"""
+    if synthetic_args is None:
+        synthetic_args = {}
+    script, config_name, action_type, overrides = SUITE[name]
+    os.makedirs(run_dir, exist_ok=True)
+    summary_file = os.path.join(run_dir, "perf_summary.json")
+    if os.path.exists(summary_file):
+        os.remove(summary_file)
+    values = {
+        "n_steps": n_steps,
+        "learning_starts": n_steps // 10,
+        "eval_interval": n_steps // 5,
+        "n_epochs": n_steps // 256,
+        "n_episodes": max(1, n_steps // 5000),
+    }
+    args = [o.format(**values) for o in overrides] + [
+        f"hydra.run.dir={run_dir}",
+        f"++logger.log_dir={os.path.join(run_dir, 'logs')}",
+        "++save_best=False",
+        "++instrument=True",
+        f"++perf_summary={summary_file}",
+    ]
+    if synthetic:
+        args.append(f"gym_env.env_name={SYNTHETIC_ENVS[action_type]}")
+        args += [
+            f"++gym_env.make_env_args.{key}={value}"
+            for key, value in synthetic_args.items()
+        ]
+    command = [
+        sys.executable,
+        os.path.join(ALGOS_PATH, script),
+        "--config-name",
+        config_name,
+    ] + args
+
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, "output.log"), "w") as output:
+        # The scripts without a version_base do not change of directory
+        process = subprocess.Popen(
+            command, cwd=run_dir, stdout=output, stderr=subprocess.STDOUT
+        )
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = status
+    results = {
+        "config": config_name,
+        "env_name": SYNTHETIC_ENVS[action_type] if synthetic else None,
+        "wall_time": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss_mb(rusage),
+    }
+    if status != 0 or not os.path.exists(summary_file):
+        with open(os.path.join(run_dir, "output.log")) as output:
+            # The last exception raised by the script
+            errors = [line.strip() for line in output if "Error:" in line]
+        results["status"] = "error"
+        results["error"] = errors[-1] if errors else f"exit status {status}"
+        return results
+    with open(summary_file) as file:
+        results.update(json.load(file))
+    results["status"] = "ok"
+    return results
+
+
+def run(args):
+    synthetic_args = {
+        key: value
+        for key, value in [
+            ("obs_dim", args.obs_dim),
+            ("action_dim", args.action_dim),
+            ("max_episode_steps", args.episode_steps),
+        ]
+        if value is not None
+    }
+    results = {
+        "metadata": {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "n_steps": args.n_steps,
+            "synthetic": args.synthetic,
+            "synthetic_args": synthetic_args,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": {},
+    }
+    run_root = os.path.abspath(args.run_dir)
+    for name in args.algos:
+        print(f"{name}...", end=" ", flush=True)
+        result = run_algo(
+            name,
+            os.path.join(run_root, name),
+            args.n_steps,
+            args.synthetic,
+            synthetic_args,
+        )
+        results["results"][name] = result
+        if result["status"] == "ok":
+            print(
+                f"{result['env_steps_per_s']:.0f} steps/s, "
+                f"{result['updates_per_s']:.1f} updates/s, "
+                f"{result['peak_rss_mb']:.0f} MB"
+            )
+        else:
+            print(f"error: {result['error']}")
+        # Written after each algorithm, so that a long suite can be interrupted
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+def compare(args):
+    """Prints the metrics of both files, returns the number of regressions"""
+    with open(args.baseline) as file:
+        baseline = json.load(file)["results"]
+    with open(args.current) as file:
+        current = json.load(file)["results"]
+
+    nb_regressions = 0
+    print(f"{'algo':>10} {'metric':>22} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in baseline:
+        if baseline[name]["status"] != "ok" or name not in current:
+            continue
+        if current[name]["status"] != "ok":
+            print(f"{name:>10} REGRESSION: {current[name]['error']}")
+            nb_regressions += 1
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = baseline[name].get(metric), current[name].get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = " REGRESSION" if worse > args.tolerance else ""
+            nb_regressions += bool(flag)
+            print(
+                f"{name:>10} {metric:>22} {old:>10.2f} {new:>10.2f} "
+                f"{change:>+8.1%}{flag}"
+            )
+    return nb_regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--algos", nargs="+", default=DEFAULT_ALGOS)
+    run_parser.add_argument("--n_steps", type=int, default=20_000)
+    run_parser.add_argument("--synthetic", action="store_true")
+    run_parser.add_argument("--obs_dim", type=int)
+    run_parser.add_argument("--action_dim", type=int)
+    run_parser.add_argument("--episode_steps", type=int)
+    run_parser.add_argument("--output", default="throughput.json")
+    run_parser.add_argument("--run_dir", default="./throughput_runs/")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(1 if compare(args) > 0 else 0)
@@ -44,9 +44,13 @@ class DiscreteDeterministicActor(BaseActor):
             observation = kwargs["observation"]
         else:
             observation = self.get(("env/env_obs", t))
-        action = torch.argmax(self.model(observation), axis=1)
+        action = self.output_to_action(self.model(observation))
         self.set(("action", t), action)
 
+    def output_to_action(self, output):
+        """Turns a batch of outputs of the model into actions"""
+        return torch.argmax(output, axis=-1)
+
     def predict_action(self, obs):
         action = self.model(obs)
         return action
@@ -77,6 +81,10 @@ class ContinuousDeterministicActor(BaseActor):
         action = self.model(obs)
         self.set(("action", t), action)
 
+    def output_to_action(self, output):
+        """Turns a batch of outputs of the model into actions"""
+        return output
+
     def predict_action(self, obs, stochastic=False):
         """Predict just one action (without using the workspace)"""
         assert (
@@ -0,0 +1,372 @@
+"""
+Checkpoints of the training state of a run, so that it can be resumed later on:
+the state dicts of the networks and of the optimizers, the content of the replay buffer,
+the step counters and the random states.
+The environments are not saved, unless they are wrapped into a ReplayableEnv: a resumed
+run starts new episodes. The replay buffer can be written incrementally (ReplaySegments).
+
+CheckpointManager keeps the k best agents of a run, written on a background thread.
+"""
+
+import atexit
+import copy
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+
+import gymnasium
+import numpy as np
+import torch
+
+
+def replay_buffer_state(rb):
+    return {"variables": rb.variables, "position": rb.position, "is_full": rb.is_full}
+
+
+def load_replay_buffer_state(rb, state):
+    rb.variables = state["variables"]
+    rb.position = state["position"]
+    rb.is_full = state["is_full"]
+
+
+class ReplaySegments:
+    """
+    Writes the content of a ReplayBuffer incrementally into directory: each save writes
+    the transitions put since the previous one as a new segment, the segments whose
+    transitions have all been overwritten since are deleted by remove_obsolete.
+    nb_puts is the number of transitions put into the buffer since its creation.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        self.obsolete = []
+        self.nb_saved = 0
+
+    def save(self, rb, nb_puts):
+        """Writes the new segment, returns the state to save with the checkpoint"""
+        if rb.variables is not None:
+            start = max(self.nb_saved, nb_puts - rb.max_size)
+            if nb_puts > start:
+                filename = f"segment_{start}_{nb_puts}.pt"
+                indexes = torch.arange(start, nb_puts) % rb.max_size
+                save_checkpoint(
+                    os.path.join(self.directory, filename),
+                    {key: tensor[indexes] for key, tensor in rb.variables.items()},
+                )
+                self.segments.append(
+                    {"filename": filename, "start": start, "end": nb_puts}
+                )
+            self.nb_saved = nb_puts
+            # Only deleted once the checkpoint that does not refer to them is saved
+            self.obsolete += [
+                segment
+                for segment in self.segments
+                if segment["end"] <= nb_puts - rb.max_size
+            ]
+            self.segments = [
+                segment for segment in self.segments if segment not in self.obsolete
+            ]
+        return {"segments": list(self.segments), "nb_saved": self.nb_saved}
+
+    def remove_obsolete(self):
+        for segment in self.obsolete:
+            path = os.path.join(self.directory, segment["filename"])
+            if os.path.exists(path):
+                os.remove(path)
+        self.obsolete = []
+
+    def load(self, rb, state):
+        """Rebuilds the content of rb from the segments of state"""
+        self.segments = list(state["segments"])
+        self.nb_saved = state["nb_saved"]
+        # The segments written after the checkpoint, by an interrupted save
+        filenames = {segment["filename"] for segment in self.segments}
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename not in filenames:
+                    os.remove(os.path.join(self.directory, filename))
+
+        for segment in self.segments:
+            rows = torch.load(
+                os.path.join(self.directory, segment["filename"]), weights_only=True
+            )
+            if rb.variables is None:
+                rb.variables = {
+                    key: torch.zeros(
+                        rb.max_size,
+                        *value.shape[1:],
+                        dtype=value.dtype,
+                        device=rb.device,
+                    )
+                    for key, value in rows.items()
+                }
+            indexes = torch.arange(segment["start"], segment["end"]) % rb.max_size
+            for key, value in rows.items():
+                rb.variables[key][indexes] = value.to(rb.device)
+        rb.position = self.nb_saved % rb.max_size
+        rb.is_full = self.nb_saved >= rb.max_size
+
+
+class ReplayableEnv(gymnasium.Wrapper):
+    """
+    Records the random state of the environment at each reset and the actions since,
+    so that its current episode can be rebuilt in another process by replaying them
+    (many environments, e.g. the Box2D ones, cannot be copied)
+    """
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.episode = None
+
+    def reset(self, *, seed=None, options=None):
+        np_random = self.unwrapped._np_random
+        self.episode = {
+            "seed": seed,
+            "options": options,
+            "np_random": None if np_random is None else np_random.bit_generator.state,
+            "actions": [],
+        }
+        return self.env.reset(seed=seed, options=options)
+
+    def step(self, action):
+        self.episode["actions"].append(copy.deepcopy(action))
+        return self.env.step(action)
+
+    def replay(self, episode):
+        if episode["np_random"] is not None:
+            self.unwrapped.np_random.bit_generator.state = episode["np_random"]
+        self.reset(seed=episode["seed"], options=episode["options"])
+        for action in episode["actions"]:
+            self.step(action)
+
+
+def replayable_envs(env_agent):
+    """The ReplayableEnv wrapper of each environment of a ParallelGymAgent, or None"""
+    envs = []
+    for env in env_agent.envs:
+        while not isinstance(env, ReplayableEnv):
+            if not isinstance(env, gymnasium.Wrapper):
+                return None
+            env = env.env
+        envs.append(env)
+    return envs
+
+
+def env_agent_state(env_agent):
+    """The counters of a ParallelGymAgent, and its current episodes if they are recorded"""
+    envs = replayable_envs(env_agent)
+    return {
+        "timestep": env_agent._timestep.clone(),
+        "cumulated_reward": dict(env_agent.cumulated_reward),
+        "timestep_from_reset": env_agent._timestep_from_reset,
+        "nb_reset": env_agent._nb_reset,
+        "last_frame": copy.deepcopy(env_agent._last_frame),
+        "episodes": None if envs is None else [env.episode for env in envs],
+    }
+
+
+def load_env_agent_state(env_agent, state):
+    """Restores the counters of the agent, returns True if its episodes were replayed"""
+    env_agent._timestep = state["timestep"]
+    env_agent.cumulated_reward = state["cumulated_reward"]
+    env_agent._timestep_from_reset = state["timestep_from_reset"]
+    env_agent._nb_reset = state["nb_reset"]
+    env_agent._last_frame = state["last_frame"]
+    envs = replayable_envs(env_agent)
+    if envs is None or state["episodes"] is None or None in state["episodes"]:
+        return False
+    for env, episode in zip(envs, state["episodes"]):
+        env.replay(episode)
+    return True
+
+
+def rng_state():
+    return {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+
+
+def save_checkpoint(path, state):
+    """Saves the state (a dict) into a temporary file, renamed once it is complete"""
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def remove_checkpoint(path):
+    """Deletes the checkpoint path, and its replay segments if there are some"""
+    if os.path.exists(path):
+        os.remove(path)
+    shutil.rmtree(path + ".replay", ignore_errors=True)
+
+
+def load_checkpoint(path):
+    """Returns the state saved into path, None if there is no checkpoint yet"""
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, weights_only=False)
+
+
+def snapshot(value):
+    """A copy of the tensors (on the CPU) and arrays of a nested state"""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+
+class CheckpointManager:
+    """
+    Keeps the top_k best checkpoints of a run into dirname, ranked by score.
+    save copies the state dicts into memory and returns, the files are written by a
+    background thread (into a temporary file, then renamed), which also deletes the
+    checkpoints out of the top k and maintains an index of the kept ones.
+    The states of the optimizers and the replay buffer are only saved on demand.
+    """
+
+    def __init__(self, dirname, prefix, top_k=1, optimizers=False, replay_buffer=False):
+        self.dirname = dirname
+        self.prefix = prefix
+        self.top_k = top_k
+        self.with_optimizers = optimizers
+        self.with_replay_buffer = replay_buffer
+        self.index_path = os.path.join(dirname, prefix + "index.json")
+        os.makedirs(dirname, exist_ok=True)
+        # The kept checkpoints of a previous run of the same prefix, best first
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.entries = [
+                    entry
+                    for entry in json.load(file)
+                    if os.path.exists(os.path.join(dirname, entry["filename"]))
+                ]
+        # At most two snapshots wait for the disk, then save blocks
+        self.queue = queue.Queue(maxsize=2)
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def from_config(cfg, dirname, prefix):
+        """The options are read from cfg.best_checkpoints (top_k, optimizers, replay_buffer)"""
+        options = dict(cfg.best_checkpoints) if "best_checkpoints" in cfg else {}
+        return CheckpointManager(dirname, prefix, **options)
+
+    def is_kept(self, score):
+        return len(self.entries) < self.top_k or score > self.entries[-1]["score"]
+
+    def save(self, score, nb_steps, models, optimizers=None, replay_buffer=None):
+        """
+        Checkpoints the models (a dict of name -> module) if score is in the top k,
+        returns the path of the checkpoint, None otherwise
+        """
+        self._raise_error()
+        score = float(score)
+        if not self.is_kept(score):
+            return None
+        state = {
+            "score": score,
+            "nb_steps": nb_steps,
+            "models": {name: model.state_dict() for name, model in models.items()},
+        }
+        if self.with_optimizers:
+            optimizers = optimizers or {}
+            state["optimizers"] = {
+                name: optimizer.state_dict() for name, optimizer in optimizers.items()
+            }
+        if self.with_replay_buffer and replay_buffer is not None:
+            state["replay_buffer"] = replay_buffer_state(replay_buffer)
+
+        filename = f"{self.prefix}{score:.4f}_{nb_steps}.ckpt"
+        self.entries.append(
+            {"score": score, "nb_steps": nb_steps, "filename": filename}
+        )
+        self.entries.sort(key=lambda entry: entry["score"], reverse=True)
+        removed = [entry["filename"] for entry in self.entries[self.top_k :]]
+        self.entries = self.entries[: self.top_k]
+        self.queue.put((filename, snapshot(state), removed, list(self.entries)))
+        return os.path.join(self.dirname, filename)
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None and self.error is None:
+                    filename, state, removed, entries = item
+                    save_checkpoint(os.path.join(self.dirname, filename), state)
+                    for name in removed:
+                        path = os.path.join(self.dirname, name)
+                        if os.path.exists(path):
+                            os.remove(path)
+                    with open(self.index_path + ".tmp", "w") as file:
+                        json.dump(entries, file, indent=2)
+                    os.replace(self.index_path + ".tmp", self.index_path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def wait(self):
+        """Waits until the pending checkpoints are written"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def best_path(self):
+        """The path of the best checkpoint written so far, None if there is none"""
+        self.wait()
+        if len(self.entries) == 0:
+            return None
+        return os.path.join(self.dirname, self.entries[0]["filename"])
+
+    def restore(self, path=None, models=None, optimizers=None, replay_buffer=None):
+        """
+        Loads the checkpoint path (by default the best one) into the models, the
+        optimizers and the replay buffer given, returns its state
+        """
+        models = models or {}
+        optimizers = optimizers or {}
+        self.wait()
+        path = path or self.best_path()
+        # The tensors are mapped from the file, and only read when they are used
+        state = torch.load(path, mmap=True, weights_only=False)
+        for name, model in models.items():
+            model.load_state_dict(state["models"][name])
+        for name, optimizer in optimizers.items():
+            optimizer.load_state_dict(state["optimizers"][name])
+        if replay_buffer is not None:
+            load_replay_buffer_state(replay_buffer, state["replay_buffer"])
+        return state
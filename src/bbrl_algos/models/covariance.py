@@ -0,0 +1,165 @@
+"""
+Covariance models of the sampling distribution of CEM.
+They all sample the whole population in one batched operation and share the same interface:
+update_noise(), generate_weights(centroid, pop_size), update_covariance(elite_weights)
+and get_distribution(centroid), the sampling distribution as a torch distribution.
+The full matrix costs O(d^2) memory and O(d^3) per generation, the other models
+are linear in the number of parameters d, so that CEM can be used on larger networks.
+"""
+
+import math
+
+import torch
+from torch.distributions import (
+    Independent,
+    LowRankMultivariateNormal,
+    MultivariateNormal,
+    Normal,
+)
+
+
+class CovMatrix:
+    """Full (d x d) covariance matrix, plus a diagonal noise"""
+
+    def __init__(self, centroid: torch.Tensor, sigma, noise_multiplier):
+        policy_dim = centroid.size()[0]
+        self.noise = torch.diag(torch.ones(policy_dim) * sigma)
+        self.cov = torch.diag(torch.ones(policy_dim) * torch.var(centroid)) + self.noise
+        self.noise_multiplier = noise_multiplier
+
+    def update_noise(self) -> None:
+        self.noise = self.noise * self.noise_multiplier
+
+    def get_distribution(self, centroid):
+        return MultivariateNormal(centroid, covariance_matrix=self.cov)
+
+    def generate_weights(self, centroid, pop_size):
+        return self.get_distribution(centroid).sample((pop_size,))
+
+    def update_covariance(self, elite_weights) -> None:
+        self.cov = torch.cov(elite_weights.T) + self.noise
+
+
+class DiagonalCovMatrix:
+    """Diagonal covariance: the variance of each parameter of the elites, plus a noise"""
+
+    def __init__(self, centroid: torch.Tensor, sigma, noise_multiplier):
+        policy_dim = centroid.size()[0]
+        self.noise = torch.ones(policy_dim) * sigma
+        self.var = torch.ones(policy_dim) * torch.var(centroid) + self.noise
+        self.noise_multiplier = noise_multiplier
+
+    def update_noise(self) -> None:
+        self.noise = self.noise * self.noise_multiplier
+
+    def get_distribution(self, centroid):
+        return Independent(Normal(centroid, self.var.sqrt()), 1)
+
+    def generate_weights(self, centroid, pop_size):
+        return self.get_distribution(centroid).sample((pop_size,))
+
+    def update_covariance(self, elite_weights) -> None:
+        self.var = elite_weights.var(dim=0) + self.noise
+
+
+class LowRankCovMatrix:
+    """
+    Diagonal plus rank-k covariance D + U U^T, with U of size (d x k)
+    U holds the k main directions of the elites, D their residual variance plus a noise
+    """
+
+    def __init__(self, centroid: torch.Tensor, sigma, noise_multiplier, rank=10):
+        policy_dim = centroid.size()[0]
+        self.noise = torch.ones(policy_dim) * sigma
+        self.var = torch.ones(policy_dim) * torch.var(centroid) + self.noise
+        # torch needs a factor of rank 1 at least
+        self.factor = torch.zeros(policy_dim, 1)
+        self.noise_multiplier = noise_multiplier
+        self.rank = rank
+
+    def update_noise(self) -> None:
+        self.noise = self.noise * self.noise_multiplier
+
+    def get_distribution(self, centroid):
+        # Sampling costs O(d k), the log density O(d k^2)
+        return LowRankMultivariateNormal(centroid, self.factor, self.var)
+
+    def generate_weights(self, centroid, pop_size):
+        return self.get_distribution(centroid).sample((pop_size,))
+
+    def update_covariance(self, elite_weights) -> None:
+        # The empirical covariance is deviations^T deviations, of rank < nb of elites
+        nb_elites = elite_weights.size(0)
+        deviations = (elite_weights - elite_weights.mean(dim=0)) / math.sqrt(
+            max(nb_elites - 1, 1)
+        )
+        # (nb_elites x d) SVD, which costs O(d nb_elites^2)
+        _, singular_values, directions = torch.linalg.svd(
+            deviations, full_matrices=False
+        )
+        rank = min(self.rank, singular_values.size(0))
+        self.factor = directions[:rank].T * singular_values[:rank]
+        residual = (deviations**2).sum(dim=0) - (self.factor**2).sum(dim=1)
+        self.var = residual.clamp(min=0.0) + self.noise
+
+
+class SepCMACovMatrix:
+    """
+    Separable CMA-ES (Ros & Hansen, 2008): a diagonal covariance adapted
+    with an evolution path, times a global step size adapted by cumulation
+    The elites have the same weight, as the centroid of CEM is their mean.
+    The step size adaptation replaces the noise, so noise_multiplier is not used.
+    """
+
+    def __init__(self, centroid: torch.Tensor, sigma, noise_multiplier):
+        policy_dim = centroid.size()[0]
+        self.dim = policy_dim
+        self.step_size = math.sqrt(torch.var(centroid).item() + sigma)
+        self.var = torch.ones(policy_dim)
+        self.path_c = torch.zeros(policy_dim)
+        self.path_sigma = torch.zeros(policy_dim)
+        self.mean = None
+        # E||N(0, I)||
+        self.expected_norm = math.sqrt(policy_dim) * (
+            1 - 1 / (4 * policy_dim) + 1 / (21 * policy_dim**2)
+        )
+
+    def update_noise(self) -> None:
+        pass
+
+    def get_distribution(self, centroid):
+        # The elites of the next update come from this distribution
+        self.mean = centroid.clone()
+        return Independent(Normal(centroid, self.step_size * self.var.sqrt()), 1)
+
+    def generate_weights(self, centroid, pop_size):
+        return self.get_distribution(centroid).sample((pop_size,))
+
+    def update_covariance(self, elite_weights) -> None:
+        mu = elite_weights.size(0)
+        dim = self.dim
+        c_sigma = (mu + 2) / (dim + mu + 5)
+        d_sigma = 1 + 2 * max(0.0, math.sqrt((mu - 1) / (dim + 1)) - 1) + c_sigma
+        c_c = 4 / (dim + 4)
+        # The learning rates of the separable version are (dim + 2) / 3 times larger
+        c_1 = 2 / ((dim + 1.3) ** 2 + mu) * (dim + 2) / 3
+        c_mu = min(
+            1 - c_1, 2 * (mu - 2 + 1 / mu) / ((dim + 2) ** 2 + mu) * (dim + 2) / 3
+        )
+
+        steps = (elite_weights - self.mean) / self.step_size
+        mean_step = steps.mean(dim=0)
+        self.path_sigma = (1 - c_sigma) * self.path_sigma + math.sqrt(
+            c_sigma * (2 - c_sigma) * mu
+        ) * mean_step / self.var.sqrt()
+        self.path_c = (1 - c_c) * self.path_c + math.sqrt(
+            c_c * (2 - c_c) * mu
+        ) * mean_step
+        self.var = (
+            (1 - c_1 - c_mu) * self.var
+            + c_1 * self.path_c**2
+            + c_mu * (steps**2).mean(dim=0)
+        )
+        self.step_size *= math.exp(
+            c_sigma / d_sigma * (self.path_sigma.norm().item() / self.expected_norm - 1)
+        )
@@ -72,6 +72,9 @@ class VAgent(NamedCritic):
         critic = self.model(observation).squeeze(-1)
         self.set((f"{self.name}/v_values", t), critic)
 
+    def predict_value(self, obs):
+        return self.model(obs).squeeze(-1)
+
 
 class DiscreteQAgent(NamedCritic):
     def __init__(
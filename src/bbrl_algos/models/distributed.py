@@ -0,0 +1,123 @@
+"""
+Synchronous data-parallel training of the on-policy algorithms (A2C, PPO)
+with torch.distributed, on the gloo backend and on localhost.
+
+Each process (rank) runs its own environments and collects its own rollout,
+the gradients computed on these shards are averaged over the ranks before every
+optimizer step, so that all the ranks keep identical parameters and optimizers.
+Only the rank 0 evaluates, logs and saves the agents.
+Outside of a distributed run, the helpers below do nothing.
+"""
+
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from bbrl_algos.models.loggers import Logger, NullLogger
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def _optimizer_parameters(optimizer):
+    return [param for group in optimizer.param_groups for param in group["params"]]
+
+
+def broadcast_parameters(optimizer):
+    """Copies the parameters of the rank 0 to all the ranks"""
+    if not dist.is_initialized():
+        return
+    for param in _optimizer_parameters(optimizer):
+        dist.broadcast(param.data, src=0)
+
+
+def all_reduce_gradients(optimizer):
+    """
+    Averages the gradients of the parameters of the optimizer over the ranks,
+    in a single all-reduce of the flattened gradients
+    The parameters without a gradient are the same on all the ranks and are skipped.
+    """
+    if not dist.is_initialized():
+        return
+    grads = [
+        param.grad
+        for param in _optimizer_parameters(optimizer)
+        if param.grad is not None
+    ]
+    if len(grads) == 0:
+        return
+    flat_grads = torch.cat([grad.flatten() for grad in grads])
+    dist.all_reduce(flat_grads)
+    flat_grads /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat_grads[offset : offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def sum_over_ranks(value):
+    """Sums an integer (e.g. a number of steps) over the ranks"""
+    if not dist.is_initialized():
+        return value
+    total = torch.tensor(value, dtype=torch.long)
+    dist.all_reduce(total)
+    return int(total)
+
+
+def min_over_ranks(value):
+    """The minimum of an integer (e.g. a number of transitions) over the ranks"""
+    if not dist.is_initialized():
+        return value
+    minimum = torch.tensor(value, dtype=torch.long)
+    dist.all_reduce(minimum, op=dist.ReduceOp.MIN)
+    return int(minimum)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _run_rank(rank, world_size, port, cfg, run_func):
+    # The ranks share the cores, each one runs single-threaded
+    torch.set_num_threads(1)
+    dist.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=world_size,
+    )
+    # Each rank collects different transitions: the seeds of its environments
+    # and of its action sampling are shifted by its rank
+    cfg.algorithm.seed.train += rank
+    cfg.algorithm.seed.torch += rank
+    torch.random.manual_seed(seed=cfg.algorithm.seed.torch)
+
+    logger = Logger(cfg) if rank == 0 else NullLogger()
+    try:
+        run_func(cfg, logger)
+    finally:
+        logger.close()
+        dist.destroy_process_group()
+
+
+def launch_distributed(cfg, run_func):
+    """
+    Runs run_func(cfg, logger) in cfg.algorithm.n_processes processes,
+    each one with cfg.algorithm.n_envs training environments
+    """
+    world_size = cfg.algorithm.n_processes
+    mp.spawn(
+        _run_rank,
+        args=(world_size, _free_port(), cfg, run_func),
+        nprocs=world_size,
+        join=True,
+    )
@@ -0,0 +1,118 @@
+"""
+Closed-form kernels for the policy distributions used by the stochastic actors.
+They compute samples, log probabilities and entropies directly from the
+distribution parameters, without building torch.distributions objects.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+HALF_LOG_2PI = 0.5 * math.log(2 * math.pi)
+LOG_2 = math.log(2.0)
+
+
+# Categorical distributions, parameterized by log probabilities (log_softmax of the scores)
+
+
+def categorical_sample(log_probs: torch.Tensor) -> torch.Tensor:
+    probs = log_probs.detach().exp()
+    samples = torch.multinomial(probs.reshape(-1, probs.size(-1)), 1, True)
+    return samples.reshape(probs.shape[:-1])
+
+
+def categorical_log_prob(log_probs: torch.Tensor, action: torch.Tensor) -> torch.Tensor:
+    return log_probs.gather(-1, action.long().unsqueeze(-1)).squeeze(-1)
+
+
+def categorical_entropy(log_probs: torch.Tensor) -> torch.Tensor:
+    return -(log_probs.exp() * log_probs).sum(-1)
+
+
+def categorical_kl(
+    log_probs_p: torch.Tensor, log_probs_q: torch.Tensor
+) -> torch.Tensor:
+    """KL(p || q)"""
+    return (log_probs_p.exp() * (log_probs_p - log_probs_q)).sum(-1)
+
+
+# Diagonal Gaussian distributions, the last dimension holds the action dimensions
+
+
+def gaussian_sample(
+    mean: torch.Tensor, std: torch.Tensor, reparameterize=False
+) -> torch.Tensor:
+    """Samples mean + std * eps, with a gradient only if reparameterize is True"""
+    if reparameterize:
+        return mean + std * torch.randn_like(mean)
+    with torch.no_grad():
+        return mean + std * torch.randn_like(mean)
+
+
+def gaussian_log_prob(
+    mean: torch.Tensor, std: torch.Tensor, value: torch.Tensor
+) -> torch.Tensor:
+    z = (value - mean) / std
+    return (-0.5 * z**2 - torch.log(std) - HALF_LOG_2PI).sum(-1)
+
+
+def gaussian_entropy(mean: torch.Tensor, std: torch.Tensor) -> torch.Tensor:
+    return (0.5 + HALF_LOG_2PI + torch.log(std)).expand_as(mean).sum(-1)
+
+
+def gaussian_kl(
+    mean_p: torch.Tensor, std_p: torch.Tensor, mean_q: torch.Tensor, std_q: torch.Tensor
+) -> torch.Tensor:
+    """KL(p || q)"""
+    var_ratio = (std_p / std_q) ** 2
+    t = ((mean_p - mean_q) / std_q) ** 2
+    return 0.5 * (var_ratio + t - 1.0 - torch.log(var_ratio)).sum(-1)
+
+
+# Gaussian distributions squashed by a tanh
+
+
+def tanh_log_det(gaussian_action: torch.Tensor) -> torch.Tensor:
+    """log|det d tanh(u)/du| = sum log(1 - tanh(u)^2), computed without cancellation"""
+    u = gaussian_action
+    return (2.0 * (LOG_2 - u - F.softplus(-2.0 * u))).sum(-1)
+
+
+def squashed_gaussian_sample(mean: torch.Tensor, std: torch.Tensor):
+    """Reparameterized sample, returns the squashed action and the Gaussian one"""
+    gaussian_action = gaussian_sample(mean, std, reparameterize=True)
+    return torch.tanh(gaussian_action), gaussian_action
+
+
+def squashed_gaussian_log_prob(
+    mean: torch.Tensor, std: torch.Tensor, action=None, gaussian_action=None
+) -> torch.Tensor:
+    """
+    Log probability of a squashed action
+    If the Gaussian action is not given, it is recovered by inverting the tanh
+    """
+    if gaussian_action is None:
+        eps = torch.finfo(action.dtype).eps
+        gaussian_action = torch.atanh(action.clamp(-1.0 + eps, 1.0 - eps))
+    return gaussian_log_prob(mean, std, gaussian_action) - tanh_log_det(gaussian_action)
+
+
+# Bernoulli distributions, parameterized by the probability of drawing 1
+
+
+def bernoulli_sample(probs: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+        return torch.bernoulli(probs)
+
+
+def bernoulli_log_prob(probs: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    eps = torch.finfo(probs.dtype).eps
+    p = probs.clamp(eps, 1.0 - eps)
+    return value * torch.log(p) + (1.0 - value) * torch.log1p(-p)
+
+
+def bernoulli_entropy(probs: torch.Tensor) -> torch.Tensor:
+    eps = torch.finfo(probs.dtype).eps
+    p = probs.clamp(eps, 1.0 - eps)
+    return -(p * torch.log(p) + (1.0 - p) * torch.log1p(-p))
@@ -0,0 +1,206 @@
+"""
+Training several seeds of an algorithm at once, in a single process.
+
+An Ensemble holds S independent copies (the members) of a network, with their parameters
+stacked along a leading dimension of size S, and runs the S members in one vmapped call.
+A single optimizer over the stacked parameters is equivalent to one optimizer per member
+when it is elementwise (Adam, SGD...), provided that the loss is the sum of the losses
+of the members and that the gradients are clipped per member.
+
+The member i interacts with the i-th block of n_envs environments among S x n_envs ones,
+stores its transitions in its own replay buffer, and has its own logger and stats file.
+"""
+
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+from bbrl.agents import TimeAgent
+from bbrl.utils.replay_buffer import ReplayBuffer
+from bbrl.workspace import Workspace
+
+from bbrl_algos.models.stats import StatsWriter
+
+
+def split_members(x, nb_members, dim=0):
+    """Moves the blocks of the members along dim to a leading dimension of size nb_members"""
+    return x.unflatten(dim, (nb_members, -1)).movedim(dim, 0)
+
+
+def merge_members(x, dim=0):
+    """Inverse of split_members"""
+    return x.movedim(0, dim).flatten(dim, dim + 1)
+
+
+def member_mean(values, mask=None):
+    """Mean of the (S x ...) values of each member, over the entries selected by the mask"""
+    if mask is None:
+        return values.flatten(1).mean(dim=1)
+    values = torch.where(mask, values, torch.zeros_like(values))
+    return values.flatten(1).sum(dim=1) / mask.flatten(1).sum(dim=1).clamp(min=1)
+
+
+class _MethodCall(nn.Module):
+    """Calls a method of the module, so that functional_call can run any of them"""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, method, *inputs, **kwargs):
+        return getattr(self.module, method)(*inputs, **kwargs)
+
+
+class Ensemble(nn.Module):
+    """S copies of a module (without buffers), with stacked (S x ...) parameters"""
+
+    def __init__(self, modules):
+        super().__init__()
+        self.size = len(modules)
+        params, buffers = stack_module_state(modules)
+        assert len(buffers) == 0, "The members of an ensemble cannot have buffers"
+        self.names = list(params.keys())
+        self.stacked = nn.ParameterList(
+            [nn.Parameter(params[name].detach()) for name in self.names]
+        )
+        # The parameters of this copy are replaced by the stacked ones at each call,
+        # it is not registered as a submodule so that it has no parameters of its own
+        self.__dict__["base"] = _MethodCall(copy.deepcopy(modules[0]).to("meta"))
+
+    def call_stacked(self, method, *inputs, **kwargs):
+        """Runs the method of the member i on the i-th slice of each (S x ...) input"""
+        params = {
+            "module." + name: param for name, param in zip(self.names, self.stacked)
+        }
+
+        def member_call(member_params, *member_inputs):
+            return functional_call(
+                self.base, member_params, (method, *member_inputs), kwargs
+            )
+
+        return vmap(member_call, randomness="different")(params, *inputs)
+
+    def call(self, method, *inputs, dim=0, **kwargs):
+        """
+        Runs the method of the member i on the i-th of the S blocks of each input along dim,
+        the outputs of the members are concatenated along the same dimension
+        """
+        outputs = self.call_stacked(
+            method, *[split_members(x, self.size, dim) for x in inputs], **kwargs
+        )
+        if isinstance(outputs, tuple):
+            return tuple(merge_members(output, dim) for output in outputs)
+        return merge_members(outputs, dim)
+
+
+def clip_grad_norm_per_member(parameters, max_norm):
+    """clip_grad_norm_ applied to the gradient of each member separately"""
+    grads = [param.grad for param in parameters if param.grad is not None]
+    norms = torch.stack([grad.flatten(1).norm(dim=1) for grad in grads]).norm(dim=0)
+    scales = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+    for grad in grads:
+        grad.mul_(scales.view(-1, *[1] * (grad.dim() - 1)))
+    return norms
+
+
+class EnsembleAgent(TimeAgent):
+    """
+    Runs a method of the members on the observations of S x n_envs environments,
+    and writes its outputs into the output variable
+    """
+
+    def __init__(self, ensemble, method, output, **method_kwargs):
+        super().__init__()
+        self.ensemble = ensemble
+        self.method = method
+        self.output = output
+        self.method_kwargs = method_kwargs
+
+    def forward(self, t, **kwargs):
+        obs = self.get(("env/env_obs", t))
+        outputs = self.ensemble.call(self.method, obs, **self.method_kwargs)
+        self.set((self.output, t), outputs)
+
+
+class EnsembleReplayBuffer:
+    """One replay buffer per member, filled with the transitions of its own environments"""
+
+    def __init__(self, nb_members, max_size):
+        self.buffers = [ReplayBuffer(max_size=max_size) for _ in range(nb_members)]
+
+    def put(self, workspace, filter_key="env/done"):
+        """
+        Stores the rollout of the S x n_envs environments
+        :return: the mean number of transitions of a member
+        """
+        nb_members = len(self.buffers)
+        nb_transitions = 0
+        for index, rb in enumerate(self.buffers):
+            member_workspace = Workspace()
+            for key in workspace.keys():
+                member_workspace.set_full(
+                    key, split_members(workspace[key], nb_members, dim=1)[index]
+                )
+            transitions = member_workspace.get_transitions(filter_key=filter_key)
+            rb.put(transitions)
+            nb_transitions += transitions["env/done"].size(1)
+        return nb_transitions // nb_members
+
+    def size(self):
+        return min(rb.size() for rb in self.buffers)
+
+    def get_shuffled(self, batch_size):
+        """Samples batch_size transitions per member, the member i gets the i-th block"""
+        samples = [rb.get_shuffled(batch_size) for rb in self.buffers]
+        workspace = Workspace()
+        for key in samples[0].keys():
+            workspace.set_full(
+                key, torch.cat([sample.get_full(key) for sample in samples], dim=1)
+            )
+        return workspace
+
+
+def ensemble_env_config(cfg):
+    """The configuration of the S x n_envs training and S x nb_evals evaluation environments"""
+    env_cfg = cfg.copy()
+    env_cfg.algorithm.n_envs = cfg.algorithm.n_envs * cfg.algorithm.nb_seeds
+    env_cfg.algorithm.nb_evals = cfg.algorithm.nb_evals * cfg.algorithm.nb_seeds
+    return env_cfg
+
+
+def member_config(cfg, index):
+    """The configuration of the member index: its torch seed is shifted by index,
+    and it logs into its own directory"""
+    member_cfg = cfg.copy()
+    member_cfg.algorithm.seed.torch = cfg.algorithm.seed.torch + index
+    if "log_dir" in member_cfg.logger:
+        member_cfg.logger.log_dir = os.path.join(cfg.logger.log_dir, f"seed_{index}")
+    return member_cfg
+
+
+class MemberStatsWriter:
+    """
+    Streams the evaluations of each member into its own stats file (see models/stats.py),
+    directory/<fileroot>_<env_name>_seed<i>.stats, as collect_stats does for a single run
+    """
+
+    def __init__(self, directory, fileroot, env_name, nb_members, nb_episodes):
+        self.writers = [
+            StatsWriter(
+                os.path.join(directory, f"{fileroot}_{env_name}_seed{index}.stats"),
+                nb_episodes,
+            )
+            for index in range(nb_members)
+        ]
+
+    def write(self, nb_steps, rewards):
+        """Appends an evaluation: the (nb_members x nb_episodes) rewards of its episodes"""
+        for writer, member_rewards in zip(self.writers, rewards):
+            writer.write(nb_steps, member_rewards)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
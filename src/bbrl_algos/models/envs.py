@@ -4,6 +4,9 @@ import gym
 # import bbrl_gymnasium is necessary to see the bbrl_gymnasium environments
 import bbrl_gymnasium
 
+# registers the synthetic environments of the benchmarks
+from bbrl_algos.models.synthetic_env import SyntheticEnvAgent, is_synthetic_env
+
 # import gym_torcs
 
 from bbrl import get_arguments, get_class
@@ -17,14 +20,56 @@ from bbrl_algos.wrappers.env_wrappers import MazeMDPContinuousWrapper
 assets_path = os.getcwd() + "/../../assets/"
 
 
+def make_env_agent(
+    cfg, n_envs, seed, *, autoreset=False, include_last_state=True, wrappers=None
+) -> GymAgent:
+    """
+    Runs n_envs environments cfg.gym_env.env_name, created with the optional
+    arguments cfg.gym_env.make_env_args. The synthetic environments are stepped at once
+    """
+    if wrappers is None:
+        wrappers = []
+    if "make_env_args" in cfg.gym_env:
+        make_env_args = dict(cfg.gym_env.make_env_args)
+    else:
+        make_env_args = {}
+    if is_synthetic_env(cfg.gym_env.env_name) and len(wrappers) == 0:
+        return SyntheticEnvAgent(
+            cfg.gym_env.env_name,
+            n_envs,
+            autoreset=autoreset,
+            include_last_state=include_last_state,
+            make_env_args=make_env_args,
+            seed=seed,
+        )
+    return ParallelGymAgent(
+        partial(
+            make_env,
+            cfg.gym_env.env_name,
+            autoreset=autoreset,
+            wrappers=wrappers,
+            **make_env_args,
+        ),
+        n_envs,
+        include_last_state=include_last_state,
+        seed=seed,
+    )
+
+
 def get_eval_env_agent(cfg):
-    eval_env_agent = ParallelGymAgent(
-        partial(make_env, cfg.gym_env.env_name, autoreset=False),
-        cfg.algorithm.n_envs_eval,
-        include_last_state=True,
-        seed=cfg.algorithm.seed.eval,
+    # The CEM configs give the number of evaluation episodes as nb_evals
+    if "n_envs_eval" in cfg.algorithm:
+        n_envs = cfg.algorithm.n_envs_eval
+    else:
+        n_envs = cfg.algorithm.nb_evals
+    return make_env_agent(cfg, n_envs, cfg.algorithm.seed.eval)
+
+
+def get_population_eval_env_agent(cfg, nb_individuals):
+    # nb_evals environments for each individual of the population, evaluated together
+    return make_env_agent(
+        cfg, nb_individuals * cfg.algorithm.nb_evals, cfg.algorithm.seed.eval
     )
-    return eval_env_agent
 
 
 def get_eval_env_agent_rich(cfg):
@@ -62,38 +107,40 @@ def get_env_agents(
 
     # Train environment
     if xml_file is None:
-        train_env_agent = ParallelGymAgent(
-            partial(
-                make_env, cfg.gym_env.env_name, autoreset=autoreset, wrappers=wrappers
-            ),
+        train_env_agent = make_env_agent(
+            cfg,
             cfg.algorithm.n_envs,
+            cfg.algorithm.seed.train,
+            autoreset=autoreset,
             include_last_state=include_last_state,
-            seed=cfg.algorithm.seed.train,
+            wrappers=wrappers,
         )
 
         # Test environment (implictly, autoreset=False, which is always the case for evaluation environments)
-        eval_env_agent = ParallelGymAgent(
-            partial(make_env, cfg.gym_env.env_name, wrappers=wrappers),
+        eval_env_agent = make_env_agent(
+            cfg,
             cfg.algorithm.nb_evals,
+            cfg.algorithm.seed.eval,
             include_last_state=include_last_state,
-            seed=cfg.algorithm.seed.eval,
+            wrappers=wrappers,
         )
     else:
-        train_env_agent = ParallelGymAgent(
-            partial(
-                make_env, cfg.gym_env.env_name, autoreset=autoreset, wrappers=wrappers
-            ),
+        train_env_agent = make_env_agent(
+            cfg,
             cfg.algorithm.n_envs,
+            cfg.algorithm.seed.train,
+            autoreset=autoreset,
             include_last_state=include_last_state,
-            seed=cfg.algorithm.seed.train,
+            wrappers=wrappers,
         )
 
         # Test environment (implictly, autoreset=False, which is always the case for evaluation environments)
-        eval_env_agent = ParallelGymAgent(
-            partial(make_env, cfg.gym_env.env_name, wrappers=wrappers),
+        eval_env_agent = make_env_agent(
+            cfg,
             cfg.algorithm.nb_evals,
+            cfg.algorithm.seed.eval,
             include_last_state=include_last_state,
-            seed=cfg.algorithm.seed.eval,
+            wrappers=wrappers,
         )
 
     return train_env_agent, eval_env_agent
@@ -0,0 +1,156 @@
+"""
+Building blocks of the OpenAI-ES style evolution strategies (Salimans et al., 2017):
+antithetic Gaussian perturbations taken from a shared noise table, rank-based fitness shaping,
+and evaluators of the perturbations. A perturbation is identified by its offset in the
+noise table, so the workers only receive offsets and send back scalar returns.
+"""
+
+import copy
+
+import torch
+import torch.multiprocessing as mp
+
+from bbrl.agents import Agents
+
+from bbrl_algos.models.envs import get_eval_env_agent
+from bbrl_algos.models.population_eval import evaluate_individual
+from bbrl_algos.models.rollout import make_temporal_agent
+
+
+class NoiseTable:
+    """A block of Gaussian noise generated from a seed, in shared memory"""
+
+    def __init__(self, size, seed):
+        generator = torch.Generator().manual_seed(seed)
+        self.noise = torch.randn(size, generator=generator).share_memory_()
+
+    def sample_offsets(self, nb_offsets, dim):
+        return torch.randint(0, len(self.noise) - dim + 1, (nb_offsets,))
+
+    def get(self, offset, dim):
+        return self.noise[offset : offset + dim]
+
+    def get_batch(self, offsets, dim):
+        """Returns the (nb_offsets x dim) perturbations"""
+        return torch.stack([self.get(offset, dim) for offset in offsets])
+
+
+def centered_ranks(returns):
+    """Replaces the returns by their ranks, scaled into [-0.5, 0.5]"""
+    flat = returns.flatten()
+    ranks = torch.empty_like(flat)
+    ranks[flat.argsort()] = torch.arange(len(flat), dtype=flat.dtype)
+    return (ranks / max(len(flat) - 1, 1) - 0.5).view_as(returns)
+
+
+def es_gradient(noise_table, offsets, returns, dim, sigma):
+    """
+    Estimates the gradient of the expected return from the (nb_offsets x 2) returns
+    of the antithetic pairs theta + sigma eps, theta - sigma eps:
+    sum_i (F(theta + sigma eps_i) - F(theta - sigma eps_i)) eps_i / (2 n sigma)
+    """
+    shaped = centered_ranks(returns)
+    pair_weights = shaped[:, 0] - shaped[:, 1]
+    noise = noise_table.get_batch(offsets.tolist(), dim)
+    return pair_weights @ noise / (returns.numel() * sigma)
+
+
+class BatchedESEvaluator:
+    """Evaluates the antithetic pairs in the current process, with a PopulationEvaluator"""
+
+    def __init__(self, evaluator, noise_table):
+        self.evaluator = evaluator
+        self.noise_table = noise_table
+
+    def evaluate(self, theta, offsets, sigma):
+        """Returns the (nb_offsets x 2) mean rewards of the pairs and their total length"""
+        noise = self.noise_table.get_batch(offsets.tolist(), len(theta))
+        weights = torch.cat((theta + sigma * noise, theta - sigma * noise))
+        rewards, steps = self.evaluator.evaluate(weights)
+        return rewards.view(2, -1).T, steps.view(2, -1).sum(dim=0)
+
+    def close(self):
+        self.evaluator.close()
+
+
+def _es_worker(cfg, actor, theta, noise, tasks, results):
+    """Evaluates the antithetic pairs received from the tasks queue until it gets None"""
+    # The workers share the cores, each one runs single-threaded
+    torch.set_num_threads(1)
+    env_agent = get_eval_env_agent(cfg)
+    eval_agent = make_temporal_agent(Agents(env_agent, actor), requires_grad=False)
+    dim = len(theta)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, offset, sigma, nb_evaluations = task
+        perturbation = sigma * noise[offset : offset + dim]
+        reward_pos, steps_pos = evaluate_individual(
+            eval_agent, env_agent, actor, theta + perturbation, nb_evaluations
+        )
+        reward_neg, steps_neg = evaluate_individual(
+            eval_agent, env_agent, actor, theta - perturbation, nb_evaluations + 1
+        )
+        results.put(
+            (index, float(reward_pos), float(reward_neg), steps_pos + steps_neg)
+        )
+
+
+class ESWorkerPool:
+    """
+    Evaluates the antithetic pairs in long-lived worker processes,
+    each one with its own evaluation env agent (nb_evals environments)
+
+    The parameters theta and the noise table are in shared memory,
+    so a task is an offset in the noise table and a result is a pair of returns.
+    The results do not depend on the number of workers nor on the order of the evaluations.
+    """
+
+    def __init__(self, cfg, actor, noise_table, n_workers):
+        self.nb_evaluations = 0
+        dim = sum(p.numel() for p in actor.parameters())
+        self.theta = torch.zeros(dim).share_memory_()
+
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_es_worker,
+                args=(
+                    cfg,
+                    copy.deepcopy(actor),
+                    self.theta,
+                    noise_table.noise,
+                    self.tasks,
+                    self.results,
+                ),
+                daemon=True,
+            )
+            for _ in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def evaluate(self, theta, offsets, sigma):
+        """Returns the (nb_offsets x 2) mean rewards of the pairs and their total length"""
+        self.theta.copy_(theta)
+        for index, offset in enumerate(offsets.tolist()):
+            self.tasks.put((index, offset, sigma, self.nb_evaluations + 2 * index + 1))
+        rewards = torch.zeros(len(offsets), 2)
+        steps = torch.zeros(len(offsets), dtype=torch.long)
+        for _ in range(len(offsets)):
+            index, reward_pos, reward_neg, nb_steps = self.results.get()
+            rewards[index, 0] = reward_pos
+            rewards[index, 1] = reward_neg
+            steps[index] = nb_steps
+        self.nb_evaluations += 2 * len(offsets)
+        return rewards, steps
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -1,10 +1,20 @@
+import os
+import math
+
 import hydra
 import optuna
 import yaml
+import torch
+import torch.multiprocessing as mp
 
-from omegaconf import DictConfig
+from omegaconf import DictConfig, open_dict
+from optuna.storages import JournalStorage
+from optuna.storages.journal import JournalFileBackend
+from optuna.study import MaxTrialsCallback, StudyDirection
+from optuna.trial import TrialState
 from bbrl import get_arguments, get_class
 from bbrl_algos.models.loggers import Logger
+from bbrl_algos.models.checkpoint import remove_checkpoint
 
 
 # %%
@@ -29,23 +39,206 @@ def get_trial_config(trial: optuna.Trial, cfg: DictConfig):
     return cfg
 
 
-def launch_optuna(cfg_raw, run_func):
+def get_storage_name(cfg_optuna):
+    """
+    Returns the storage of the study, None if it is kept in memory
+    It is either an RDB url (e.g. sqlite:///optuna.db) or the path of a journal file,
+    both can be shared by several processes and make the study resumable.
+    With several workers and no storage, the study is journaled into <study_name>.log
+    """
+    if "storage" in cfg_optuna:
+        storage = cfg_optuna.storage
+    elif "n_workers" in cfg_optuna and cfg_optuna.n_workers > 1:
+        storage = f"{cfg_optuna.study.study_name}.log"
+    else:
+        return None
+    if "://" in storage:
+        return storage
+    # Relative paths are relative to the launch directory, not to the hydra run directory
+    return hydra.utils.to_absolute_path(storage)
+
+
+def create_study(cfg_optuna, storage_name, worker=0):
+    if storage_name is None:
+        return hydra.utils.call(cfg_optuna.study)
+    if "://" in storage_name:
+        storage = storage_name
+    else:
+        storage = JournalStorage(JournalFileBackend(storage_name))
+    # Each worker samples different trials
+    study_cfg = cfg_optuna.study.copy()
+    if "sampler" in study_cfg and "seed" in study_cfg.sampler:
+        study_cfg.sampler.seed += worker
+    return hydra.utils.call(study_cfg, storage=storage, load_if_exists=True)
+
+
+def retry_interrupted_trials(study):
+    """The trials left running by an interrupted launch are failed and enqueued again"""
+    for trial in study.get_trials(deepcopy=False, states=(TrialState.RUNNING,)):
+        study.tell(trial.number, state=TrialState.FAIL)
+        study.enqueue_trial(trial.params)
+
+
+def optimize(study, cfg_raw, run_func, storage_name):
     cfg_optuna = cfg_raw.optuna
 
     def objective(trial):
         cfg_sampled = get_trial_config(trial, cfg_raw.copy())
 
+        # A pruned trial is recorded as such, with its last reported value
         logger = Logger(cfg_sampled)
         try:
             trial_result: float = run_func(cfg_sampled, logger, trial)
-            logger.close()
             return trial_result
-        except optuna.exceptions.TrialPruned:
+        finally:
             logger.close()
-            return float("-inf")
 
-    study = hydra.utils.call(cfg_optuna.study)
-    study.optimize(func=objective, **cfg_optuna.optimize)
+    optimize_args = dict(cfg_optuna.optimize)
+    callbacks = []
+    if storage_name is not None and "n_trials" in optimize_args:
+        # n_trials is the total number of trials of the study,
+        # over all the workers and all the launches
+        n_trials = optimize_args.pop("n_trials")
+        states = (TrialState.COMPLETE, TrialState.PRUNED)
+        if len(study.get_trials(deepcopy=False, states=states)) >= n_trials:
+            return
+        callbacks.append(MaxTrialsCallback(n_trials, states=states))
+    study.optimize(func=objective, callbacks=callbacks, **optimize_args)
+
+
+def resumable(run_func):
+    """
+    Marks a run function which saves its training state into cfg.algorithm.checkpoint
+    when it ends, and resumes from it when it is called again: needed by Hyperband
+    """
+    run_func.resumable = True
+    return run_func
+
+
+def successive_halving(
+    study, cfg_raw, run_func, nb_trials, nb_rungs, reduction_factor, checkpoint_dir
+):
+    """
+    Trains nb_trials sampled configurations during the first of nb_rungs rungs, then only
+    the best 1 / reduction_factor of them reduction_factor times longer, and so on:
+    the last rung ends at cfg.algorithm.n_steps steps. The other trials are pruned.
+    The run functions save their training state into cfg.algorithm.checkpoint at the end
+    of each rung, so that a promoted trial resumes from there instead of from scratch.
+    """
+    trials = []
+    for _ in range(nb_trials):
+        trial = study.ask()
+        cfg_sampled = get_trial_config(trial, cfg_raw.copy())
+        with open_dict(cfg_sampled.algorithm):
+            cfg_sampled.algorithm.checkpoint = os.path.join(
+                checkpoint_dir, f"{study.study_name}_{trial.number}.ckpt"
+            )
+        trials.append((trial, cfg_sampled))
+
+    maximize = study.direction == StudyDirection.MAXIMIZE
+    for rung in range(nb_rungs):
+        last_rung = rung == nb_rungs - 1
+        n_steps = cfg_raw.algorithm.n_steps // reduction_factor ** (nb_rungs - 1 - rung)
+        scores = []
+        for trial, cfg_sampled in trials:
+            cfg_sampled.algorithm.n_steps = n_steps
+            logger = Logger(cfg_sampled)
+            try:
+                score = float(run_func(cfg_sampled, logger))
+            finally:
+                logger.close()
+            trial.report(score, n_steps)
+            scores.append(score)
+
+        order = sorted(range(len(trials)), key=lambda k: scores[k], reverse=maximize)
+        nb_promoted = 0 if last_rung else max(1, len(trials) // reduction_factor)
+        for k in order[nb_promoted:]:
+            trial, cfg_sampled = trials[k]
+            if last_rung:
+                study.tell(trial, scores[k])
+            else:
+                study.tell(trial, state=TrialState.PRUNED)
+            remove_checkpoint(cfg_sampled.algorithm.checkpoint)
+        trials = [trials[k] for k in order[:nb_promoted]]
+
+
+def run_hyperband(study, cfg_raw, run_func):
+    """
+    Hyperband (Li et al., 2018): successive halving brackets, from many configurations
+    started with optuna.hyperband.min_steps steps to a few ones trained with
+    cfg.algorithm.n_steps steps from the start
+    """
+    # Otherwise, each promoted trial would be trained again from scratch
+    if not getattr(run_func, "resumable", False):
+        raise ValueError(
+            f"{run_func.__name__} does not resume from cfg.algorithm.checkpoint, "
+            "it cannot be scheduled by Hyperband"
+        )
+    cfg_hyperband = cfg_raw.optuna.hyperband
+    reduction_factor = cfg_hyperband.reduction_factor
+    max_steps = cfg_raw.algorithm.n_steps
+    checkpoint_dir = (
+        cfg_hyperband.checkpoint_dir
+        if "checkpoint_dir" in cfg_hyperband
+        else "./hyperband_checkpoints/"
+    )
+    s_max = int(math.log(max_steps / cfg_hyperband.min_steps, reduction_factor) + 1e-9)
+    for s in reversed(range(s_max + 1)):
+        nb_trials = math.ceil((s_max + 1) / (s + 1) * reduction_factor**s)
+        successive_halving(
+            study,
+            cfg_raw,
+            run_func,
+            nb_trials,
+            s + 1,
+            reduction_factor,
+            checkpoint_dir,
+        )
+
+
+def _optuna_worker(worker, cfg_raw, run_func, storage_name, n_threads):
+    # The workers share the cores
+    torch.set_num_threads(n_threads)
+    torch.random.manual_seed(seed=cfg_raw.algorithm.seed.torch + worker)
+    study = create_study(cfg_raw.optuna, storage_name, worker)
+    optimize(study, cfg_raw, run_func, storage_name)
+
+
+def launch_optuna(cfg_raw, run_func):
+    """
+    Runs the study described by cfg_raw.optuna
+    With optuna.hyperband, the trials are scheduled by Hyperband,
+    else with optuna.n_workers > 1, they are run by as many processes sharing the storage
+    """
+    cfg_optuna = cfg_raw.optuna
+    n_workers = cfg_optuna.n_workers if "n_workers" in cfg_optuna else 1
+
+    storage_name = get_storage_name(cfg_optuna)
+    study = create_study(cfg_optuna, storage_name)
+    if storage_name is not None:
+        retry_interrupted_trials(study)
+
+    if "hyperband" in cfg_optuna:
+        # The rungs are synchronous, the trials are run in this process
+        run_hyperband(study, cfg_raw, run_func)
+    elif n_workers > 1:
+        n_threads = max(1, os.cpu_count() // n_workers)
+        context = mp.get_context("spawn")
+        workers = [
+            context.Process(
+                target=_optuna_worker,
+                args=(worker, cfg_raw, run_func, storage_name, n_threads),
+            )
+            for worker in range(n_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # The best trial of all the workers
+        study = create_study(cfg_optuna, storage_name)
+    else:
+        optimize(study, cfg_raw, run_func, storage_name)
 
     file = open("best_params.yaml", "w")
     yaml.dump(study.best_params, file)
@@ -0,0 +1,40 @@
+"""
+Importance mixing (Sun et al., 2009): the samples of the previous generation
+are reused when the new sampling distribution is close to the old one,
+so that only the remainder of the new population has to be evaluated.
+"""
+
+import math
+
+import torch
+
+
+def importance_mixing(old_dist, new_dist, old_weights, pop_size, refresh_rate):
+    """
+    Builds a population of pop_size samples following new_dist from the old samples
+    (which follow old_dist) and fresh samples of new_dist
+
+    An old sample is kept with probability min(1, (1 - refresh_rate) p_new / p_old),
+    a fresh sample is accepted with probability max(refresh_rate, 1 - p_old / p_new).
+    At most a fraction (1 - refresh_rate) of the population is reused, so that there
+    is always something new to evaluate.
+    :return: the indices of the reused old samples and the fresh samples to evaluate
+    """
+    log_keep = math.log(1 - refresh_rate) + (
+        new_dist.log_prob(old_weights) - old_dist.log_prob(old_weights)
+    )
+    keep = torch.rand(len(old_weights)).log() < log_keep.clamp(max=0.0)
+    max_reused = min(int((1 - refresh_rate) * pop_size), pop_size - 1)
+    # A random subset of the kept samples, the first ones are not favored
+    reused = keep.nonzero().squeeze(-1)
+    reused = reused[torch.randperm(len(reused))[:max_reused]]
+
+    fresh = []
+    nb_missing = pop_size - len(reused)
+    while nb_missing > 0:
+        candidates = new_dist.sample((nb_missing,))
+        ratio = (old_dist.log_prob(candidates) - new_dist.log_prob(candidates)).exp()
+        accept = torch.rand(nb_missing) < (1 - ratio).clamp(min=refresh_rate)
+        fresh.append(candidates[accept])
+        nb_missing -= int(accept.sum())
+    return reused, torch.cat(fresh)
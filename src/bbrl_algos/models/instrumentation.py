@@ -0,0 +1,143 @@
+"""
+Wall-clock instrumentation of the training loops, telling whether a run is bound by
+the environments (collect), by the replay buffer (replay_put, replay_sample)
+or by the learner (forward, backward, optimizer_step):
+
+    timer = PhaseTimer.from_config(cfg)
+    with timer.phase("collect"):
+        train_agent(train_workspace, ...)
+    ...
+    timer.log(logger, nb_steps)
+
+When it is disabled, phase() returns a shared no-op context manager and log() does nothing.
+With a profiler (see models/profiling.py), the phases are also labelled in its traces.
+With cfg.perf_summary, the totals since the start of the loop are written into this json
+file at each log() (see benchmarks/throughput.py).
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import torch
+
+from bbrl_algos.models.profiling import UpdateProfiler
+
+_NO_PHASE = nullcontext()
+
+
+class _Phase:
+    __slots__ = ("timer", "name", "start", "record")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+        self.record = None
+
+    def __enter__(self):
+        profiler = self.timer.profiler
+        if profiler is not None and profiler.active:
+            self.record = profiler.record(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timer.synchronize:
+            # The CUDA kernels launched during the phase are part of it
+            torch.cuda.synchronize()
+        self.timer.times[self.name] += time.perf_counter() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc_info)
+            self.record = None
+
+
+class PhaseTimer:
+    """
+    Accumulates the time spent in each phase, and the number of updates, between two calls
+    to log(). The phases must not be nested.
+    """
+
+    def __init__(self, enabled=True, nb_steps=0, profiler=None, summary_file=None):
+        self.enabled = enabled
+        self.profiler = profiler
+        self.summary_file = summary_file
+        self.synchronize = enabled and torch.cuda.is_available()
+        self.phases = {}
+        self.times = defaultdict(float)
+        self.nb_updates = 0
+        self.last_steps = nb_steps
+        self.last_time = time.perf_counter()
+        self.first_steps = nb_steps
+        self.start_time = self.last_time
+        self.total_updates = 0
+        self.time_to_first_update = None
+
+    @staticmethod
+    def from_config(cfg, nb_steps=0):
+        """Enabled by cfg.instrument, profiles the updates described by cfg.profiler"""
+        profiler = UpdateProfiler(**cfg.profiler) if "profiler" in cfg else None
+        summary_file = cfg.perf_summary if "perf_summary" in cfg else None
+        return PhaseTimer(
+            "instrument" in cfg and cfg.instrument, nb_steps, profiler, summary_file
+        )
+
+    def phase(self, name):
+        if not self.enabled and (self.profiler is None or not self.profiler.active):
+            return _NO_PHASE
+        if name not in self.phases:
+            self.phases[name] = _Phase(self, name)
+        return self.phases[name]
+
+    def add_updates(self, nb_updates=1):
+        if self.time_to_first_update is None:
+            self.time_to_first_update = time.perf_counter() - self.start_time
+        self.nb_updates += nb_updates
+        self.total_updates += nb_updates
+        if self.profiler is not None:
+            self.profiler.step(nb_updates)
+
+    def log(self, logger, nb_steps):
+        """
+        Logs the environment steps and the updates per second since the previous call,
+        and the time spent in each phase (perf/time/<phase>, in seconds,
+        and perf/share/<phase>, as a fraction of the elapsed time)
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        elapsed = max(now - self.last_time, 1e-9)
+        logger.add_log(
+            "perf/env_steps_per_s", (nb_steps - self.last_steps) / elapsed, nb_steps
+        )
+        logger.add_log("perf/updates_per_s", self.nb_updates / elapsed, nb_steps)
+        times = dict(self.times)
+        times["other"] = max(elapsed - sum(times.values()), 0.0)
+        for name, duration in times.items():
+            logger.add_log(f"perf/time/{name}", duration, nb_steps)
+            logger.add_log(f"perf/share/{name}", duration / elapsed, nb_steps)
+
+        self.times.clear()
+        self.nb_updates = 0
+        self.last_steps = nb_steps
+        self.last_time = now
+        if self.summary_file is not None:
+            self.write_summary(nb_steps, now)
+
+    def write_summary(self, nb_steps, now):
+        elapsed = max(now - self.start_time, 1e-9)
+        summary = {
+            "env_steps": nb_steps - self.first_steps,
+            "updates": self.total_updates,
+            "elapsed": elapsed,
+            "env_steps_per_s": (nb_steps - self.first_steps) / elapsed,
+            "updates_per_s": self.total_updates / elapsed,
+            "time_to_first_update": self.time_to_first_update,
+        }
+        # Replaced atomically, the last summary stays readable if the run is killed
+        tmp_file = self.summary_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(summary, file)
+        os.replace(tmp_file, self.summary_file)
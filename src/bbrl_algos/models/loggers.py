@@ -1,15 +1,116 @@
+import threading
+from collections import deque
+from itertools import groupby
+
 import torch
 import numpy as np
 from bbrl import instantiate_class
 
 
+class AsyncScalarWriter:
+    """
+    Buffers the scalars sent to a logger (e.g. a TFLogger) and writes them from a
+    background thread every every_n_seconds seconds, so that the training loop never waits
+    for a conversion of a tensor or a file write.
+    The values of each key are kept (detached) in a ring buffer of the last window ones.
+    The values logged at the same step, e.g. the losses of several updates, are written
+    as one point: their mean, and if min_max their min and max under <key>/min and <key>/max.
+    A step is only written once a later step of its key arrives, since more values of it
+    may still come (the logger keeps the first point of a step), and the last steps
+    are written when the logger is closed.
+    The writes are serialized by write_lock, as the logger is not thread-safe.
+    """
+
+    def __init__(self, logger, every_n_seconds=1.0, window=10000, min_max=False):
+        self.logger = logger
+        self.every_n_seconds = every_n_seconds
+        self.window = window
+        self.min_max = min_max
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, key, value, step):
+        if isinstance(value, torch.Tensor):
+            # A copy, in case the tensor is modified in place before being written
+            value = value.detach().clone()
+        with self.lock:
+            if key not in self.buffers:
+                self.buffers[key] = deque(maxlen=self.window)
+            self.buffers[key].append((step, value))
+
+    def _run(self):
+        while not self.stop_event.wait(self.every_n_seconds):
+            with self.write_lock:
+                self._write()
+
+    def _write(self, last_step=False):
+        """Writes the buffered steps, except the last one of each key unless last_step"""
+        with self.lock:
+            buffers, self.buffers = self.buffers, {}
+        for key, buffer in buffers.items():
+            buffer = list(buffer)
+            if not last_step:
+                # Keeps the values of the last step, before the ones logged since the swap
+                nb_written = len(buffer)
+                while nb_written > 0 and buffer[nb_written - 1][0] == buffer[-1][0]:
+                    nb_written -= 1
+                buffer, kept = buffer[:nb_written], buffer[nb_written:]
+                with self.lock:
+                    added = self.buffers.get(key, [])
+                    self.buffers[key] = deque(kept + list(added), maxlen=self.window)
+            if len(buffer) == 0:
+                continue
+            steps = [step for step, _ in buffer]
+            # A single conversion (and device synchronization) per key
+            values = torch.stack(
+                [
+                    torch.as_tensor(value, dtype=torch.float32).reshape(())
+                    for _, value in buffer
+                ]
+            ).tolist()
+            for step, group in groupby(zip(steps, values), key=lambda x: x[0]):
+                group_values = [value for _, value in group]
+                self.logger.add_scalar(key, np.mean(group_values), step)
+                if self.min_max and len(group_values) > 1:
+                    self.logger.add_scalar(key + "/min", min(group_values), step)
+                    self.logger.add_scalar(key + "/max", max(group_values), step)
+
+    def flush(self):
+        """Writes the completed steps and flushes the logger, e.g. before a checkpoint"""
+        with self.write_lock:
+            self._write()
+            if hasattr(self.logger, "flush"):
+                self.logger.flush()
+
+    def close(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.thread.join()
+        with self.write_lock:
+            self._write(last_step=True)
+            self.logger.close()
+
+
 class Logger:
     def __init__(self, cfg):
         self.logger = instantiate_class(cfg.logger)
         self.logger.save_hps(cfg)
+        self.asynchronous = "async_logger" in cfg
+        if self.asynchronous:
+            self.logger = AsyncScalarWriter(self.logger, **cfg.async_logger)
 
     def add_log(self, log_string, log_item, steps):
-        if isinstance(log_item, torch.Tensor) and log_item.dim() == 0:
+        # The asynchronous writer converts the tensors itself, out of the training loop
+        if (
+            isinstance(log_item, torch.Tensor)
+            and log_item.dim() == 0
+            and not self.asynchronous
+        ):
             log_item = log_item.item()
         self.logger.add_scalar(log_string, log_item, steps)
 
@@ -26,10 +127,31 @@ class Logger:
         self.add_log("reward/median", rewards.median(), nb_steps)
         self.add_log("reward/std", rewards.std(), nb_steps)
 
+    def flush(self) -> None:
+        """Writes the logs of the previous steps, e.g. before a checkpoint"""
+        if hasattr(self.logger, "flush"):
+            self.logger.flush()
+
     def close(self) -> None:
         self.logger.close()
 
 
+class NullLogger(Logger):
+    """Discards the logs, e.g. in the processes other than the main one"""
+
+    def __init__(self):
+        pass
+
+    def add_log(self, log_string, log_item, steps):
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
 class RewardLogger:
     def __init__(self, steps_filename, rewards_filename):
         self.steps_filename = steps_filename
@@ -0,0 +1,280 @@
+"""
+Memory accounting of a run: footprint of the replay buffer (per field), of the
+workspaces, of the parameters of the models and of the states of the optimizers,
+and resident set size of the process. With log_memory: True in the configuration,
+the training loops log them in MB (memory/...) at each evaluation.
+
+The footprint of a run can be estimated from its configuration alone:
+
+    python -m bbrl_algos.models.memory algos/dqn/configs/dqn_lunar_lander.yaml \\
+        algorithm.buffer.max_size=2e5
+
+The algorithm is given by the prefix of the name of the configuration file
+(dqn, ddpg or sac), the networks and variables of the other ones are guessed.
+"""
+
+import resource
+import sys
+
+import numpy as np
+from gymnasium import spaces
+
+from bbrl.agents.gymnasium import make_env
+
+# registers the environments of bbrl_gymnasium and the synthetic ones
+import bbrl_algos.models.envs
+
+MB = 2**20
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def replay_buffer_bytes(rb):
+    """The bytes of each field of a ReplayBuffer, or of all the buffers of an ensemble"""
+    buffers = rb.buffers if hasattr(rb, "buffers") else [rb]
+    fields = {}
+    for buffer in buffers:
+        for key, tensor in (buffer.variables or {}).items():
+            fields[key] = fields.get(key, 0) + tensor_bytes(tensor)
+    return fields
+
+
+def workspace_bytes(workspace):
+    """The bytes of the variables of a workspace, without copying them"""
+    fields = {}
+    for key, variable in workspace.variables.items():
+        if hasattr(variable, "tensors"):
+            fields[key] = sum(tensor_bytes(tensor) for tensor in variable.tensors)
+        elif variable.tensor is not None:
+            fields[key] = tensor_bytes(variable.tensor)
+    return fields
+
+
+def module_bytes(module):
+    return sum(tensor_bytes(tensor) for tensor in module.parameters()) + sum(
+        tensor_bytes(tensor) for tensor in module.buffers()
+    )
+
+
+def optimizer_bytes(optimizer):
+    """The bytes of the state of an optimizer (e.g. the moments of Adam)"""
+    return sum(
+        tensor_bytes(value)
+        for state in optimizer.state.values()
+        for value in state.values()
+        if hasattr(value, "numel")
+    )
+
+
+def rss_bytes():
+    """The current resident set size of the process (Linux only, None elsewhere)"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def log_memory(
+    logger, nb_steps, replay_buffer=None, workspaces=None, models=None, optimizers=None
+):
+    """
+    Logs the footprints in MB, workspaces, models and optimizers being dicts of
+    name -> workspace, module or optimizer
+    """
+    workspaces = workspaces or {}
+    models = models or {}
+    optimizers = optimizers or {}
+    if replay_buffer is not None:
+        fields = replay_buffer_bytes(replay_buffer)
+        for key, nb_bytes in fields.items():
+            logger.add_log(f"memory/replay/{key}", nb_bytes / MB, nb_steps)
+        logger.add_log("memory/replay_total", sum(fields.values()) / MB, nb_steps)
+    for name, workspace in workspaces.items():
+        nb_bytes = sum(workspace_bytes(workspace).values())
+        logger.add_log(f"memory/workspace/{name}", nb_bytes / MB, nb_steps)
+    for name, model in models.items():
+        logger.add_log(f"memory/model/{name}", module_bytes(model) / MB, nb_steps)
+    for name, optimizer in optimizers.items():
+        nb_bytes = optimizer_bytes(optimizer)
+        logger.add_log(f"memory/optimizer/{name}", nb_bytes / MB, nb_steps)
+    rss = rss_bytes()
+    if rss is not None:
+        logger.add_log("memory/rss", rss / MB, nb_steps)
+    logger.add_log("memory/peak_rss", peak_rss_bytes() / MB, nb_steps)
+
+
+def step_bytes(observation_space, action_space):
+    """The bytes of a time step of an environment in a workspace, per variable"""
+    if isinstance(action_space, spaces.Discrete):
+        action_bytes = 8
+    else:
+        action_bytes = 4 * int(np.prod(action_space.shape))
+    return {
+        "env/env_obs": 4 * int(np.prod(observation_space.shape)),
+        "env/reward": 4,
+        "env/cumulated_reward": 4,
+        "env/terminated": 1,
+        "env/truncated": 1,
+        "env/done": 1,
+        "env/timestep": 8,
+        "action": action_bytes,
+    }
+
+
+def mlp_layers(sizes):
+    """The (inputs, outputs) of the linear layers of a multilayer perceptron"""
+    return list(zip(sizes[:-1], sizes[1:]))
+
+
+def network_layers(kind, hidden_sizes, obs_dim, action_dim, critic_input):
+    """
+    The linear layers of a network: the actors (and the Q networks of DQN) output an
+    action (or a value per action), the critics a value of the observation and of the
+    action if it is continuous, the squashed Gaussian actors of SAC have a head for the
+    means and one for the standard deviations
+    """
+    if kind == "critic":
+        return mlp_layers([critic_input, *hidden_sizes, 1])
+    if kind == "squashed_gaussian":
+        heads = 2 * [(hidden_sizes[-1], action_dim)]
+        return mlp_layers([obs_dim, *hidden_sizes]) + heads
+    return mlp_layers([obs_dim, *hidden_sizes, action_dim])
+
+
+# The variables written into the training workspace by the agents of each algorithm,
+# besides those of the environment and the action, in floats per time step
+# ("actions": one per discrete action), and its networks: name -> (kind, key of the
+# hidden sizes in cfg.algorithm.architecture), the targets being copies of the trained
+# networks. Each optimizer trains the networks of its entry.
+ALGORITHMS = {
+    "dqn": {
+        "variables": {"critic/q_values": "actions"},
+        "networks": {
+            "q": ("q", "hidden_sizes"),
+            "target_q": ("q", "hidden_sizes"),
+        },
+        "optimizers": {"q": ["q"]},
+    },
+    "ddpg": {
+        "variables": {},
+        "networks": {
+            "actor": ("actor", "actor_hidden_size"),
+            "critic": ("critic", "critic_hidden_size"),
+            "target_critic": ("critic", "critic_hidden_size"),
+        },
+        "optimizers": {"actor": ["actor"], "critic": ["critic"]},
+    },
+    "sac": {
+        "variables": {"policy/action_logprobs": 1},
+        "networks": {
+            "actor": ("squashed_gaussian", "actor_hidden_size"),
+            "critic_1": ("critic", "critic_hidden_size"),
+            "critic_2": ("critic", "critic_hidden_size"),
+            "target_critic_1": ("critic", "critic_hidden_size"),
+            "target_critic_2": ("critic", "critic_hidden_size"),
+        },
+        "optimizers": {"actor": ["actor"], "critic": ["critic_1", "critic_2"]},
+    },
+}
+
+
+def generic_algorithm(architecture):
+    """One network per hidden sizes of the architecture, each with its own optimizer"""
+    networks = {}
+    for key in architecture.keys():
+        if "hidden_size" not in key:
+            continue
+        name = key.replace("hidden_sizes", "").replace("hidden_size", "").strip("_")
+        networks[name or "network"] = ("critic" if "critic" in key else "actor", key)
+    return {
+        "variables": {},
+        "networks": networks,
+        "optimizers": {name: [name] for name in networks},
+    }
+
+
+def estimate_memory(cfg, algorithm=None):
+    """
+    Estimates the footprints in bytes of a run from its configuration, with the names
+    logged by log_memory: the replay buffer (per field) and the workspaces hold the
+    variables of the environment, the actions and the variables written by the agents
+    of the algorithm (see ALGORITHMS), the networks are multilayer perceptrons of the
+    hidden sizes of cfg.algorithm.architecture, trained with Adam (two moments and a
+    step per parameter tensor). Without algorithm, there is one network per hidden
+    sizes and the agents only write the actions.
+    """
+    make_env_args = (
+        dict(cfg.gym_env.make_env_args) if "make_env_args" in cfg.gym_env else {}
+    )
+    env = make_env(cfg.gym_env.env_name, **make_env_args)
+    algo = cfg.algorithm
+    architecture = algo.architecture if "architecture" in algo else {}
+    spec = ALGORITHMS[algorithm] if algorithm else generic_algorithm(architecture)
+
+    obs_dim = int(np.prod(env.observation_space.shape))
+    if isinstance(env.action_space, spaces.Discrete):
+        action_dim, critic_input = env.action_space.n, obs_dim
+    else:
+        action_dim = int(np.prod(env.action_space.shape))
+        critic_input = obs_dim + action_dim
+
+    fields = step_bytes(env.observation_space, env.action_space)
+    for key, nb_floats in spec["variables"].items():
+        fields[key] = 4 * (action_dim if nb_floats == "actions" else nb_floats)
+    step = sum(fields.values())
+    estimate = {}
+
+    if "buffer" in algo and "max_size" in algo.buffer:
+        buffer_size = int(float(algo.buffer.max_size))
+    else:
+        buffer_size = int(float(algo.buffer_size)) if "buffer_size" in algo else 0
+    # A transition is made of two time steps
+    for key, nb_bytes in fields.items():
+        estimate[f"replay/{key}"] = 2 * buffer_size * nb_bytes
+
+    n_steps_train = algo.n_steps_train if "n_steps_train" in algo else algo.n_steps
+    estimate["workspace/train"] = n_steps_train * algo.n_envs * step
+    # The evaluation episodes are run until the longest one is over
+    max_episode_steps = env.spec.max_episode_steps if env.spec is not None else None
+    if max_episode_steps is not None:
+        estimate["workspace/eval"] = max_episode_steps * algo.nb_evals * step
+
+    layers = {
+        name: network_layers(
+            kind, list(architecture[key]), obs_dim, action_dim, critic_input
+        )
+        for name, (kind, key) in spec["networks"].items()
+    }
+    for name, network in layers.items():
+        estimate[f"model/{name}"] = 4 * sum(a * b + b for a, b in network)
+    for name, networks in spec["optimizers"].items():
+        # A weight and a bias per layer
+        nb_tensors = sum(2 * len(layers[network]) for network in networks)
+        nb_bytes = sum(estimate[f"model/{network}"] for network in networks)
+        estimate[f"optimizer/{name}"] = 2 * nb_bytes + 4 * nb_tensors
+    env.close()
+    return estimate
+
+
+if __name__ == "__main__":
+    import os
+
+    from omegaconf import OmegaConf
+
+    cfg = OmegaConf.merge(
+        OmegaConf.load(sys.argv[1]), OmegaConf.from_dotlist(sys.argv[2:])
+    )
+    algorithm = os.path.basename(sys.argv[1]).split("_")[0]
+    estimate = estimate_memory(cfg, algorithm if algorithm in ALGORITHMS else None)
+    for name, nb_bytes in estimate.items():
+        print(f"{name:>32}: {nb_bytes / MB:>10.2f} MB")
+    print(f"{'total':>32}: {sum(estimate.values()) / MB:>10.2f} MB")
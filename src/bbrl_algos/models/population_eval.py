@@ -0,0 +1,221 @@
+"""
+Evaluation of a population of policies sharing the same architecture.
+
+PopulationEvaluator stacks the weights of all the individuals and runs the actor
+for the whole population in one vectorized forward (torch.func.vmap over its parameters),
+so a generation costs a single rollout of nb_evals environments per individual.
+PopulationWorkerPool evaluates the individuals in parallel worker processes instead,
+which is faster when stepping the environments dominates (e.g. MuJoCo tasks).
+"""
+
+import copy
+
+import torch
+import torch.multiprocessing as mp
+from torch.func import functional_call, vmap
+from torch.nn.utils import vector_to_parameters
+
+from bbrl.agents import Agent, Agents
+from bbrl.workspace import Workspace
+
+from bbrl_algos.models.envs import get_eval_env_agent
+from bbrl_algos.models.rollout import make_temporal_agent
+
+
+def unflatten_population(module, weights):
+    """
+    Splits (pop_size x dim) flat weights, laid out as by parameters_to_vector,
+    into a dict of batched parameters of the module
+    """
+    params = {}
+    start = 0
+    for name, param in module.named_parameters():
+        end = start + param.numel()
+        params[name] = weights[:, start:end].reshape(weights.size(0), *param.shape)
+        start = end
+    assert start == weights.size(1), "The weights do not match the module parameters"
+    return params
+
+
+class PopulationActor(Agent):
+    """
+    Plays the actions of copies of a deterministic actor with different weights
+    The environments are grouped by individual: env k is played by individual k // nb_evals
+    """
+
+    def __init__(self, actor, nb_evals, name="population_actor"):
+        super().__init__(name=name)
+        model_size = sum(p.numel() for p in actor.model.parameters())
+        assert model_size == sum(
+            p.numel() for p in actor.parameters()
+        ), "All the parameters of the actor must be in its model"
+        self.actor = actor
+        self.pop_size = 0
+        self.nb_evals = nb_evals
+        self.params = None
+
+        def call_model(params, obs):
+            return functional_call(self.actor.model, params, (obs,))
+
+        self.batched_model = vmap(call_model)
+
+    def set_weights(self, weights):
+        self.pop_size = weights.size(0)
+        self.params = unflatten_population(self.actor.model, weights)
+
+    def forward(self, t, **kwargs):
+        obs = self.get(("env/env_obs", t))
+        obs = obs.view(self.pop_size, self.nb_evals, -1)
+        output = self.batched_model(self.params, obs)
+        action = self.actor.output_to_action(output.flatten(0, 1))
+        self.set(("action", t), action)
+
+
+class PopulationEvaluator:
+    """
+    Evaluates all the individuals of a population in a single rollout
+    make_env_agent(n) must return an env agent with n x nb_evals environments without autoreset,
+    it is called once for each number of individuals to evaluate
+    """
+
+    def __init__(self, make_env_agent, actor, nb_evals):
+        self.make_env_agent = make_env_agent
+        self.nb_evals = nb_evals
+        self.population = PopulationActor(actor, nb_evals)
+        self.agents = {}
+
+    def get_agent(self, nb_individuals):
+        if nb_individuals not in self.agents:
+            env_agent = self.make_env_agent(nb_individuals)
+            self.agents[nb_individuals] = make_temporal_agent(
+                Agents(env_agent, self.population), requires_grad=False
+            )
+        return self.agents[nb_individuals]
+
+    def evaluate(self, weights):
+        """
+        Returns the mean cumulated reward of each individual over its nb_evals episodes,
+        and the length of the rollout of each individual (as if it was evaluated alone)
+        """
+        self.population.set_weights(weights)
+        workspace = Workspace()
+        self.get_agent(len(weights))(workspace, t=0, stop_variable="env/done")
+
+        shape = (len(weights), self.nb_evals)
+        rewards = workspace["env/cumulated_reward"][-1].view(shape)
+        # An individual evaluated alone stops when all its episodes are done
+        nb_actions = (~workspace["env/done"]).sum(dim=0).view(shape)
+        steps = nb_actions.max(dim=1).values + 1
+        return rewards.mean(dim=1), steps
+
+    def close(self):
+        pass
+
+
+def _set_nb_reset(env_agent, nb_reset):
+    """
+    Sets the number of resets of a bbrl env agent, from which it derives the seeds of
+    its next resets: bbrl has no public way to reset the environments with a given seed
+    """
+    assert hasattr(
+        env_agent, "_nb_reset"
+    ), "The env agent does not derive its reset seeds from its number of resets"
+    env_agent._nb_reset = nb_reset
+
+
+def evaluate_individual(eval_agent, env_agent, actor, weights, nb_evaluations):
+    """
+    Runs the actor with the given weights on all the environments of env_agent
+    eval_agent chains env_agent and actor, nb_evaluations is the number of the evaluation:
+    the seeds of the env resets only depend on it, as if all the individuals were evaluated
+    one after the other by the same env agent
+    :return: the mean cumulated reward and the length of the rollout
+    """
+    vector_to_parameters(weights.clone(), actor.parameters())
+    # The env agent increments its number of resets when it starts an episode
+    _set_nb_reset(env_agent, nb_evaluations)
+
+    workspace = Workspace()
+    eval_agent(workspace, t=0, stop_variable="env/done")
+    return workspace["env/cumulated_reward"][-1].mean(), workspace["action"].shape[0]
+
+
+def _population_worker(cfg, actor, weights, results, tasks, done):
+    """Evaluates the individuals received from the tasks queue until it gets None"""
+    # The workers share the cores, each one runs single-threaded
+    torch.set_num_threads(1)
+    env_agent = get_eval_env_agent(cfg)
+    eval_agent = make_temporal_agent(Agents(env_agent, actor), requires_grad=False)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, nb_evaluations = task
+        reward, steps = evaluate_individual(
+            eval_agent, env_agent, actor, weights[index], nb_evaluations
+        )
+        results[index, 0] = reward
+        results[index, 1] = steps
+        done.put(index)
+
+
+class PopulationWorkerPool:
+    """
+    Evaluates the individuals of a population in long-lived worker processes,
+    each one with its own evaluation env agent (nb_evals environments)
+
+    The weights and the results go through shared memory tensors,
+    the queues only carry the indices of the individuals.
+    The results do not depend on the number of workers nor on the order of the evaluations.
+    """
+
+    def __init__(self, cfg, actor, pop_size, n_workers):
+        self.pop_size = pop_size
+        self.nb_evaluations = 0
+        dim = sum(p.numel() for p in actor.parameters())
+        self.weights = torch.zeros(pop_size, dim).share_memory_()
+        self.results = torch.zeros(pop_size, 2).share_memory_()
+
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self.done = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_population_worker,
+                args=(
+                    cfg,
+                    copy.deepcopy(actor),
+                    self.weights,
+                    self.results,
+                    self.tasks,
+                    self.done,
+                ),
+                daemon=True,
+            )
+            for _ in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def evaluate(self, weights):
+        """
+        Returns the mean cumulated reward of each individual over its nb_evals episodes,
+        and the length of the rollout of each individual
+        There can be less individuals than pop_size
+        """
+        nb_individuals = len(weights)
+        self.weights[:nb_individuals] = weights
+        for index in range(nb_individuals):
+            self.tasks.put((index, self.nb_evaluations + index + 1))
+        for _ in range(nb_individuals):
+            self.done.get()
+        self.nb_evaluations += nb_individuals
+        results = self.results[:nb_individuals]
+        return results[:, 0].clone(), results[:, 1].long()
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
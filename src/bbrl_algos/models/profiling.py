@@ -0,0 +1,98 @@
+"""
+Profiling of a window of updates of a training loop with torch.profiler, e.g. with
+
+    profiler:
+      start_update: 1000
+      end_update: 1100
+
+in the configuration of an algorithm. The phases timed by the PhaseTimer of the loop
+(collect, forward, backward, optimizer_step...) are labelled with record_function.
+A chrome trace (open it in chrome://tracing or https://ui.perfetto.dev) and a table
+of the operators are written into the hydra run directory.
+"""
+
+import atexit
+import os
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+from hydra.core.hydra_config import HydraConfig
+
+
+class UpdateProfiler:
+    """Profiles the updates from start_update (included) to end_update (excluded)"""
+
+    def __init__(
+        self,
+        start_update,
+        end_update,
+        directory="profiler",
+        record_shapes=False,
+        profile_memory=False,
+        with_stack=False,
+        sort_by="self_cpu_time_total",
+        row_limit=40,
+    ):
+        self.start_update = start_update
+        self.end_update = end_update
+        # The hydra run directory, the current directory may have been changed or not
+        if HydraConfig.initialized():
+            directory = os.path.join(HydraConfig.get().runtime.output_dir, directory)
+        self.directory = os.path.abspath(directory)
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.with_stack = with_stack
+        self.sort_by = sort_by
+        self.row_limit = row_limit
+        self.nb_updates = 0
+        self.profile = None
+        self.done = False
+        # The window is exported even if the run ends before its last update
+        atexit.register(self.stop)
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def record(self, name):
+        return record_function(name)
+
+    def step(self, nb_updates=1):
+        """Counts the updates, starts and stops the profiler at the bounds of the window"""
+        self.nb_updates += nb_updates
+        if self.active and self.nb_updates >= self.end_update:
+            self.stop()
+        elif not self.active and not self.done and self.nb_updates >= self.start_update:
+            self.start()
+
+    def start(self):
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.profile = profile(
+            activities=activities,
+            record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack,
+        )
+        self.profile.__enter__()
+        self.first_update = self.nb_updates
+
+    def stop(self):
+        if not self.active:
+            return
+        self.profile.__exit__(None, None, None)
+        os.makedirs(self.directory, exist_ok=True)
+        filename = f"updates_{self.first_update}_{self.nb_updates}"
+        self.profile.export_chrome_trace(
+            os.path.join(self.directory, filename + ".trace.json")
+        )
+        with open(os.path.join(self.directory, filename + ".txt"), "w") as file:
+            file.write(
+                self.profile.key_averages().table(
+                    sort_by=self.sort_by, row_limit=self.row_limit
+                )
+            )
+        print(f"Profile of the updates written into {self.directory}/{filename}.*")
+        self.profile = None
+        self.done = True
@@ -0,0 +1,174 @@
+"""
+Computation of the returns and advantages used by the policy gradient algorithms.
+All the functions take (T x B) tensors (timestep x n_envs) laid out as in bbrl workspaces.
+"""
+
+import torch
+
+
+def discount_matrix(n_steps, discount_factor, device=None, dtype=torch.float32):
+    """Returns the (T x T) upper triangular matrix M[t, k] = discount_factor^(k-t)"""
+    idx = torch.arange(n_steps, device=device)
+    exponent = (idx.unsqueeze(0) - idx.unsqueeze(1)).to(dtype)
+    gamma = torch.tensor(discount_factor, device=device, dtype=dtype)
+    return torch.where(exponent >= 0, gamma.pow(exponent.clamp(min=0)), 0.0)
+
+
+def _episode_ends(done):
+    """For each step, the index of the last step of its episode (T-1 if the episode is not over)"""
+    n_steps = done.size(0)
+    idx = torch.arange(n_steps, device=done.device).unsqueeze(-1).expand_as(done)
+    ends = torch.where(done.bool(), idx, n_steps - 1)
+    return torch.flip(torch.cummin(torch.flip(ends, [0]), dim=0).values, [0])
+
+
+def discounted_returns(reward, discount_factor, done=None):
+    """
+    Discounted reward-to-go G_t = sum_{k>=t} discount_factor^(k-t) r_k
+    If done is given, the sum stops at the end of the episode of each step
+    """
+    n_steps = reward.size(0)
+    matrix = discount_matrix(n_steps, discount_factor, reward.device, reward.dtype)
+    returns = matrix @ reward.reshape(n_steps, -1)
+    returns = returns.reshape(reward.shape)
+    if done is None:
+        return returns
+
+    # Remove what comes after the end of the episode e_t:
+    # G_t = R_t - discount_factor^(e_t + 1 - t) R_{e_t + 1}
+    ends = _episode_ends(done)
+    next_start = (ends + 1).clamp(max=n_steps - 1)
+    idx = torch.arange(n_steps, device=reward.device).unsqueeze(-1).to(reward.dtype)
+    gamma = torch.tensor(discount_factor, device=reward.device, dtype=reward.dtype)
+    factor = gamma.pow(ends.to(reward.dtype) + 1 - idx) * (ends < n_steps - 1)
+    return returns - factor * returns.gather(0, next_start)
+
+
+def baselined_returns(reward, baseline, discount_factor, done=None):
+    """Discounted reward-to-go minus the value of the baseline at each step"""
+    return discounted_returns(reward, discount_factor, done) - baseline
+
+
+def episode_returns(reward, done=None):
+    """
+    The (undiscounted) sum of the rewards of the episode, repeated at each step
+    If done is not given, the whole time dimension is considered as a single episode
+    """
+    if done is None:
+        return reward.sum(dim=0, keepdim=True).expand_as(reward)
+    cumulated = torch.cumsum(reward, dim=0)
+    ends = _episode_ends(done)
+    # The episode of step t starts just after the previous done
+    previous_done = torch.cat((torch.zeros_like(done[:1]), done[:-1]), dim=0).bool()
+    n_steps = reward.size(0)
+    idx = torch.arange(n_steps, device=reward.device).unsqueeze(-1).expand_as(done)
+    starts = torch.cummax(torch.where(previous_done, idx, 0), dim=0).values
+    before_start = torch.where(
+        starts > 0,
+        cumulated.gather(0, (starts - 1).clamp(min=0)),
+        torch.zeros_like(cumulated),
+    )
+    return cumulated.gather(0, ends) - before_start
+
+
+def _gae_scan(delta, coef, advantages):
+    """Backward recursion A_t = delta_t + coef_t * A_{t+1}, written into advantages"""
+    last = torch.zeros_like(delta[0])
+    for t in range(delta.size(0) - 1, -1, -1):
+        last = delta[t] + coef[t] * last
+        advantages[t] = last
+    return advantages
+
+
+def _gae_scan_transposed(grad, coef, grad_delta):
+    """Gradient of _gae_scan: G_t = g_t + coef_{t-1} * G_{t-1}, written into grad_delta"""
+    last = torch.zeros_like(grad[0])
+    for t in range(grad.size(0)):
+        last = grad[t] + (coef[t - 1] * last if t > 0 else 0.0)
+        grad_delta[t] = last
+    return grad_delta
+
+
+_compiled_scans = {}
+
+
+def _get_scan(scan, compiled):
+    if not compiled:
+        return scan
+    if scan not in _compiled_scans:
+        # The loop is unrolled, so there is one compilation per rollout length
+        _compiled_scans[scan] = torch.compile(scan, dynamic=True)
+    return _compiled_scans[scan]
+
+
+class _GAEScan(torch.autograd.Function):
+    """
+    Runs the GAE recursion in place, the backward pass being the transposed recursion
+    (autograd on the in-place writes would copy the whole gradient at each step)
+    """
+
+    @staticmethod
+    def forward(ctx, delta, coef, advantages, compiled):
+        # advantages has one more step than delta, its last step is set to 0
+        ctx.compiled = compiled
+        ctx.save_for_backward(coef)
+        ctx.mark_dirty(advantages)
+        advantages[-1] = 0.0
+        _get_scan(_gae_scan, compiled)(delta, coef, advantages[:-1])
+        return advantages
+
+    @staticmethod
+    def backward(ctx, grad_advantages):
+        (coef,) = ctx.saved_tensors
+        grad_delta = torch.empty_like(coef)
+        _get_scan(_gae_scan_transposed, ctx.compiled)(
+            grad_advantages[:-1], coef, grad_delta
+        )
+        return grad_delta, None, None, None
+
+
+def gae_advantages(
+    value,
+    reward,
+    terminated,
+    done,
+    discount_factor,
+    gae_coef,
+    advantages=None,
+    returns=None,
+    compiled=False,
+):
+    """
+    Generalized advantage estimation, computing the advantages and the returns
+    in a single backward pass
+
+    The advantage of the transition t -> t+1 is stored at index t, so the outputs
+    have the same (T x B) shape as the inputs. The last step and the transitions
+    between two episodes (done[t]) get a zero advantage.
+    The value of a terminated state is not bootstrapped, the one of a truncated state is,
+    and the recursion stops at the end of each episode.
+
+    :param advantages: optional preallocated (T x B) buffer for the advantages
+    :param returns: optional preallocated (T x B) buffer for the returns (value targets)
+    :param compiled: if True, the backward recursion is compiled with torch.compile
+    :return: the advantages (differentiable through value[:-1]) and the detached returns
+    """
+    dtype = value.dtype
+    valid = (~done[:-1]).to(dtype)
+    not_terminated = (~terminated[1:]).to(dtype)
+    delta = (
+        reward[1:] + discount_factor * not_terminated * value[1:].detach() - value[:-1]
+    ) * valid
+    coef = discount_factor * gae_coef * valid * (~done[1:]).to(dtype)
+
+    if advantages is None:
+        advantages = torch.empty(value.shape, dtype=dtype, device=value.device)
+    else:
+        # Drop the graph of the previous use of the buffer
+        advantages = advantages.detach()
+    advantages = _GAEScan.apply(delta, coef, advantages, compiled)
+
+    if returns is None:
+        returns = torch.empty(value.shape, dtype=dtype, device=value.device)
+    torch.add(advantages.detach(), value.detach(), out=returns)
+    return advantages, returns
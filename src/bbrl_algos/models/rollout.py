@@ -0,0 +1,26 @@
+import torch
+
+from bbrl.agents import TemporalAgent
+
+
+class InferenceTemporalAgent(TemporalAgent):
+    """A TemporalAgent that executes its agent under torch.inference_mode
+
+    It should be used for the env + actor chains whose outputs never need a gradient
+    (data collection of off-policy algorithms, evaluation).
+    No graph is built during the rollout and the tensors written into the workspace
+    are already detached, so calling zero_grad() on the workspace is not necessary.
+    """
+
+    def __call__(self, workspace, t=0, n_steps=None, stop_variable=None, **kwargs):
+        with torch.inference_mode():
+            super().__call__(
+                workspace, t=t, n_steps=n_steps, stop_variable=stop_variable, **kwargs
+            )
+
+
+def make_temporal_agent(agent, requires_grad=True, name=None):
+    """Wraps an agent into a TemporalAgent, using the inference mode when no gradient is needed"""
+    if requires_grad:
+        return TemporalAgent(agent, name=name)
+    return InferenceTemporalAgent(agent, name=name)
@@ -0,0 +1,92 @@
+import torch
+
+
+class RolloutBuffer:
+    """
+    Fixed-size storage of the on-policy rollouts of A2C and PPO
+
+    The tensors have a (n_steps x n_envs) layout, the same as the rollout workspace:
+    the transition t -> t+1 is stored at index t, it is valid if the episode was not done at t.
+    They are allocated by the first call to store() and overwritten by the next ones,
+    minibatches are drawn through a permutation of the indices of the valid transitions.
+    """
+
+    # Buffer field -> workspace variable
+    workspace_keys = {
+        "obs": "env/env_obs",
+        "action": "action",
+        "reward": "env/reward",
+        "terminated": "env/terminated",
+        "done": "env/done",
+    }
+
+    def __init__(self):
+        self.n_steps = None
+        self.n_envs = None
+        self.dist_params = None
+
+    def _allocate(self, workspace):
+        reference = workspace[self.workspace_keys["obs"]]
+        self.n_steps, self.n_envs = reference.shape[:2]
+        shape = (self.n_steps, self.n_envs)
+        for field, key in self.workspace_keys.items():
+            setattr(self, field, torch.zeros_like(workspace[key]))
+        for field in ["logprob", "value", "advantage", "returns"]:
+            setattr(self, field, torch.zeros(shape, device=reference.device))
+        self.valid = torch.zeros(shape, dtype=torch.bool, device=reference.device)
+
+    def store(self, workspace, logprob_key=None):
+        """
+        Copies the rollout contained in the workspace into the buffer
+        If logprob_key is given, the log probabilities of the actions are read from this variable
+        """
+        if self.n_steps is None:
+            self._allocate(workspace)
+        for field, key in self.workspace_keys.items():
+            getattr(self, field).copy_(workspace[key])
+        if logprob_key is not None:
+            self.logprob.copy_(workspace[logprob_key])
+        # The last step has no next step, and a done step is followed by a new episode
+        self.valid[:-1] = ~self.done[:-1]
+        self.valid[-1] = False
+
+    def cache_policy_outputs(self, logprob, value, dist_params=None):
+        """
+        Stores the outputs of the policy and the critic that collected the rollout,
+        which are the old policy and critic of the next optimization epochs
+        dist_params are the parameters of the distribution of the policy, if they are needed
+        """
+        self.logprob.copy_(logprob)
+        self.value.copy_(value)
+        if dist_params is not None:
+            if self.dist_params is None:
+                self.dist_params = torch.zeros_like(dist_params)
+            self.dist_params.copy_(dist_params)
+
+    def nb_transitions(self):
+        return int(self.valid.sum())
+
+    def minibatches(self, batch_size, generator=None, nb_batches=None):
+        """
+        Yields tensors of indices covering all the valid transitions once, in a random order
+        If batch_size <= 0, a single batch containing all the transitions is yielded
+        If nb_batches is given, the transitions are split into nb_batches minibatches
+        of about the same size instead, at most one per valid transition so that none is
+        empty: distributed callers clamp nb_batches to the minimum over the ranks beforehand
+        """
+        indices = self.valid.flatten().nonzero().squeeze(-1)
+        permutation = torch.randperm(len(indices), generator=generator)
+        indices = indices[permutation.to(indices.device)]
+        if nb_batches is not None:
+            nb_batches = min(nb_batches, len(indices))
+            if nb_batches > 0:
+                yield from torch.tensor_split(indices, nb_batches)
+            return
+        if batch_size <= 0:
+            batch_size = len(indices)
+        for start in range(0, len(indices), batch_size):
+            yield indices[start : start + batch_size]
+
+    def get(self, indices, *fields):
+        """Returns the given fields at the (flat) indices of a minibatch"""
+        return [getattr(self, field).flatten(0, 1)[indices] for field in fields]
@@ -0,0 +1,114 @@
+"""
+Streaming collection of the evaluations of a run (collect_stats): each evaluation
+appends its step and the reward of each of its episodes to a binary file, flushed at
+once, so that a crashed run keeps its evaluations. The file is a header of HEADER_SIZE
+bytes (MAGIC, version, number of episodes per evaluation) followed by records of
+record_dtype(nb_episodes), which the loaders memory-map without parsing them.
+
+The curves of several runs, as the data files of rliable_stats (evaluations x runs):
+
+    steps, curves = load_runs(glob.glob("./dqn_data/*.stats"))
+"""
+
+import os
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b"BBRLSTAT"
+VERSION = 1
+HEADER_SIZE = 64
+
+
+def record_dtype(nb_episodes):
+    return np.dtype([("nb_steps", "<i8"), ("rewards", "<f4", (nb_episodes,))])
+
+
+def read_header(file):
+    """Returns the number of episodes per evaluation of an open stats file"""
+    magic, version, nb_episodes = struct.unpack(
+        "<8sII", file.read(HEADER_SIZE)[: struct.calcsize("<8sII")]
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{file.name} is not a stats file of version {VERSION}")
+    return nb_episodes
+
+
+class StatsWriter:
+    """
+    Appends the evaluations of a run to path. A new run overwrites the file, a run
+    resumed at resume_step keeps the evaluations up to this step
+    """
+
+    def __init__(self, path, nb_episodes, resume_step=None):
+        self.path = path
+        self.dtype = record_dtype(nb_episodes)
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        if resume_step is not None and os.path.exists(path):
+            steps, rewards = load_stats(path)
+            if rewards.shape[1] != nb_episodes:
+                raise ValueError(f"{path} has another number of episodes")
+            nb_kept = int(np.searchsorted(steps, resume_step, side="right"))
+            # The file is unmapped before being truncated
+            del steps, rewards
+            self.file = open(path, "r+b")
+            # Also drops an evaluation partly written when the run was interrupted
+            self.file.truncate(HEADER_SIZE + nb_kept * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            header = struct.pack("<8sII", MAGIC, VERSION, nb_episodes)
+            self.file.write(header.ljust(HEADER_SIZE, b"\0"))
+            self.file.flush()
+
+    def write(self, nb_steps, rewards):
+        """Appends an evaluation: the (nb_episodes) rewards of its episodes"""
+        if isinstance(rewards, torch.Tensor):
+            rewards = rewards.detach().cpu().numpy()
+        record = np.zeros(1, dtype=self.dtype)
+        record["nb_steps"] = nb_steps
+        record["rewards"] = np.asarray(rewards, dtype=np.float32).reshape(-1)
+        self.file.write(record.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_stats(path):
+    """
+    Memory-maps a stats file, returns the steps (E) and the rewards (E x nb_episodes)
+    of its E evaluations
+    """
+    with open(path, "rb") as file:
+        nb_episodes = read_header(file)
+    dtype = record_dtype(nb_episodes)
+    nb_records = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if nb_records == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, nb_episodes), np.float32)
+    records = np.memmap(
+        path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(nb_records,)
+    )
+    return records["nb_steps"], records["rewards"]
+
+
+def load_runs(paths, episodes=False):
+    """
+    Memory-maps the stats files of several runs, returns the steps of the evaluations
+    of the first run and the mean reward of each evaluation of each run (E x R),
+    or the reward of each episode (E x R x nb_episodes) if episodes.
+    The runs are cut to the number of evaluations of the shortest one
+    """
+    runs = [load_stats(path) for path in paths]
+    nb_evals = min(rewards.shape[0] for _, rewards in runs)
+    if episodes:
+        curves = np.stack([rewards[:nb_evals] for _, rewards in runs], axis=1)
+    else:
+        curves = np.stack(
+            [rewards[:nb_evals].mean(axis=1) for _, rewards in runs], axis=1
+        )
+    return np.array(runs[0][0][:nb_evals]), curves
@@ -5,9 +5,25 @@ from bbrl_algos.models.actors import BaseActor
 from bbrl.agents import TimeAgent, SeedableAgent, SerializableAgent
 
 from torch.distributions.normal import Normal
-from torch.distributions import Bernoulli, Independent
+from torch.distributions import Independent
 from bbrl.utils.distributions import SquashedDiagGaussianDistribution
 
+from bbrl_algos.models.distributions import (
+    categorical_sample,
+    categorical_log_prob,
+    categorical_entropy,
+    categorical_kl,
+    gaussian_sample,
+    gaussian_log_prob,
+    gaussian_entropy,
+    gaussian_kl,
+    squashed_gaussian_sample,
+    squashed_gaussian_log_prob,
+    bernoulli_sample,
+    bernoulli_log_prob,
+    bernoulli_entropy,
+)
+
 from bbrl_algos.models.shared_models import (
     build_mlp,
     build_backbone,
@@ -47,23 +63,21 @@ class BernoulliActor(TimeAgent, SeedableAgent, SerializableAgent):
     def forward(self, t, stochastic=False, **kwargs):
         obs = self.get(("env/env_obs", t))
         mean = self.model(obs)
-        dist = Bernoulli(mean)
-        self.set(("entropy", t), dist.entropy())
+        self.set(("entropy", t), bernoulli_entropy(mean))
         if stochastic:
-            action = dist.sample().int().squeeze(-1)
+            action = bernoulli_sample(mean).int().squeeze(-1)
         else:
             act = mean.lt(0.5)
             action = act.squeeze(-1)
-        # print(f"stoch:{stochastic} obs:{obs} mean:{mean} dist:{dist} action:{action}")
-        log_prob = dist.log_prob(action.float()).sum(axis=-1)
+        # print(f"stoch:{stochastic} obs:{obs} mean:{mean} action:{action}")
+        log_prob = bernoulli_log_prob(mean, action.float().unsqueeze(-1)).sum(axis=-1)
         self.set(("action", t), action)
         self.set(("action_logprobs", t), log_prob)
 
     def predict_action(self, obs, stochastic=False):
         mean = self.model(obs)
-        dist = Bernoulli(mean)
         if stochastic:
-            act = dist.sample().int()
+            act = bernoulli_sample(mean).int()
             return act
         else:
             act = mean.lt(0.5)
@@ -132,37 +146,59 @@ class DiscreteActor(BaseActor):
             observation = kwargs["observation"]
         else:
             observation = self.get(("env/env_obs", t))
-        dist, scores = self.get_distribution(observation)
-        probs = torch.softmax(scores, dim=-1)
+        scores = self.model(observation)
+        log_probs = torch.log_softmax(scores, dim=-1)
 
         if compute_entropy:
-            entropy = dist.entropy()
-            self.set(("entropy", t), entropy)
+            self.set(("entropy", t), categorical_entropy(log_probs))
 
         if predict_proba:
             action = self.get(("action", t))
-            log_prob = probs[torch.arange(probs.size()[0]), action].log()
+            log_prob = categorical_log_prob(log_probs, action)
             self.set((f"{self.name}/logprob_predict", t), log_prob)
         else:
             if stochastic:
-                action = dist.sample()
+                action = categorical_sample(log_probs)
             else:
                 action = scores.argmax(1)
 
-            log_probs = probs[torch.arange(probs.size()[0]), action].log()
-
             self.set(("action", t), action)
-            self.set((f"{self.name}/action_logprobs", t), log_probs)
+            self.set(
+                (f"{self.name}/action_logprobs", t),
+                categorical_log_prob(log_probs, action),
+            )
 
     def predict_action(self, obs, stochastic=False):
-        dist, scores = self.get_distribution(obs)
+        scores = self.model(obs)
 
         if stochastic:
-            action = dist.sample()
+            action = categorical_sample(torch.log_softmax(scores, dim=-1))
         else:
             action = scores.argmax(0)
         return action
 
+    def evaluate_actions(self, obs, action, compute_entropy=False):
+        """Log probabilities (and entropies) of given actions, without using the workspace"""
+        params = self.get_distribution_params(obs)
+        entropy = self.entropy_from_params(params) if compute_entropy else None
+        return self.log_prob_from_params(params, action), entropy
+
+    # The distribution of the policy can be stored as a tensor of parameters,
+    # here the log probabilities of the actions
+
+    def get_distribution_params(self, obs):
+        return torch.log_softmax(self.model(obs), dim=-1)
+
+    def log_prob_from_params(self, params, action):
+        return categorical_log_prob(params, action)
+
+    def entropy_from_params(self, params):
+        return categorical_entropy(params)
+
+    def kl_from_params(self, params_p, params_q):
+        """KL divergence between the distributions of parameters params_p and params_q"""
+        return categorical_kl(params_p, params_q)
+
 
 # All the actors below use a Gaussian policy, that is the output is Normal distribution
 
@@ -207,8 +243,83 @@ class StochasticActor(BaseActor):
         dist, mean = self.get_distribution(obs)
         return dist.sample() if stochastic else mean
 
+    def evaluate_actions(self, obs, action, compute_entropy=False):
+        """Log probabilities (and entropies) of given actions, without using the workspace"""
+        dist, _ = self.get_distribution(obs)
+        entropy = dist.entropy() if compute_entropy else None
+        return dist.log_prob(action), entropy
+
+
+class GaussianActor(StochasticActor):
+    """
+    A stochastic actor whose policy is a diagonal Gaussian
+    Subclasses only provide the mean and the standard deviation,
+    forward and predict_action use the closed-form kernels instead of building a distribution
+    """
+
+    def get_mean_and_std(self, obs: torch.Tensor):
+        raise NotImplementedError
+
+    def get_distribution(self, obs: torch.Tensor):
+        mean, std = self.get_mean_and_std(obs)
+        return Independent(Normal(mean, std), 1), mean
+
+    def forward(
+        self, t, stochastic=False, predict_proba=False, compute_entropy=False, **kwargs
+    ):
+        obs = self.get(("env/env_obs", t))
+        mean, std = self.get_mean_and_std(obs)
+
+        if compute_entropy:
+            self.set(("entropy", t), gaussian_entropy(mean, std))
+
+        if predict_proba:
+            action = self.get(("action", t))
+            log_prob = gaussian_log_prob(mean, std, action)
+            self.set((f"{self.name}/logprob_predict", t), log_prob)
+        else:
+            action = gaussian_sample(mean, std) if stochastic else mean
+
+            self.set(("action", t), action)
+            self.set(
+                (f"{self.name}/action_logprobs", t),
+                gaussian_log_prob(mean, std, action),
+            )
+
+    def predict_action(self, obs, stochastic=False):
+        """Predict just one action (without using the workspace)"""
+        mean, std = self.get_mean_and_std(obs)
+        return gaussian_sample(mean, std) if stochastic else mean
+
+    def evaluate_actions(self, obs, action, compute_entropy=False):
+        """Log probabilities (and entropies) of given actions, without using the workspace"""
+        mean, std = self.get_mean_and_std(obs)
+        entropy = gaussian_entropy(mean, std) if compute_entropy else None
+        return gaussian_log_prob(mean, std, action), entropy
 
-class TunableVarianceContinuousActor(StochasticActor):
+    # The distribution of the policy can be stored as a tensor of parameters,
+    # here the mean and the standard deviation concatenated along the last dimension
+
+    def get_distribution_params(self, obs):
+        mean, std = self.get_mean_and_std(obs)
+        return torch.cat((mean, std.expand_as(mean)), dim=-1)
+
+    def log_prob_from_params(self, params, action):
+        mean, std = params.chunk(2, dim=-1)
+        return gaussian_log_prob(mean, std, action)
+
+    def entropy_from_params(self, params):
+        mean, std = params.chunk(2, dim=-1)
+        return gaussian_entropy(mean, std)
+
+    def kl_from_params(self, params_p, params_q):
+        """KL divergence between the distributions of parameters params_p and params_q"""
+        mean_p, std_p = params_p.chunk(2, dim=-1)
+        mean_q, std_q = params_q.chunk(2, dim=-1)
+        return gaussian_kl(mean_p, std_p, mean_q, std_q)
+
+
+class TunableVarianceContinuousActor(GaussianActor):
     def __init__(
         self, state_dim, hidden_layers, action_dim, name="policy", *args, **kwargs
     ):
@@ -219,13 +330,13 @@ class TunableVarianceContinuousActor(StochasticActor):
         self.std_param = nn.parameter.Parameter(init_variance)
         self.soft_plus = torch.nn.Softplus()
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_and_std(self, obs: torch.Tensor):
         mean = self.model(obs)
         # std must be positive
-        return Independent(Normal(mean, self.soft_plus(self.std_param[:, 0])), 1), mean
+        return mean, self.soft_plus(self.std_param[:, 0])
 
 
-class TunableVarianceContinuousActorExp(StochasticActor):
+class TunableVarianceContinuousActorExp(GaussianActor):
     """
     A variant of the TunableVarianceContinuousActor class where, instead of using a softplus on the std,
     we exponentiate it
@@ -239,13 +350,13 @@ class TunableVarianceContinuousActorExp(StochasticActor):
         self.model = build_mlp(layers, activation=nn.Tanh())
         self.std_param = nn.parameter.Parameter(torch.randn(1, action_dim))
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_and_std(self, obs: torch.Tensor):
         mean = self.model(obs)
         std = torch.clamp(self.std_param, -20, 2)
-        return Independent(Normal(mean, torch.exp(std)), 1), mean
+        return mean, torch.exp(std)
 
 
-class StateDependentVarianceContinuousActor(StochasticActor):
+class StateDependentVarianceContinuousActor(GaussianActor):
     def __init__(
         self, state_dim, hidden_layers, action_dim, name="policy", *args, **kwargs
     ):
@@ -257,15 +368,15 @@ class StateDependentVarianceContinuousActor(StochasticActor):
         self.last_mean_layer = nn.Linear(hidden_layers[-1], action_dim)
         self.last_std_layer = nn.Linear(hidden_layers[-1], action_dim)
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_and_std(self, obs: torch.Tensor):
         backbone_output = self.backbone(obs)
         mean = self.last_mean_layer(backbone_output)
         std_out = self.last_std_layer(backbone_output)
         std = torch.exp(std_out)
-        return Independent(Normal(mean, std), 1), mean
+        return mean, std
 
 
-class ConstantVarianceContinuousActor(StochasticActor):
+class ConstantVarianceContinuousActor(GaussianActor):
     def __init__(
         self, state_dim, hidden_layers, action_dim, name="policy", *args, **kwargs
     ):
@@ -274,9 +385,9 @@ class ConstantVarianceContinuousActor(StochasticActor):
         self.model = build_mlp(layers, activation=nn.Tanh())
         self.std_param = 2
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_and_std(self, obs: torch.Tensor):
         mean = self.model(obs)
-        return Normal(mean, self.std_param), mean
+        return mean, torch.full_like(mean, self.std_param)
 
 
 class SquashedGaussianActor(StochasticActor):
@@ -291,21 +402,73 @@ class SquashedGaussianActor(StochasticActor):
         self.last_std_layer = nn.Linear(hidden_layers[-1], action_dim)
         self.action_dist = SquashedDiagGaussianDistribution(action_dim)
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_and_std(self, obs: torch.Tensor):
         backbone_output = self.backbone(obs)
         mean = self.last_mean_layer(backbone_output)
         std_out = self.last_std_layer(backbone_output)
 
         std_out = std_out.clamp(-20, 2)  # as in the official code
         std = torch.exp(std_out)
+        return mean, std
+
+    def get_distribution(self, obs: torch.Tensor):
+        mean, std = self.get_mean_and_std(obs)
         return self.action_dist.make_distribution(mean, std), mean
 
+    def get_action_std(self, std: torch.Tensor):
+        # make_distribution() takes its second argument as a log std,
+        # the kernels use the same standard deviation as the distribution
+        return std.exp()
+
+    def forward(
+        self, t, stochastic=False, predict_proba=False, compute_entropy=False, **kwargs
+    ):
+        obs = self.get(("env/env_obs", t))
+        mean, std = self.get_mean_and_std(obs)
+        action_std = self.get_action_std(std)
+
+        if compute_entropy:
+            raise Exception("Call to entropy in squashed Diag Gaussian distribution")
+
+        if predict_proba:
+            action = self.get(("action", t))
+            log_prob = squashed_gaussian_log_prob(mean, action_std, action=action)
+            self.set((f"{self.name}/logprob_predict", t), log_prob)
+        else:
+            if stochastic:
+                action, gaussian_action = squashed_gaussian_sample(mean, action_std)
+                log_prob = squashed_gaussian_log_prob(
+                    mean, action_std, gaussian_action=gaussian_action
+                )
+            else:
+                action = mean
+                log_prob = squashed_gaussian_log_prob(mean, action_std, action=action)
+
+            self.set(("action", t), action)
+            self.set((f"{self.name}/action_logprobs", t), log_prob)
+
+    def predict_action(self, obs, stochastic=False):
+        """Predict just one action (without using the workspace)"""
+        mean, std = self.get_mean_and_std(obs)
+        if stochastic:
+            action, _ = squashed_gaussian_sample(mean, self.get_action_std(std))
+            return action
+        return mean
+
+    def evaluate_actions(self, obs, action, compute_entropy=False):
+        """Log probabilities of given actions, without using the workspace"""
+        if compute_entropy:
+            raise Exception("Call to entropy in squashed Diag Gaussian distribution")
+        mean, std = self.get_mean_and_std(obs)
+        action_std = self.get_action_std(std)
+        return squashed_gaussian_log_prob(mean, action_std, action=action), None
+
     def test(self, obs, action):
         action_dist = self.get_distribution(obs)
         return action_dist.log_prob(action)
 
 
-class TunableVariancePPOActor(StochasticActor):
+class TunableVariancePPOActor(GaussianActor):
     """
     The official PPO actor uses Tanh activation functions and orthogonal initialization
     """
@@ -320,7 +483,7 @@ class TunableVariancePPOActor(StochasticActor):
         self.std_param = nn.parameter.Parameter(init_variance)
         self.soft_plus = torch.nn.Softplus()
 
-    def get_distribution(self, obs: torch.Tensor):
+    def get_mean_and_std(self, obs: torch.Tensor):
         mean = self.model(obs)
         # std must be positive
-        return Independent(Normal(mean, self.soft_plus(self.std_param[:, 0])), 1), mean
+        return mean, self.soft_plus(self.std_param[:, 0])
@@ -0,0 +1,177 @@
+"""
+Deterministic synthetic environments of negligible cost, to benchmark the learners
+without the cost of the simulators. SyntheticDiscrete-v0 has the sizes of CartPole
+and SyntheticContinuous-v0 those of Pendulum, other sizes are set by
+
+    gym_env:
+      env_name: SyntheticContinuous-v0
+      make_env_args:
+        obs_dim: 17
+        action_dim: 6
+        max_episode_steps: 1000
+
+They are registered when this module is imported. get_env_agents builds them as
+a SyntheticEnvAgent, which steps all the environments at once.
+"""
+
+import numpy as np
+import torch
+import gymnasium
+from gymnasium import spaces
+
+from bbrl.agents.gymnasium import GymAgent
+
+
+class SyntheticDynamics:
+    """
+    A fixed random linear recurrence of the observations driven by the actions,
+    squashed by tanh, the reward is minus the mean square of the observation.
+    It only depends on seed, not on the seeds of the episodes.
+    """
+
+    def __init__(self, obs_dim, action_dim, discrete, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.obs_dim = obs_dim
+        self.discrete = discrete
+        self.transition = (
+            0.9 * torch.randn(obs_dim, obs_dim, generator=generator) / obs_dim**0.5
+        )
+        self.action_effect = 0.1 * torch.randn(action_dim, obs_dim, generator=generator)
+
+    def initial_states(self, nb_states, generator):
+        return 0.2 * torch.rand(nb_states, self.obs_dim, generator=generator) - 0.1
+
+    def step(self, states, actions):
+        """Steps a batch of (B x obs_dim) states, returns the next states and the rewards"""
+        if self.discrete:
+            effect = self.action_effect[actions.long().view(-1)]
+        else:
+            actions = actions.float().view(states.shape[0], -1).clamp(-1.0, 1.0)
+            effect = actions @ self.action_effect
+        states = torch.tanh(states @ self.transition + effect)
+        return states, -states.square().mean(dim=1)
+
+
+class SyntheticEnv(gymnasium.Env):
+    def __init__(
+        self, obs_dim=4, action_dim=2, discrete=True, seed=0, render_mode=None
+    ):
+        self.observation_space = spaces.Box(-1.0, 1.0, (obs_dim,), np.float32)
+        if discrete:
+            self.action_space = spaces.Discrete(action_dim)
+        else:
+            self.action_space = spaces.Box(-1.0, 1.0, (action_dim,), np.float32)
+        self.dynamics = SyntheticDynamics(obs_dim, action_dim, discrete, seed)
+        self.generator = torch.Generator()
+        self.render_mode = render_mode
+        self.state = None
+
+    def reset(self, *, seed=None, options=None):
+        super().reset(seed=seed)
+        self.generator.manual_seed(int(self.np_random.integers(2**31)))
+        self.state = self.dynamics.initial_states(1, self.generator)
+        return self.state[0].numpy(), {}
+
+    def step(self, action):
+        self.state, reward = self.dynamics.step(self.state, torch.as_tensor(action))
+        return self.state[0].numpy(), reward.item(), False, False, {}
+
+
+class SyntheticEnvAgent(GymAgent):
+    """
+    num_envs synthetic environments stepped at once, writing the same variables as
+    a ParallelGymAgent. With autoreset, the last state of each episode is included.
+    """
+
+    def __init__(
+        self,
+        env_name,
+        num_envs,
+        autoreset=False,
+        include_last_state=True,
+        make_env_args=None,
+        **kwargs,
+    ):
+        super().__init__(include_last_state=include_last_state, **kwargs)
+        spec = gymnasium.spec(env_name.split(":")[-1])
+        env_args = {**spec.kwargs, **(make_env_args or {})}
+        self.max_episode_steps = env_args.pop(
+            "max_episode_steps", spec.max_episode_steps
+        )
+        env = SyntheticEnv(**env_args)
+        # Describes all the environments, as envs[0] of a ParallelGymAgent
+        self.envs = [env]
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        self.dynamics = env.dynamics
+        self.num_envs = num_envs
+        self.autoreset = autoreset
+        assert include_last_state or not autoreset, "The last state is always included"
+        self.generator = torch.Generator()
+
+    def forward(self, t=0, **kwargs):
+        super().forward(t, **kwargs)
+        if t == 0:
+            self.generator.manual_seed(self._seed * self._nb_reset)
+            self.states = self.dynamics.initial_states(self.num_envs, self.generator)
+            self.timestep = torch.zeros(self.num_envs, dtype=torch.long)
+            self.cumulated_reward = torch.zeros(self.num_envs)
+            # The environments showing the first state of a new episode (autoreset),
+            # or repeating their last state with a null reward (no autoreset)
+            self.pending = torch.zeros(self.num_envs, dtype=torch.bool)
+            reward = torch.zeros(self.num_envs)
+            truncated = torch.zeros(self.num_envs, dtype=torch.bool)
+        else:
+            action = self.get((self.input, t - 1))
+            stepping = ~self.pending
+            states, reward = self.dynamics.step(self.states, action)
+            self.states = torch.where(stepping.unsqueeze(1), states, self.states)
+            reward = torch.where(stepping, reward, torch.zeros_like(reward))
+            self.timestep += stepping
+            self.cumulated_reward += reward
+            truncated = stepping & (self.timestep >= self.max_episode_steps)
+            if not self.autoreset:
+                truncated |= self.pending
+
+        self.set_obs(
+            {
+                "env_obs": self.states.clone(),
+                "terminated": torch.zeros(self.num_envs, dtype=torch.bool),
+                "truncated": truncated,
+                "done": truncated.clone(),
+                "reward": reward,
+                "cumulated_reward": self.cumulated_reward.clone(),
+                "timestep": self.timestep.clone(),
+            },
+            t,
+        )
+
+        self.pending = truncated
+        if self.autoreset and truncated.any():
+            self.states[truncated] = self.dynamics.initial_states(
+                int(truncated.sum()), self.generator
+            )
+            self.timestep[truncated] = 0
+            self.cumulated_reward[truncated] = 0.0
+
+
+def is_synthetic_env(env_name):
+    env_id = env_name.split(":")[-1]
+    return (
+        env_id in gymnasium.registry
+        and gymnasium.registry[env_id].entry_point is SyntheticEnv
+    )
+
+
+gymnasium.register(
+    id="SyntheticDiscrete-v0",
+    entry_point=SyntheticEnv,
+    max_episode_steps=200,
+    kwargs={"obs_dim": 4, "action_dim": 2, "discrete": True},
+)
+gymnasium.register(
+    id="SyntheticContinuous-v0",
+    entry_point=SyntheticEnv,
+    max_episode_steps=200,
+    kwargs={"obs_dim": 3, "action_dim": 1, "discrete": False},
+)
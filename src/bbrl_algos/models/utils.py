@@ -83,7 +83,7 @@ def compare(v, q, pol):
 
 
 def save_best(agent, env_name, score, dirname, fileroot):
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-        filename = dirname + env_name + fileroot + str(score.item()) + ".agt"
-        agent.save_model(filename)
+    # The training loops of DQN, DDPG, SAC and A2C use checkpoint.CheckpointManager
+    os.makedirs(dirname, exist_ok=True)
+    filename = dirname + env_name + fileroot + str(score.item()) + ".agt"
+    agent.save_model(filename)
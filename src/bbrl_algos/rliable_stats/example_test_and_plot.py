@@ -1,14 +1,19 @@
 """
 In this script we show how to test and plot RL results.
 
+The curves of runs collected with collect_stats can be compared instead of the data files:
+
+    python example_test_and_plot.py "./dqn_data/*.stats" "./ddqn_data/*.stats"
 """
 from scipy.stats import ttest_ind
+import glob
 import sys
 sys.path.append('./src')
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 from bbrl_algos.rliable_stats.tests import run_test
+from bbrl_algos.models.stats import load_runs
 
 font = {"family": "normal", "size": 70}
 matplotlib.rc("font", **font)
@@ -17,8 +22,13 @@ sys.path.append("../")
 
 save = False  # save in ./plot.png if True
 
-dqn_perfs = np.loadtxt("./src/bbrl_algos/rliable_stats/data_files/dqn_curve.txt")
-ddqn_perfs = np.loadtxt("./src/bbrl_algos/rliable_stats/data_files/ddqn_curve.txt")
+if len(sys.argv) > 2:
+    # (# of evaluations x # of runs) mean rewards, memory-mapped from the stats files
+    dqn_perfs = load_runs(sorted(glob.glob(sys.argv[1])))[1]
+    ddqn_perfs = load_runs(sorted(glob.glob(sys.argv[2])))[1]
+else:
+    dqn_perfs = np.loadtxt("./src/bbrl_algos/rliable_stats/data_files/dqn_curve.txt")
+    ddqn_perfs = np.loadtxt("./src/bbrl_algos/rliable_stats/data_files/ddqn_curve.txt")
 nb_datapoints = dqn_perfs.shape[1]
 nb_steps = dqn_perfs.shape[0]
 
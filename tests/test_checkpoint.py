@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from bbrl.utils.replay_buffer import ReplayBuffer
+from bbrl.workspace import Workspace
+
+from bbrl_algos.algos.dqn.dqn import run_dqn
+from bbrl_algos.models.checkpoint import ReplaySegments, load_checkpoint
+from bbrl_algos.models.loggers import Logger
+from bbrl_algos.models.stats import load_stats
+
+ALGOS_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "bbrl_algos", "algos")
+
+
+def put_transitions(rb, first, nb_transitions):
+    """Puts the transitions first, first + 1... whose values are their number"""
+    values = torch.arange(first, first + nb_transitions, dtype=torch.float32)
+    workspace = Workspace()
+    workspace.set_full("x", torch.stack([values, values + 0.5]))
+    rb.put(workspace)
+
+
+def test_replay_segments_rebuild_a_buffer_which_wrapped_around(tmp_path):
+    directory = str(tmp_path / "replay")
+    rb = ReplayBuffer(max_size=10)
+    segments = ReplaySegments(directory)
+    nb_puts = 0
+    for nb_transitions in (4, 4, 5, 5, 4):
+        put_transitions(rb, nb_puts, nb_transitions)
+        nb_puts += nb_transitions
+        files = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        state = segments.save(rb, nb_puts)
+        # The segments overwritten since are only deleted once the checkpoint is saved
+        assert files <= set(os.listdir(directory))
+        segments.remove_obsolete()
+        # Each kept segment holds some of the last 10 transitions
+        assert all(segment["end"] > nb_puts - 10 for segment in state["segments"])
+        assert len(os.listdir(directory)) == len(state["segments"])
+
+        restored = ReplayBuffer(max_size=10)
+        ReplaySegments(directory).load(restored, state)
+        assert restored.position == rb.position
+        assert restored.is_full == rb.is_full
+        torch.testing.assert_close(restored.variables["x"], rb.variables["x"])
+
+    # 22 transitions were put: only the segments of the last 10 are kept
+    assert [(s["start"], s["end"]) for s in state["segments"]] == [
+        (8, 13),
+        (13, 18),
+        (18, 22),
+    ]
+
+
+def test_replay_segments_delete_the_segments_of_an_interrupted_save(tmp_path):
+    directory = str(tmp_path / "replay")
+    rb = ReplayBuffer(max_size=10)
+    segments = ReplaySegments(directory)
+    put_transitions(rb, 0, 4)
+    state = segments.save(rb, 4)
+    # Saved after the checkpoint, which was not written
+    put_transitions(rb, 4, 3)
+    segments.save(rb, 7)
+
+    restored = ReplayBuffer(max_size=10)
+    ReplaySegments(directory).load(restored, state)
+    assert os.listdir(directory) == ["segment_0_4.pt"]
+    assert restored.position == 4
+    torch.testing.assert_close(restored.variables["x"][:4], rb.variables["x"][:4])
+
+
+def dqn_config(checkpoint, n_steps, tmp_path):
+    """A short DQN run on the synthetic environment, its small buffer wraps around"""
+    cfg = OmegaConf.load(os.path.join(ALGOS_DIR, "dqn", "configs", "dqn_cartpole.yaml"))
+    cfg.pop("hydra")
+    cfg.gym_env = {"env_name": "SyntheticDiscrete-v0"}
+    cfg.save_best = cfg.plot_agents = False
+    cfg.visualize = False
+    cfg.logger.log_dir = str(tmp_path / "logs")
+    algo = cfg.algorithm
+    algo.architecture.hidden_sizes = [16]
+    algo.n_envs, algo.n_steps_train, algo.nb_evals = 2, 11, 2
+    algo.buffer.max_size, algo.buffer.learning_starts = 64, 20
+    algo.buffer.batch_size = 8
+    algo.target_critic_update_interval = 30
+    algo.n_steps, algo.eval_interval = n_steps, 40
+    algo.checkpoint = str(checkpoint)
+    return cfg
+
+
+def run(cfg):
+    # As main does, a resumed run then restores the random states of its checkpoint
+    torch.random.manual_seed(cfg.algorithm.seed.torch)
+    logger = Logger(cfg)
+    try:
+        return run_dqn(cfg, logger)
+    finally:
+        logger.close()
+
+
+def test_a_resumed_dqn_run_reproduces_the_uninterrupted_one(tmp_path, monkeypatch):
+    (tmp_path / "uninterrupted").mkdir()
+    monkeypatch.chdir(tmp_path / "uninterrupted")
+    run(dqn_config(tmp_path / "uninterrupted.ckpt", 300, tmp_path))
+
+    # Stopped after 150 steps (in the middle of episodes), then resumed
+    (tmp_path / "resumed").mkdir()
+    monkeypatch.chdir(tmp_path / "resumed")
+    run(dqn_config(tmp_path / "resumed.ckpt", 150, tmp_path))
+    assert load_checkpoint(str(tmp_path / "resumed.ckpt"))["nb_steps"] < 300
+    run(dqn_config(tmp_path / "resumed.ckpt", 300, tmp_path))
+
+    expected = load_checkpoint(str(tmp_path / "uninterrupted.ckpt"))
+    checkpoint = load_checkpoint(str(tmp_path / "resumed.ckpt"))
+    assert checkpoint["nb_steps"] == expected["nb_steps"]
+    assert checkpoint["epsilon"] == expected["epsilon"]
+    for name in ("q_agent", "target_q_agent"):
+        for key, value in expected[name].items():
+            torch.testing.assert_close(checkpoint[name][key], value)
+
+    rbs = []
+    for name in ("uninterrupted", "resumed"):
+        rb = ReplayBuffer(max_size=64)
+        path = str(tmp_path / f"{name}.ckpt.replay")
+        state = load_checkpoint(str(tmp_path / f"{name}.ckpt"))["replay_segments"]
+        ReplaySegments(path).load(rb, state)
+        rbs.append(rb)
+    assert rbs[0].is_full and rbs[1].position == rbs[0].position
+    for key, value in rbs[0].variables.items():
+        torch.testing.assert_close(rbs[1].variables[key], value)
+
+    # The same evaluations, those before the interruption kept by the stats file
+    path = "dqn_data/dqn_SyntheticDiscrete-v0.stats"
+    steps, rewards = load_stats(str(tmp_path / "uninterrupted" / path))
+    resumed_steps, resumed_rewards = load_stats(str(tmp_path / "resumed" / path))
+    np.testing.assert_array_equal(resumed_steps, steps)
+    np.testing.assert_array_equal(resumed_rewards, rewards)
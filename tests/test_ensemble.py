@@ -0,0 +1,52 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from bbrl_algos.models.ensemble import (
+    Ensemble,
+    clip_grad_norm_per_member,
+    member_mean,
+    split_members,
+)
+
+MAX_GRAD_NORM = 0.05
+
+
+def test_one_stacked_optimizer_matches_independent_members():
+    torch.manual_seed(0)
+    modules = [
+        nn.Sequential(nn.Linear(3, 8), nn.Tanh(), nn.Linear(8, 2)) for _ in range(2)
+    ]
+    ensemble = Ensemble(modules)
+    members = [copy.deepcopy(module) for module in modules]
+    ensemble_optimizer = torch.optim.Adam(ensemble.parameters(), lr=0.1)
+    member_optimizers = [torch.optim.Adam(m.parameters(), lr=0.1) for m in members]
+
+    for _ in range(3):
+        # The member i gets the i-th block of the batch
+        obs = torch.randn(2 * 5, 3)
+        target = torch.randn(2 * 5, 2)
+
+        output = ensemble.call("forward", obs)
+        losses = member_mean(split_members((output - target) ** 2, 2))
+        ensemble_optimizer.zero_grad()
+        losses.sum().backward()
+        norms = clip_grad_norm_per_member(ensemble.parameters(), MAX_GRAD_NORM)
+        ensemble_optimizer.step()
+
+        for index, (member, optimizer) in enumerate(zip(members, member_optimizers)):
+            block = slice(5 * index, 5 * (index + 1))
+            loss = ((member(obs[block]) - target[block]) ** 2).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            norm = nn.utils.clip_grad_norm_(member.parameters(), MAX_GRAD_NORM)
+            optimizer.step()
+            torch.testing.assert_close(losses[index], loss)
+            torch.testing.assert_close(norms[index], norm)
+            # The clipping is active, the norms are far above MAX_GRAD_NORM
+            assert norm > 2 * MAX_GRAD_NORM
+
+    for index, member in enumerate(members):
+        for stacked, param in zip(ensemble.stacked, member.parameters()):
+            torch.testing.assert_close(stacked[index], param)
@@ -0,0 +1,92 @@
+import optuna
+import pytest
+from omegaconf import OmegaConf
+
+from bbrl_algos.algos.dqn.dqn import run_dqn
+from bbrl_algos.models.checkpoint import load_checkpoint
+from bbrl_algos.models.hyper_params import resumable, run_hyperband
+
+
+def hyperband_config(tmp_path):
+    """A short DQN study on the synthetic environment, in brackets of 300 and 900 steps"""
+    return OmegaConf.create(
+        {
+            "save_best": False,
+            "plot_agents": False,
+            "collect_stats": False,
+            "visualize": False,
+            "optuna": {
+                "hyperband": {
+                    "min_steps": 300,
+                    "reduction_factor": 3,
+                    "checkpoint_dir": str(tmp_path / "checkpoints"),
+                }
+            },
+            "logger": {
+                "classname": "bbrl.utils.logger.TFLogger",
+                "log_dir": str(tmp_path / "logs"),
+                "cache_size": 10000,
+                "every_n_seconds": 10,
+                "verbose": False,
+            },
+            "gym_env": {"env_name": "SyntheticDiscrete-v0"},
+            "algorithm": {
+                "architecture": {"hidden_sizes": [16]},
+                "seed": {"train": 1, "eval": 2, "q": 3, "explorer": 4, "torch": 5},
+                "explorer": {"epsilon_start": 0.7, "epsilon_end": 0.2, "decay": 0.99},
+                "buffer": {"max_size": 1000, "batch_size": 16, "learning_starts": 50},
+                "target_critic_update_interval": 50,
+                "max_grad_norm": 0.5,
+                "nb_evals": 2,
+                "n_envs": 2,
+                "n_steps_train": 11,
+                "optim_n_updates": 1,
+                "discount_factor": {
+                    "suggest_type": "categorical",
+                    "choices": [0.9, 0.99],
+                },
+                "n_steps": 900,
+                "eval_interval": 300,
+            },
+            "optimizer": {"classname": "torch.optim.Adam", "lr": 1e-3},
+        }
+    )
+
+
+def test_promoted_trials_resume_at_their_rung_step(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    @resumable
+    def run(cfg, logger, trial=None):
+        checkpoint = load_checkpoint(cfg.algorithm.checkpoint)
+        start = 0 if checkpoint is None else checkpoint["nb_steps"]
+        best_reward = run_dqn(cfg, logger, trial)
+        end = load_checkpoint(cfg.algorithm.checkpoint)["nb_steps"]
+        calls.append((cfg.algorithm.checkpoint, start, end))
+        return best_reward
+
+    study = optuna.create_study(direction="maximize")
+    run_hyperband(study, hyperband_config(tmp_path), run)
+
+    # A bracket of 3 trials (300 steps) promoting one to 900 steps, then 2 trials of 900
+    assert len(calls) == 6
+    first_rung, promoted = calls[:3], calls[3]
+    resumed = [call for call in first_rung if call[0] == promoted[0]]
+    assert len(resumed) == 1
+    assert all(start == 0 and 300 <= end < 900 for _, start, end in first_rung)
+    # The promoted trial goes on from the step its first rung ended at
+    assert promoted[1] == resumed[0][2]
+    assert promoted[2] >= 900
+    assert all(start == 0 for _, start, _ in calls[4:])
+    assert len(study.get_trials(states=(optuna.trial.TrialState.COMPLETE,))) == 3
+
+
+def test_hyperband_needs_a_resumable_run_function(tmp_path):
+    def run(cfg, logger, trial=None):
+        return 0.0
+
+    study = optuna.create_study(direction="maximize")
+    with pytest.raises(ValueError):
+        run_hyperband(study, hyperband_config(tmp_path), run)
+    assert len(study.trials) == 0
@@ -0,0 +1,19 @@
+import torch
+from torch.distributions import MultivariateNormal
+
+from bbrl_algos.models.importance_mixing import importance_mixing
+
+
+def test_reused_samples_are_a_random_subset():
+    torch.manual_seed(0)
+    dist = MultivariateNormal(torch.zeros(3), torch.eye(3))
+    old_weights = dist.sample((200,))
+
+    reused, fresh = importance_mixing(dist, dist, old_weights, 20, 0.5)
+
+    assert len(reused) == 10
+    assert len(reused) + len(fresh) == 20
+    assert len(set(reused.tolist())) == len(reused)
+    # With the same distribution, about half of the 200 old samples are kept:
+    # the reused ones are drawn among all of them, not the first ones
+    assert reused.max() > 50
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import torch
+
+from bbrl_algos.models.loggers import AsyncScalarWriter
+
+
+class RecordingLogger:
+    """Records the scalars, and fails if two threads write at the same time"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.scalars = []
+        self.writing = threading.Lock()
+        self.concurrent_writes = 0
+
+    def add_scalar(self, key, value, step):
+        if not self.writing.acquire(blocking=False):
+            self.concurrent_writes += 1
+            return
+        time.sleep(self.delay)
+        self.scalars.append((key, value, step))
+        self.writing.release()
+
+    def flush(self):
+        self.add_scalar("flush", 0.0, -1)
+
+    def close(self):
+        pass
+
+
+def test_a_step_split_across_flushes_is_written_once_with_all_its_values():
+    logger = RecordingLogger()
+    writer = AsyncScalarWriter(logger, every_n_seconds=3600)
+    writer.add_scalar("loss", torch.tensor(1.0), 10)
+    writer.add_scalar("loss", torch.tensor(2.0), 20)
+    writer.flush()
+    # Step 20 may still get values
+    assert [s for s in logger.scalars if s[0] == "loss"] == [("loss", 1.0, 10)]
+
+    writer.add_scalar("loss", torch.tensor(4.0), 20)
+    writer.add_scalar("loss", 6.0, 30)
+    writer.flush()
+    writer.close()
+    assert [s for s in logger.scalars if s[0] == "loss"] == [
+        ("loss", 1.0, 10),
+        ("loss", 3.0, 20),
+        ("loss", 6.0, 30),
+    ]
+
+
+def test_the_flushes_and_the_background_thread_do_not_write_concurrently():
+    logger = RecordingLogger(delay=0.0005)
+    writer = AsyncScalarWriter(logger, every_n_seconds=0.0001)
+    keys = [f"key_{k}" for k in range(10)]
+    for step in range(100):
+        for key in keys:
+            writer.add_scalar(key, float(step), step)
+        # Lets the background thread start writing
+        time.sleep(0.001)
+        writer.flush()
+    writer.close()
+    assert logger.concurrent_writes == 0
+    steps = [step for key, _, step in logger.scalars if key == "key_0"]
+    assert steps == list(range(100))
@@ -0,0 +1,87 @@
+import importlib
+import os
+
+import pytest
+from omegaconf import OmegaConf
+
+from bbrl_algos.models.loggers import Logger
+from bbrl_algos.models.memory import (
+    estimate_memory,
+    module_bytes,
+    optimizer_bytes,
+    replay_buffer_bytes,
+)
+
+ALGOS_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "bbrl_algos", "algos")
+
+
+class MemoryMeasured(Exception):
+    pass
+
+
+def short_run_config(algorithm, config_name, env_name, tmp_path):
+    """The configuration of the repository, for a few steps on a synthetic environment"""
+    cfg = OmegaConf.load(os.path.join(ALGOS_DIR, algorithm, "configs", config_name))
+    for key in ("hydra", "async_logger", "best_checkpoints"):
+        cfg.pop(key, None)
+    cfg.gym_env = {"env_name": env_name}
+    cfg.save_best = cfg.plot_agents = cfg.collect_stats = cfg.visualize = False
+    cfg.log_memory = True
+    cfg.logger = {
+        "classname": "bbrl.utils.logger.TFLogger",
+        "log_dir": str(tmp_path),
+        "cache_size": 10000,
+        "every_n_seconds": 10,
+        "verbose": False,
+    }
+    algo = cfg.algorithm
+    algo.n_envs, algo.n_steps_train, algo.nb_evals = 2, 5, 2
+    algo.n_steps, algo.eval_interval = 100, 20
+    algo.architecture = {
+        key: [16, 8] for key in algo.architecture if "hidden_size" in key
+    }
+    if "buffer" in algo:
+        algo.buffer.max_size, algo.buffer.learning_starts = 64, 10
+        algo.buffer.batch_size = 8
+    else:
+        algo.buffer_size, algo.learning_starts, algo.batch_size = 64, 10, 8
+    return cfg
+
+
+@pytest.mark.parametrize(
+    "algorithm, config_name, env_name",
+    [
+        ("dqn", "dqn_cartpole.yaml", "SyntheticDiscrete-v0"),
+        ("ddpg", "ddpg_pendulum.yaml", "SyntheticContinuous-v0"),
+        ("sac", "sac_pendulum.yaml", "SyntheticContinuous-v0"),
+    ],
+)
+def test_estimate_matches_the_memory_of_a_short_run(
+    algorithm, config_name, env_name, tmp_path, monkeypatch
+):
+    module = importlib.import_module(f"bbrl_algos.algos.{algorithm}.{algorithm}")
+    cfg = short_run_config(algorithm, config_name, env_name, tmp_path)
+    measured = {}
+
+    def measure_memory(logger, nb_steps, replay_buffer, workspaces, models, optimizers):
+        for key, nb_bytes in replay_buffer_bytes(replay_buffer).items():
+            measured[f"replay/{key}"] = nb_bytes
+        for name, model in models.items():
+            measured[f"model/{name}"] = module_bytes(model)
+        for name, optimizer in optimizers.items():
+            measured[f"optimizer/{name}"] = optimizer_bytes(optimizer)
+        # The first evaluation comes after the first updates
+        raise MemoryMeasured()
+
+    monkeypatch.setattr(module, "log_memory", measure_memory)
+    logger = Logger(cfg)
+    with pytest.raises(MemoryMeasured):
+        getattr(module, f"run_{algorithm}")(cfg, logger)
+    logger.close()
+
+    estimate = estimate_memory(cfg, algorithm)
+    assert measured == {
+        key: nb_bytes
+        for key, nb_bytes in estimate.items()
+        if not key.startswith("workspace/")
+    }
@@ -0,0 +1,38 @@
+from omegaconf import OmegaConf
+
+from bbrl.agents import Agents, TemporalAgent
+from bbrl.workspace import Workspace
+
+from bbrl_algos.algos.ppo.ppo_clip_full import collect_rollout
+from bbrl_algos.models.envs import get_env_agents
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
+from bbrl_algos.models.stochastic_actors import DiscreteActor
+
+
+def test_collect_rollout_keeps_the_buffer_size_across_epochs():
+    cfg = OmegaConf.create(
+        {
+            "gym_env": {"env_name": "CartPole-v1"},
+            "algorithm": {
+                "n_envs": 2,
+                "n_steps_train": 8,
+                "nb_evals": 1,
+                "seed": {"train": 1, "eval": 2},
+            },
+        }
+    )
+    train_env_agent, _ = get_env_agents(cfg)
+    obs_size, act_size = train_env_agent.get_obs_and_actions_sizes()
+    policy = DiscreteActor(obs_size, [16], act_size, name="current_policy")
+    train_agent = TemporalAgent(Agents(train_env_agent, policy))
+    train_workspace = Workspace()
+    rollout_buffer = RolloutBuffer()
+
+    for epoch in range(3):
+        collect_rollout(cfg, train_agent, train_workspace, rollout_buffer, epoch)
+        assert rollout_buffer.obs.shape[:2] == (8, 2)
+        assert train_workspace.time_size() == 8
+    # The rollout of an epoch starts from the last step of the previous one
+    last_obs = rollout_buffer.obs[-1].clone()
+    collect_rollout(cfg, train_agent, train_workspace, rollout_buffer, 3)
+    assert (rollout_buffer.obs[0] == last_obs).all()
@@ -0,0 +1,117 @@
+import pytest
+import torch
+
+from bbrl_algos.models.returns import _GAEScan, discounted_returns, gae_advantages
+
+DISCOUNT = 0.9
+GAE = 0.8
+
+
+def make_rollout(dtype=torch.float32):
+    """A (T x B) rollout with episodes ending inside it, terminated and truncated"""
+    generator = torch.Generator().manual_seed(0)
+    n_steps, n_envs = 9, 3
+    value = torch.randn(n_steps, n_envs, generator=generator, dtype=dtype)
+    reward = torch.randn(n_steps, n_envs, generator=generator, dtype=dtype)
+    terminated = torch.zeros(n_steps, n_envs, dtype=torch.bool)
+    done = torch.zeros(n_steps, n_envs, dtype=torch.bool)
+    # env 0: terminated at 3, env 1: truncated at 4 then terminated at 7,
+    # env 2: a single episode going on after the rollout
+    terminated[3, 0] = done[3, 0] = True
+    done[4, 1] = True
+    terminated[7, 1] = done[7, 1] = True
+    return value, reward, terminated, done
+
+
+def naive_gae(value, reward, terminated, done):
+    """The GAE recursion written step by step, the next values being detached"""
+    n_steps, n_envs = value.shape
+    advantages = [[value.new_zeros(()) for _ in range(n_envs)] for _ in range(n_steps)]
+    for b in range(n_envs):
+        for t in reversed(range(n_steps - 1)):
+            if done[t, b]:
+                # The transition from the last state of an episode is not valid
+                continue
+            next_value = 0.0 if terminated[t + 1, b] else value[t + 1, b].detach()
+            delta = reward[t + 1, b] + DISCOUNT * next_value - value[t, b]
+            next_advantage = 0.0 if done[t + 1, b] else advantages[t + 1][b]
+            advantages[t][b] = delta + DISCOUNT * GAE * next_advantage
+    return torch.stack([torch.stack(row) for row in advantages])
+
+
+def naive_returns(reward, done):
+    n_steps, n_envs = reward.shape
+    returns = torch.zeros_like(reward)
+    for b in range(n_envs):
+        next_return = 0.0
+        for t in reversed(range(n_steps)):
+            if done[t, b]:
+                next_return = 0.0
+            returns[t, b] = reward[t, b] + DISCOUNT * next_return
+            next_return = returns[t, b]
+    return returns
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_gae_advantages_match_the_naive_recursion(compiled):
+    value, reward, terminated, done = make_rollout()
+    value.requires_grad_(True)
+    advantages, returns = gae_advantages(
+        value, reward, terminated, done, DISCOUNT, GAE, compiled=compiled
+    )
+    expected = naive_gae(value, reward, terminated, done)
+    torch.testing.assert_close(advantages, expected)
+    torch.testing.assert_close(returns, expected.detach() + value.detach())
+    assert not returns.requires_grad
+
+    # The gradient with respect to the values goes through the backward recursion
+    weights = torch.randn_like(advantages)
+    (grad,) = torch.autograd.grad((advantages * weights).sum(), value)
+    (expected_grad,) = torch.autograd.grad((expected * weights).sum(), value)
+    torch.testing.assert_close(grad, expected_grad)
+
+
+def test_gae_advantages_write_into_the_given_buffers():
+    value, reward, terminated, done = make_rollout()
+    advantages_buffer = torch.full_like(value, float("nan"))
+    returns_buffer = torch.full_like(value, float("nan"))
+    advantages, returns = gae_advantages(
+        value,
+        reward,
+        terminated,
+        done,
+        DISCOUNT,
+        GAE,
+        advantages=advantages_buffer,
+        returns=returns_buffer,
+    )
+    assert advantages.data_ptr() == advantages_buffer.data_ptr()
+    assert returns.data_ptr() == returns_buffer.data_ptr()
+    torch.testing.assert_close(
+        advantages_buffer, naive_gae(value, reward, terminated, done)
+    )
+
+
+def test_gae_scan_gradcheck():
+    generator = torch.Generator().manual_seed(1)
+    delta = torch.randn(6, 2, generator=generator, dtype=torch.float64)
+    delta.requires_grad_(True)
+    _, _, _, done = make_rollout(torch.float64)
+    coef = DISCOUNT * GAE * (~done[1:7, :2]).to(torch.float64)
+
+    def scan(delta):
+        advantages = torch.empty(7, 2, dtype=torch.float64)
+        return _GAEScan.apply(delta, coef, advantages, False)
+
+    assert torch.autograd.gradcheck(scan, (delta,))
+
+
+def test_discounted_returns_match_the_naive_sum():
+    _, reward, _, done = make_rollout()
+    torch.testing.assert_close(
+        discounted_returns(reward, DISCOUNT, done), naive_returns(reward, done)
+    )
+    no_done = torch.zeros_like(done)
+    torch.testing.assert_close(
+        discounted_returns(reward, DISCOUNT), naive_returns(reward, no_done)
+    )
@@ -0,0 +1,35 @@
+import torch
+from bbrl.workspace import Workspace
+
+from bbrl_algos.models.rollout_buffer import RolloutBuffer
+
+
+def make_buffer(done):
+    n_steps, n_envs = done.shape
+    workspace = Workspace()
+    workspace.set_full("env/env_obs", torch.randn(n_steps, n_envs, 3))
+    workspace.set_full("action", torch.zeros(n_steps, n_envs, dtype=torch.long))
+    workspace.set_full("env/reward", torch.ones(n_steps, n_envs))
+    workspace.set_full("env/terminated", done.clone())
+    workspace.set_full("env/done", done)
+    rollout_buffer = RolloutBuffer()
+    rollout_buffer.store(workspace)
+    return rollout_buffer
+
+
+def test_minibatches_are_never_empty():
+    done = torch.zeros(4, 2, dtype=torch.bool)
+    done[1] = True
+    rollout_buffer = make_buffer(done)
+    assert rollout_buffer.nb_transitions() == 4
+
+    batches = list(rollout_buffer.minibatches(1, nb_batches=6))
+    assert len(batches) == 4
+    assert all(len(indices) > 0 for indices in batches)
+    covered = torch.cat(batches).sort().values
+    assert torch.equal(covered, rollout_buffer.valid.flatten().nonzero().squeeze(-1))
+
+
+def test_no_minibatch_without_valid_transitions():
+    rollout_buffer = make_buffer(torch.ones(3, 2, dtype=torch.bool))
+    assert list(rollout_buffer.minibatches(1, nb_batches=2)) == []
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+
+from bbrl_algos.models.ensemble import MemberStatsWriter
+from bbrl_algos.models.stats import StatsWriter, load_runs, load_stats
+
+
+def write_run(path, nb_evals, nb_episodes=3, offset=0.0):
+    writer = StatsWriter(str(path), nb_episodes)
+    for k in range(nb_evals):
+        writer.write(1000 * (k + 1), torch.arange(nb_episodes) + offset + k)
+    writer.close()
+
+
+def test_written_evaluations_are_loaded_back(tmp_path):
+    path = tmp_path / "run.stats"
+    write_run(path, 4)
+    steps, rewards = load_stats(str(path))
+    assert steps.tolist() == [1000, 2000, 3000, 4000]
+    assert rewards.shape == (4, 3)
+    np.testing.assert_array_equal(rewards[2], [2.0, 3.0, 4.0])
+
+
+def test_a_resumed_run_keeps_the_evaluations_up_to_its_step(tmp_path):
+    path = tmp_path / "run.stats"
+    write_run(path, 4)
+    # An evaluation partly written when the run was interrupted
+    with open(path, "ab") as file:
+        file.write(b"\x01\x02\x03")
+    assert len(load_stats(str(path))[0]) == 4
+    # Resumed from a checkpoint at step 2500: the evaluations after it are dropped
+    writer = StatsWriter(str(path), 3, resume_step=2500)
+    writer.write(3000, [7.0, 8.0, 9.0])
+    writer.close()
+
+    steps, rewards = load_stats(str(path))
+    assert steps.tolist() == [1000, 2000, 3000]
+    np.testing.assert_array_equal(rewards[-1], [7.0, 8.0, 9.0])
+
+    with pytest.raises(ValueError):
+        StatsWriter(str(path), 5, resume_step=2500)
+
+
+def test_a_new_run_overwrites_the_file(tmp_path):
+    path = tmp_path / "run.stats"
+    write_run(path, 4)
+    StatsWriter(str(path), 3).close()
+    steps, rewards = load_stats(str(path))
+    assert len(steps) == 0 and rewards.shape == (0, 3)
+
+
+def test_load_runs_cuts_the_runs_to_the_shortest_one(tmp_path):
+    paths = [tmp_path / "a.stats", tmp_path / "b.stats"]
+    write_run(paths[0], 4)
+    write_run(paths[1], 2, offset=10.0)
+
+    steps, curves = load_runs([str(path) for path in paths])
+    assert steps.tolist() == [1000, 2000]
+    np.testing.assert_allclose(curves, [[1.0, 11.0], [2.0, 12.0]])
+
+    _, episodes = load_runs([str(path) for path in paths], episodes=True)
+    assert episodes.shape == (2, 2, 3)
+
+
+def test_member_stats_are_one_stats_file_per_seed(tmp_path):
+    stats = MemberStatsWriter(str(tmp_path), "dqn", "CartPole-v1", 2, 3)
+    stats.write(1000, torch.tensor([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]))
+    stats.write(2000, torch.tensor([[2.0, 2.0, 2.0], [8.0, 8.0, 8.0]]))
+    stats.close()
+
+    paths = [str(tmp_path / f"dqn_CartPole-v1_seed{index}.stats") for index in (0, 1)]
+    steps, curves = load_runs(paths)
+    assert steps.tolist() == [1000, 2000]
+    np.testing.assert_allclose(curves, [[2.0, 5.0], [2.0, 8.0]])